@@ -103,7 +103,7 @@ class ApplianceVm(object):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = RefreshFirewallRsp()
 
-        ipt = iptables.from_iptables_save()
+        ipt = iptables.from_iptables_save(cached=True)
 
         # replace bootstrap 22 port rule with a more restricted one that binds to eth0's IP
         ipt.remove_rule('-A INPUT -i eth0 -p tcp -m tcp --dport 22 -j ACCEPT')
@@ -7,6 +7,7 @@ from zstacklib.utils import daemon
 from zstacklib.utils import linux
 from zstacklib.utils import filedb
 from zstacklib.utils import lock
+from zstacklib.utils import sockstat
 import os.path
 import atexit
 import time
@@ -115,17 +116,7 @@ class ConsoleProxyAgent(object):
         return '%s-%s' % (f, cmd.token)
     
     def _get_pid_on_port(self, port):
-        out = shell.call('netstat -anp | grep ":%s" | grep LISTEN' % port, exception=False)
-        out = out.strip(' \n\t\r')
-        if "" == out:
-            return None
-        
-        pid = out.split()[-1].split('/')[0]
-        try:
-            pid = int(pid)
-            return pid
-        except:
-            return None
+        return sockstat.get_pid_listening_on_port(port)
 
         
     def _check_proxy_availability(self, args):
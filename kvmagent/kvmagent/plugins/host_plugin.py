@@ -56,8 +56,14 @@ logger = log.get_logger(__name__)
 
 
 def _get_memory(word):
-    out = shell.ShellCmd("cat /proc/meminfo | grep '%s'" % word)()
-    (name, capacity) = out.split(':')
+    with open('/proc/meminfo') as fd:
+        for line in fd:
+            if line.startswith(word + ':'):
+                break
+        else:
+            raise kvmagent.KvmError('cannot find %s in /proc/meminfo' % word)
+
+    (name, capacity) = line.split(':')
     capacity = re.sub('[k|K][b|B]', '', capacity).strip()
     #capacity = capacity.rstrip('kB').rstrip('KB').rstrip('kb').strip()
     return sizeunit.KiloByte.toByte(long(capacity))   
@@ -143,8 +149,8 @@ class HostPlugin(kvmagent.KvmAgent):
     @kvmagent.replyerror
     def capacity(self, req):
         rsp = HostCapacityResponse()
-        rsp.cpuNum = linux.get_cpu_num()
-        rsp.cpuSpeed = linux.get_cpu_speed()
+        rsp.cpuNum = self.cpu_num
+        rsp.cpuSpeed = self.cpu_speed
         (used_cpu, used_memory) = vm_plugin.get_cpu_memory_used_by_running_vms()
         rsp.usedCpu = used_cpu
         rsp.totalMemory = _get_total_memory()
@@ -208,6 +214,9 @@ class HostPlugin(kvmagent.KvmAgent):
         self.heartbeat_timer = {}
         self.libvirt_version = self._get_libvirt_version()
         self.qemu_version = self._get_qemu_version()
+        # not changed while the agent runs, no need to fork shells for every capacity query
+        self.cpu_num = linux.get_cpu_num()
+        self.cpu_speed = linux.get_cpu_speed()
 
     def stop(self):
         pass
@@ -14,6 +14,7 @@ import os.path
 import re
 import threading
 import time
+import collections
 from jinja2 import Template
 
 logger = log.get_logger(__name__)
@@ -132,6 +133,246 @@ exit 0
 
         shell.call(cmd)
 
+class DnsmasqHosts(object):
+    '''
+    the dhcp-hostsfile, dhcp-optsfile and addn-hosts of the dnsmasq of a
+    bridge, indexed by mac, ip and tag. Changes are made in memory and
+    flush() writes each changed file once. reload_if_changed() rereads the
+    files if others changed them since they were read or written
+    '''
+    def __init__(self, dhcp_path, dns_path, option_path):
+        self.dhcp_path = dhcp_path
+        self.dns_path = dns_path
+        self.option_path = option_path
+        # mac -> line of the dhcp-hostsfile
+        self.dhcp = collections.OrderedDict()
+        # ip -> mac
+        self.dhcp_ips = {}
+        # tag -> lines of the dhcp-optsfile
+        self.options = collections.OrderedDict()
+        # ip -> lines of the addn-hosts
+        self.dns = collections.OrderedDict()
+        self.dirty = set()
+        # path -> (inode, mtime, size) of the file when it was read or written
+        self.stats = {}
+        self._load()
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    @staticmethod
+    def _read_lines(path):
+        if not os.path.exists(path):
+            return []
+
+        with open(path, 'r') as fd:
+            return [l.strip() for l in fd.readlines() if l.strip()]
+
+    def _add_dhcp_line(self, line):
+        # mac,set:tag,ip[,hostname],infinite
+        fields = line.split(',')
+        mac = fields[0]
+        self.dhcp[mac] = line
+        if len(fields) > 2:
+            self.dhcp_ips[fields[2]] = mac
+
+    def _load(self):
+        for path in (self.dhcp_path, self.option_path, self.dns_path):
+            self.stats[path] = self._stat(path)
+
+        for l in self._read_lines(self.dhcp_path):
+            self._add_dhcp_line(l)
+
+        for l in self._read_lines(self.option_path):
+            # tag:tag,option
+            tag = l.split(',', 1)[0][len('tag:'):]
+            self.options.setdefault(tag, []).append(l)
+
+        for l in self._read_lines(self.dns_path):
+            # ip hostname
+            self.dns.setdefault(l.split()[0], []).append(l)
+
+    def clear(self):
+        self.dhcp.clear()
+        self.dhcp_ips.clear()
+        self.options.clear()
+        self.dns.clear()
+        self.dirty.update([self.dhcp_path, self.option_path, self.dns_path])
+
+    def reload_if_changed(self):
+        changed = [p for p, st in self.stats.items() if self._stat(p) != st]
+        if not changed:
+            return
+
+        logger.debug('%s are changed since they were loaded, reload them' % changed)
+        self.clear()
+        self.dirty.clear()
+        self._load()
+
+    def erase(self, mac, ip):
+        tag = mac.replace(':', '')
+
+        macs = [mac]
+        if ip in self.dhcp_ips:
+            macs.append(self.dhcp_ips[ip])
+        for m in macs:
+            line = self.dhcp.pop(m, None)
+            if line is not None:
+                fields = line.split(',')
+                if len(fields) > 2:
+                    self.dhcp_ips.pop(fields[2], None)
+                self.dirty.add(self.dhcp_path)
+
+        if self.options.pop(tag, None) is not None:
+            self.dirty.add(self.option_path)
+
+        if self.dns.pop(ip, None) is not None:
+            self.dirty.add(self.dns_path)
+
+    def add(self, d):
+        tag = d.mac.replace(':', '')
+
+        if d.isDefaultL3Network:
+            self._add_dhcp_line('%s,set:%s,%s,%s,infinite' % (d.mac, tag, d.ip, d.hostname))
+        else:
+            self._add_dhcp_line('%s,set:%s,%s,infinite' % (d.mac, tag, d.ip))
+        self.dirty.add(self.dhcp_path)
+
+        options = []
+        if d.isDefaultL3Network:
+            if d.gateway:
+                options.append('tag:%s,option:router,%s' % (tag, d.gateway))
+            if d.dns:
+                options.append('tag:%s,option:dns-server,%s' % (tag, ','.join(d.dns)))
+            if d.dnsDomain:
+                options.append('tag:%s,option:domain-name,%s' % (tag, d.dnsDomain))
+        else:
+            options.append('tag:%s,3' % tag)
+            options.append('tag:%s,6' % tag)
+        options.append('tag:%s,option:netmask,%s' % (tag, d.netmask))
+        self.options[tag] = options
+        self.dirty.add(self.option_path)
+
+        if d.isDefaultL3Network and d.hostname:
+            self.dns[d.ip] = ['%s %s' % (d.ip, d.hostname)]
+            self.dirty.add(self.dns_path)
+
+    def flush(self):
+        def to_content(lines):
+            return ''.join(['%s\n' % l for l in lines])
+
+        def lines_of(index):
+            ret = []
+            for lines in index.values():
+                ret.extend(lines)
+            return ret
+
+        if self.dhcp_path in self.dirty:
+            linux.write_file_atomically(self.dhcp_path, to_content(self.dhcp.values()))
+        if self.option_path in self.dirty:
+            linux.write_file_atomically(self.option_path, to_content(lines_of(self.options)))
+        if self.dns_path in self.dirty:
+            linux.write_file_atomically(self.dns_path, to_content(lines_of(self.dns)))
+        for path in self.dirty:
+            self.stats[path] = self._stat(path)
+        self.dirty.clear()
+
+class Dnsmasq(object):
+    '''
+    the dnsmasq serving dhcp in the namespace of a bridge. The pid is kept
+    in memory so /proc is only scanned when the process is started or gone.
+    reload() makes dnsmasq reread the hosts files with SIGHUP, restart() is
+    only needed when the dnsmasq.conf changes
+    '''
+    # dnsmasq is restarted after this number of SIGHUP
+    MAX_RELOADS_BEFORE_RESTART = 50
+
+    def __init__(self, ns_name, conf_file_path):
+        self.ns_name = ns_name
+        self.conf_file_path = conf_file_path
+        self.pid = None
+        self.signal_count = 0
+        # counters of restarts and reloads since the agent started
+        self.restarts = 0
+        self.reloads = 0
+
+    def _is_pid_alive(self):
+        if not self.pid:
+            return False
+
+        try:
+            with open('/proc/%s/cmdline' % self.pid, 'r') as fd:
+                return self.conf_file_path in fd.read()
+        except IOError:
+            return False
+
+    def get_pid(self):
+        if not self._is_pid_alive():
+            self.pid = linux.find_process_by_cmdline([self.conf_file_path])
+        return self.pid
+
+    def restart(self):
+        pid = self.get_pid()
+        if pid:
+            linux.kill_process(pid)
+        self.pid = None
+
+        cmd = '''\
+ip netns exec {{ns_name}} /sbin/dnsmasq --conf-file={{conf_file}} || ip netns exec {{ns_name}} /usr/sbin/dnsmasq --conf-file={{conf_file}}
+'''
+        tmpt = Template(cmd)
+        cmd = tmpt.render({'ns_name': self.ns_name, 'conf_file': self.conf_file_path})
+        shell.call(cmd)
+
+        def check(_):
+            return self.get_pid() is not None
+
+        if not linux.wait_callback_success(check, None, 5):
+            raise Exception('dnsmasq[conf-file:%s] is not running after being started %s seconds' % (self.conf_file_path, 5))
+
+        self.signal_count = 0
+        self.restarts += 1
+        logger.debug('restarted dnsmasq[pid:%s] of bridge[%s], restarts: %s, reloads: %s' %
+                     (self.pid, self.ns_name, self.restarts, self.reloads))
+
+    def reload(self):
+        pid = self.get_pid()
+        if not pid or self.signal_count > self.MAX_RELOADS_BEFORE_RESTART:
+            self.restart()
+            return
+
+        shell.call('kill -1 %s' % pid)
+        self.signal_count += 1
+        self.reloads += 1
+        logger.debug('reloaded dnsmasq[pid:%s] of bridge[%s], restarts: %s, reloads: %s' %
+                     (pid, self.ns_name, self.restarts, self.reloads))
+
+    def _get_interface(self):
+        with open(self.conf_file_path, 'r') as fd:
+            for l in fd.readlines():
+                if l.startswith('interface='):
+                    return l.strip()[len('interface='):]
+        return None
+
+    def release(self, leases):
+        '''
+        drop the leases, a list of (ip, mac), from a running dnsmasq. Falls
+        back to a restart when dhcp_release is not installed
+        '''
+        iface = self._get_interface()
+        if not iface or not self.get_pid() or shell.run('which dhcp_release > /dev/null 2>&1') != 0:
+            self.restart()
+            return
+
+        cmds = ['ip netns exec %s dhcp_release %s %s %s' % (self.ns_name, iface, ip, mac) for ip, mac in leases]
+        shell.call('; '.join(cmds))
+        self.reload()
+
 class Mevoco(kvmagent.KvmAgent):
     APPLY_DHCP_PATH = "/flatnetworkprovider/dhcp/apply"
     PREPARE_DHCP_PATH = "/flatnetworkprovider/dhcp/prepare"
@@ -145,7 +386,10 @@ class Mevoco(kvmagent.KvmAgent):
     USERDATA_ROOT = "/var/lib/zstack/userdata/"
 
     def __init__(self):
-        self.signal_count = 0
+        # bridge name -> DnsmasqHosts
+        self.dnsmasq_hosts = {}
+        # bridge name -> Dnsmasq
+        self.dnsmasq = {}
 
     def start(self):
         http_server = kvmagent.get_http_server()
@@ -272,6 +516,22 @@ mimetype.assign = (
 
         return conf, dhcp, dns, option, log
 
+    def _get_dnsmasq_hosts(self, bridge_name, dhcp_path, dns_path, option_path):
+        hosts = self.dnsmasq_hosts.get(bridge_name)
+        if not hosts:
+            hosts = DnsmasqHosts(dhcp_path, dns_path, option_path)
+            self.dnsmasq_hosts[bridge_name] = hosts
+        else:
+            hosts.reload_if_changed()
+        return hosts
+
+    def _get_dnsmasq(self, bridge_name, conf_file_path):
+        dnsmasq = self.dnsmasq.get(bridge_name)
+        if not dnsmasq:
+            dnsmasq = Dnsmasq(bridge_name, conf_file_path)
+            self.dnsmasq[bridge_name] = dnsmasq
+        return dnsmasq
+
     @lock.lock('prepare_dhcp')
     @kvmagent.replyerror
     def prepare_dhcp(self, req):
@@ -347,77 +607,21 @@ dhcp-range={{g}},static
                     logger.debug('wrote dnsmasq configure file for bridge[%s]\n%s' % (bridge_name, conf_file))
 
 
-            info = []
-            for d in dhcp:
-                dhcp_info = {'tag': d.mac.replace(':', '')}
-                dhcp_info.update(d.__dict__)
-                dhcp_info['dns'] = ','.join(d.dns)
-                info.append(dhcp_info)
-
-                if not cmd.rebuild:
-                    self._erase_configurations(d.mac, d.ip, dhcp_path, dns_path, option_path)
-
-            dhcp_conf = '''\
-{% for d in dhcp -%}
-{% if d.isDefaultL3Network -%}
-{{d.mac}},set:{{d.tag}},{{d.ip}},{{d.hostname}},infinite
-{% else -%}
-{{d.mac}},set:{{d.tag}},{{d.ip}},infinite
-{% endif -%}
-{% endfor -%}
-'''
-
-            tmpt = Template(dhcp_conf)
-            dhcp_conf = tmpt.render({'dhcp': info})
-            mode = 'a+'
+            hosts = self._get_dnsmasq_hosts(bridge_name, dhcp_path, dns_path, option_path)
             if cmd.rebuild:
-                mode = 'w'
-
-            with open(dhcp_path, mode) as fd:
-                fd.write(dhcp_conf)
-
-            option_conf = '''\
-{% for o in options -%}
-{% if o.isDefaultL3Network -%}
-{% if o.gateway -%}
-tag:{{o.tag}},option:router,{{o.gateway}}
-{% endif -%}
-{% if o.dns -%}
-tag:{{o.tag}},option:dns-server,{{o.dns}}
-{% endif -%}
-{% if o.dnsDomain -%}
-tag:{{o.tag}},option:domain-name,{{o.dnsDomain}}
-{% endif -%}
-{% else -%}
-tag:{{o.tag}},3
-tag:{{o.tag}},6
-{% endif -%}
-tag:{{o.tag}},option:netmask,{{o.netmask}}
-{% endfor -%}
-    '''
-            tmpt = Template(option_conf)
-            option_conf = tmpt.render({'options': info})
-
-            with open(option_path, mode) as fd:
-                fd.write(option_conf)
+                hosts.clear()
 
-            hostname_conf = '''\
-{% for h in hostnames -%}
-{% if h.isDefaultL3Network and h.hostname -%}
-{{h.ip}} {{h.hostname}}
-{% endif -%}
-{% endfor -%}
-    '''
-            tmpt = Template(hostname_conf)
-            hostname_conf = tmpt.render({'hostnames': info})
-
-            with open(dns_path, mode) as fd:
-                fd.write(hostname_conf)
+            # the whole batch is applied in memory, each file is written once
+            for d in dhcp:
+                hosts.erase(d.mac, d.ip)
+                hosts.add(d)
+            hosts.flush()
 
+            dnsmasq = self._get_dnsmasq(bridge_name, conf_file_path)
             if restart_dnsmasq:
-                self._restart_dnsmasq(bridge_name, conf_file_path)
+                dnsmasq.restart()
             else:
-                self._refresh_dnsmasq(bridge_name, conf_file_path)
+                dnsmasq.reload()
 
         for k, v in bridge_dhcp.iteritems():
             apply(k, v)
@@ -425,62 +629,6 @@ tag:{{o.tag}},option:netmask,{{o.netmask}}
         rsp = ApplyDhcpRsp()
         return jsonobject.dumps(rsp)
 
-    def _restart_dnsmasq(self, ns_name, conf_file_path):
-        pid = linux.find_process_by_cmdline([conf_file_path])
-        if pid:
-            linux.kill_process(pid)
-
-        cmd = '''\
-ip netns exec {{ns_name}} /sbin/dnsmasq --conf-file={{conf_file}} || ip netns exec {{ns_name}} /usr/sbin/dnsmasq --conf-file={{conf_file}}
-'''
-        tmpt = Template(cmd)
-        cmd = tmpt.render({'ns_name': ns_name, 'conf_file': conf_file_path})
-        shell.call(cmd)
-
-        def check(_):
-            pid = linux.find_process_by_cmdline([conf_file_path])
-            return pid is not None
-
-        if not linux.wait_callback_success(check, None, 5):
-            raise Exception('dnsmasq[conf-file:%s] is not running after being started %s seconds' % (conf_file_path, 5))
-
-    def _refresh_dnsmasq(self, ns_name, conf_file_path):
-        pid = linux.find_process_by_cmdline([conf_file_path])
-        if not pid:
-            self._restart_dnsmasq(ns_name, conf_file_path)
-            return
-
-        if self.signal_count > 50:
-            self._restart_dnsmasq(ns_name, conf_file_path)
-            self.signal_count = 0
-            return
-
-        shell.call('kill -1 %s' % pid)
-        self.signal_count += 1
-
-    def _erase_configurations(self, mac, ip, dhcp_path, dns_path, option_path):
-        cmd = '''\
-sed -i '/{{mac}}/d' {{dhcp}};
-sed -i '/{{ip}}/d' {{dhcp}};
-sed -i '/^$/d' {{dhcp}};
-sed -i '/{{tag}}/d' {{option}};
-sed -i '/^$/d' {{option}};
-sed -i '/{{ip}}/d' {{dns}};
-sed -i '/^$/d' {{dns}}
-'''
-        tmpt = Template(cmd)
-        context = {
-            'tag': mac.replace(':', ''),
-            'mac': mac,
-            'dhcp': dhcp_path,
-            'option': option_path,
-            'ip': ip,
-            'dns': dns_path,
-            }
-
-        cmd = tmpt.render(context)
-        shell.call(cmd)
-
     @lock.lock('dnsmasq')
     @kvmagent.replyerror
     def release_dhcp(self, req):
@@ -496,11 +644,14 @@ sed -i '/^$/d' {{dns}}
 
         def release(bridge_name, dhcp):
             conf_file_path, dhcp_path, dns_path, option_path, _ = self._make_conf_path(bridge_name)
+            hosts = self._get_dnsmasq_hosts(bridge_name, dhcp_path, dns_path, option_path)
 
             for d in dhcp:
-                self._erase_configurations(d.mac, d.ip, dhcp_path, dns_path, option_path)
-                #shell.call("(which dhcp_release &>/dev/null && dhcp_release %s %s %s) || true" % (bridge_name, d.ip, d.mac))
-                self._restart_dnsmasq(bridge_name, conf_file_path)
+                hosts.erase(d.mac, d.ip)
+            hosts.flush()
+
+            # the dnsmasq.conf doesn't change, no need to restart
+            self._get_dnsmasq(bridge_name, conf_file_path).release([(d.ip, d.mac) for d in dhcp])
 
         for k, v in bridge_dhcp.iteritems():
             release(k, v)
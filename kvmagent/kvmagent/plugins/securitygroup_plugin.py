@@ -11,8 +11,12 @@ from zstacklib.utils import shell
 from zstacklib.utils import lock
 from zstacklib.utils import linux
 from zstacklib.utils import iptables
+from zstacklib.utils import ipset
+from zstacklib.utils import thread
 import os.path
 import re
+import hashlib
+import collections
 
 logger = log.get_logger(__name__)
 
@@ -29,6 +33,9 @@ class RuleTO(object):
         self.endPort = None
         self.allowedInternalIpRange = None
         self.allowedCidr = None
+        # optional, names the ipset shared by the vnics of the group. It's not
+        # sent by the management node yet, see _make_ipset_name()
+        self.securityGroupUuid = None
 
 class ApplySecurityGroupRuleCmd(kvmagent.AgentCommand):
     def __init__(self):
@@ -73,6 +80,14 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
     WORLD_OPEN_CIDR = '0.0.0.0/0'
     
     ZSTACK_DEFAULT_CHAIN = 'sg-default'
+
+    IPSET_NAME_PREFIX = 'zsg-'
+    # falls back to one iprange rule per allowed ip if ipset is not installed
+    IPSET_ENABLED = True
+
+    use_ipset = False
+    # merges ruleTOs of concurrent applyrules calls into one iptables-restore
+    apply_queue = None
     
     def _make_in_chain_name(self, vif_name):
         return '%s-in' % vif_name
@@ -93,6 +108,40 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         return '-A %s -j DROP' % out_chain_name
         
     def _create_rules_using_iprange_match(self, sto):
+        def iprange_matches(rto, direction):
+            return ['-m iprange --%s-range %s' % (direction, ip) for ip in rto.allowedInternalIpRange or []]
+
+        return self._create_rules(sto, iprange_matches)
+
+    def _make_ipset_name(self, sto, rto):
+        # vnics of a security group would share one set named after the group,
+        # but the management node doesn't send the group of a rule yet. The
+        # set is then named after the vnic and the rule, one set per rule of
+        # a vnic, so a change of members keeps the rule as it is. The rule
+        # alone can't name a shared set, vnics of different groups may have
+        # the same rule allowing different members
+        if rto.securityGroupUuid:
+            key = rto.securityGroupUuid
+        else:
+            key = hashlib.md5('%s %s %s %s:%s %s' % (sto.vmNicInternalName, rto.type, rto.protocol,
+                    rto.startPort, rto.endPort, rto.allowedCidr)).hexdigest()
+        return (self.IPSET_NAME_PREFIX + key)[:ipset.MAX_SET_NAME_LEN]
+
+    def _create_rules_using_ipset_match(self, sto, ipsets):
+        def ipset_matches(rto, direction):
+            if not rto.allowedInternalIpRange:
+                return []
+
+            # rules of the same name only differ in the ips they allow, one
+            # set of all of them allows the same
+            set_name = self._make_ipset_name(sto, rto)
+            members = ipsets.setdefault(set_name, [])
+            members.extend([ip for ip in rto.allowedInternalIpRange if ip not in members])
+            return ['-m set --match-set %s %s' % (set_name, direction)]
+
+        return self._create_rules(sto, ipset_matches)
+
+    def _create_rules(self, sto, internal_ip_matches):
         rules = []
         vif_name = sto.vmNicInternalName
         in_chain_name = self._make_in_chain_name(vif_name)
@@ -111,21 +160,21 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
                 else:
                     icmp_type = '%s/%s' % (rto.startPort, rto.endPort)
                     
-                tmpt = ' '.join(['-A', in_chain_name, '-p icmp --icmp-type', icmp_type, '-m iprange --src-range %s -j RETURN'])
+                tmpt = ' '.join(['-A', in_chain_name, '-p icmp --icmp-type', icmp_type, '%s -j RETURN'])
                 cidr_tmpt = ' '.join(['-A', in_chain_name, '-p icmp --icmp-type', icmp_type, '-s %s -j RETURN'])
             else:
                 protocol = rto.protocol.lower()
                 start_port = rto.startPort
                 end_port = rto.endPort
-                tmpt = ' '.join(['-A', in_chain_name, '-p', protocol, '-m', protocol, '--dport', '%s:%s' % (start_port, end_port), '-m state --state NEW -m iprange --src-range %s -j RETURN'])
+                tmpt = ' '.join(['-A', in_chain_name, '-p', protocol, '-m', protocol, '--dport', '%s:%s' % (start_port, end_port), '-m state --state NEW %s -j RETURN'])
                 cidr_tmpt = ' '.join(['-A', in_chain_name, '-p', protocol, '-m', protocol, '--dport', '%s:%s' % (start_port, end_port), '-m state --state NEW -s %s -j RETURN'])
                         
             rule = cidr_tmpt % rto.allowedCidr
             rules.append(rule)
             
             if rto.allowedCidr != self.WORLD_OPEN_CIDR:
-                for internal_ip in rto.allowedInternalIpRange:
-                    rule = tmpt % internal_ip
+                for match in internal_ip_matches(rto, 'src'):
+                    rule = tmpt % match
                     rules.append(rule)
             
         
@@ -136,20 +185,20 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
                 else:
                     icmp_type = '%s/%s' % (rto.startPort, rto.endPort)
                     
-                tmpt = ' '.join(['-A', out_chain_name, '-p icmp --icmp-type', icmp_type, '-m iprange --dst-range %s -j RETURN'])
+                tmpt = ' '.join(['-A', out_chain_name, '-p icmp --icmp-type', icmp_type, '%s -j RETURN'])
                 cidr_tmpt = ' '.join(['-A', out_chain_name, '-p icmp --icmp-type', icmp_type, '-d %s -j RETURN'])
             else:
                 protocol = rto.protocol.lower()
                 start_port = rto.startPort
                 end_port = rto.endPort
-                tmpt = ' '.join(['-A', out_chain_name, '-p', protocol, '-m', protocol, '--dport', '%s:%s' % (start_port, end_port), '-m state --state NEW -m iprange --dst-range %s -j RETURN'])
+                tmpt = ' '.join(['-A', out_chain_name, '-p', protocol, '-m', protocol, '--dport', '%s:%s' % (start_port, end_port), '-m state --state NEW %s -j RETURN'])
                 cidr_tmpt = ' '.join(['-A', out_chain_name, '-p', protocol, '-m', protocol, '--dport', '%s:%s' % (start_port, end_port), '-m state --state NEW -d %s -j RETURN'])
                         
             rule = cidr_tmpt % rto.allowedCidr
             rules.append(rule)
             if rto.allowedCidr != self.WORLD_OPEN_CIDR:
-                for internal_ip in rto.allowedInternalIpRange:
-                    rule = tmpt % internal_ip
+                for match in internal_ip_matches(rto, 'dst'):
+                    rule = tmpt % match
                     rules.append(rule)
             
         empty_in_chain = True
@@ -186,32 +235,97 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         
         return rules
     
+    def _make_default_rules(self):
+        return [
+            '-A %s -m state --state RELATED,ESTABLISHED -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN,
+            '-A %s -p udp -m physdev  --physdev-is-bridged -m udp --sport 68 --dport 67 -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN,
+            '-A %s -p udp -m physdev  --physdev-is-bridged -m udp --sport 67 --dport 68 -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN,
+            '-A %s -p udp -m physdev  --physdev-is-bridged -m udp --dport 53 -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN,
+        ]
+
+    def _make_default_accept_rule(self):
+        return '-A %s -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN
+
     def _create_default_rules(self, ipt):
         ipt.add_rule('-A FORWARD -m physdev  --physdev-is-bridged -j %s' % self.ZSTACK_DEFAULT_CHAIN)
-        ipt.add_rule('-A %s -m state --state RELATED,ESTABLISHED -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN)
-        ipt.add_rule('-A %s -p udp -m physdev  --physdev-is-bridged -m udp --sport 68 --dport 67 -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN)
-        ipt.add_rule('-A %s -p udp -m physdev  --physdev-is-bridged -m udp --sport 67 --dport 68 -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN)
-        ipt.add_rule('-A %s -p udp -m physdev  --physdev-is-bridged -m udp --dport 53 -j ACCEPT' % self.ZSTACK_DEFAULT_CHAIN)
+        for rule in self._make_default_rules():
+            ipt.add_rule(rule)
+
+    def _rebuild_default_chain_if_changed(self, ipt, nic_names):
+        default_rules = [' '.join(r.split()) for r in self._make_default_rules()]
+        jump_rules = []
+        for nic_name in nic_names:
+            jump_rules.append(self._start_ingress_rule(nic_name, self._make_in_chain_name(nic_name)))
+            jump_rules.append(self._start_egress_rule(nic_name, self._make_out_chain_name(nic_name)))
+        jump_rules = [' '.join(r.split()) for r in jump_rules]
+        accept_rule = ' '.join(self._make_default_accept_rule().split())
+
+        # the default rules come first and the accept rule last, the jumps
+        # to vnic chains match distinct vnics, their order doesn't matter
+        chain = ipt.get_chain(self.ZSTACK_DEFAULT_CHAIN)
+        current = [r.identity for r in chain.children] if chain else []
+        middle = current[len(default_rules):-1]
+        if current[:len(default_rules)] == default_rules and current[-1:] == [accept_rule] and \
+                len(middle) == len(jump_rules) and set(middle) == set(jump_rules):
+            return
+
+        logger.debug('rules of chain[%s] are changed, rebuild it' % self.ZSTACK_DEFAULT_CHAIN)
+        ipt.delete_chain(self.ZSTACK_DEFAULT_CHAIN)
+        for rule in default_rules + jump_rules + [accept_rule]:
+            ipt.add_rule(rule)
     
-    def _delete_all_chains(self, ipt):
+    def _delete_vnic_chains_not_in(self, ipt, nic_names):
         filter_table = ipt.get_table()
-        for c in filter_table.children:
-            if c.name.startswith('vnic'):
+        for c in list(filter_table.children):
+            if c.name.startswith('vnic') and c.name.split('-')[0] not in nic_names:
                 logger.debug('delete zstack vnic chain[%s]' % c.name)
-                c.delete()
-                
-        default_chain = ipt.get_chain(self.ZSTACK_DEFAULT_CHAIN)
-        if default_chain:
-            default_chain.delete()
-            logger.debug('deleted default chain')
+                self._delete_vnic_chain(ipt, c.name.split('-')[0])
+
+    def _make_vnic_chain_rules(self, nic_name, rules):
+        '''
+        returns {chain name -> rules} of the in and out chains of the vnic, in
+        the order they are in the chains
+        '''
+        chains = collections.OrderedDict()
+        for chain_name in (self._make_in_chain_name(nic_name), self._make_out_chain_name(nic_name)):
+            chains[chain_name] = []
+
+        for rule in rules:
+            rule = ' '.join(rule.split())
+            chain_rules = chains.get(rule.split(None, 2)[1])
+            if chain_rules is not None and rule not in chain_rules:
+                chain_rules.append(rule)
+        return chains
     
-    def _apply_rules_on_vnic_chain(self, ipt, rto):
-        self._delete_vnic_chain(ipt, rto.vmNicInternalName)
-        
-        rules = self._create_rules_using_iprange_match(rto)
+    def _create_vnic_rules(self, rto, ipsets):
+        if self.use_ipset:
+            return self._create_rules_using_ipset_match(rto, ipsets)
+        else:
+            return self._create_rules_using_iprange_match(rto)
+
+    def _is_vnic_chain_unchanged(self, ipt, nic_name, chain_rules):
+        # the model keeps the rules of chains the kernel has as they were
+        # written, chains changed by others are parsed from iptables-save and
+        # differ from the rules written
+        for chain_name, rules in chain_rules.items():
+            chain = ipt.get_chain(chain_name)
+            if not chain or [r.identity for r in chain.children] != rules:
+                return False
+
+        # the chains are useless if nothing jumps to them
+        if not ipt.search_rule(self._start_ingress_rule(nic_name, self._make_in_chain_name(nic_name))):
+            return False
+        return ipt.search_rule(self._start_egress_rule(nic_name, self._make_out_chain_name(nic_name))) is not None
+
+    def _apply_rules_on_vnic_chain(self, ipt, nic_name, rules):
+        if self._is_vnic_chain_unchanged(ipt, nic_name, self._make_vnic_chain_rules(nic_name, rules)):
+            return False
+
+        self._delete_vnic_chain(ipt, nic_name)
         
         for rule in rules:
             ipt.add_rule(rule)
+        return True
             
     def _delete_vnic_in_chain(self, ipt, nic_name):
         in_chain_name = self._make_in_chain_name(nic_name)
@@ -219,8 +333,8 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         ipt.remove_rule(self._start_ingress_rule(nic_name, in_chain_name))
         ipt.remove_rule(self._end_ingress_rule(in_chain_name))
         default_chain = ipt.get_chain(self.ZSTACK_DEFAULT_CHAIN)
-        for r in default_chain.children:
-            if ipt.is_target_in_rule(r.identity, in_chain_name):
+        for r in ipt.search_rules_by_target(in_chain_name):
+            if r.parent is default_chain:
                 r.delete()
                 
     def _delete_vnic_out_chain(self, ipt, nic_name):
@@ -229,8 +343,8 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         ipt.remove_rule(self._start_egress_rule(nic_name, out_chain_name))
         ipt.remove_rule(self._end_egress_rule(out_chain_name))
         default_chain = ipt.get_chain(self.ZSTACK_DEFAULT_CHAIN)
-        for r in default_chain.children:
-            if ipt.is_target_in_rule(r.identity, out_chain_name):
+        for r in ipt.search_rules_by_target(out_chain_name):
+            if r.parent is default_chain:
                 r.delete()
         
     def _delete_vnic_chain(self, ipt, nic_name):
@@ -247,42 +361,82 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
             return True
         return False
 
-    def _apply_rules_using_iprange_match(self, cmd, iptable=None):
-        if not iptable:
-            ipt = iptables.from_iptables_save()
-        else:
-            ipt = iptable
+    def _cleanup_unused_ipsets(self, ipt):
+        used = set(re.findall(r'--match-set (\S+)', str(ipt)))
+        try:
+            unused = [n for n in ipset.list_set_names() if n.startswith(self.IPSET_NAME_PREFIX) and n not in used]
+            ipset.destroy_sets(unused)
+        except Exception:
+            logger.warn('unable to cleanup unused ipsets\n%s' % linux.get_exception_stacktrace())
 
-        self._create_default_rules(ipt)
-        
-        for rto in cmd.ruleTOs:
+    def _apply_rules(self, rule_tos, refresh=False):
+        ipsets = {}
+        vnic_rules = []
+        for rto in rule_tos:
             if rto.actionCode == self.ACTION_CODE_DELETE_CHAIN:
-                self._delete_vnic_chain(ipt, rto.vmNicInternalName)
+                vnic_rules.append((rto.vmNicInternalName, None))
             elif rto.actionCode == self.ACTION_CODE_APPLY_RULE:
-                self._apply_rules_on_vnic_chain(ipt, rto)
+                vnic_rules.append((rto.vmNicInternalName, self._create_vnic_rules(rto, ipsets)))
             else:
                 raise Exception('unknown action code: %s' % rto.actionCode)
 
+        # rules only reference sets by name, a change of group members is
+        # done once the sets are synced. The vnic chains are then unchanged
+        # and nothing is restored
+        ipset.sync_sets(ipsets)
+
+        # the cached model is checked against the rules in kernel chain by
+        # chain, a full refresh can take it as well
+        ipt = iptables.from_iptables_save(cached=True)
+        if refresh:
+            nic_names = [n for n, rules in vnic_rules if rules is not None]
+            self._delete_vnic_chains_not_in(ipt, nic_names)
+            self._rebuild_default_chain_if_changed(ipt, nic_names)
 
-        default_accept_rule = "-A %s -j ACCEPT" % self.ZSTACK_DEFAULT_CHAIN
+        self._create_default_rules(ipt)
+        
+        unchanged = 0
+        for nic_name, rules in vnic_rules:
+            if rules is None:
+                self._delete_vnic_chain(ipt, nic_name)
+            elif not self._apply_rules_on_vnic_chain(ipt, nic_name, rules):
+                unchanged += 1
+        if unchanged:
+            logger.debug('skipped %s vnics whose rules are not changed' % unchanged)
+
+
+        default_accept_rule = self._make_default_accept_rule()
         ipt.remove_rule(default_accept_rule)
         ipt.add_rule(default_accept_rule)
         self._cleanup_stale_chains(ipt)
         ipt.iptable_restore()
+
+        if self.use_ipset:
+            self._cleanup_unused_ipsets(ipt)
         
-    def _refresh_rules_on_host_using_iprange_match(self, cmd):
-        ipt = iptables.from_iptables_save()
-        self._delete_all_chains(ipt)
-        self._apply_rules_using_iprange_match(cmd, ipt)
+    def _refresh_rules_on_host(self, rule_tos):
+        # chains of vnics whose rules are not changed are kept as they are
+        self._apply_rules(rule_tos, refresh=True)
     
-    @lock.lock('iptables')
+    def _apply_coalesced_rules(self, rule_to_lists):
+        # only the last action of a vnic matters
+        rule_tos = collections.OrderedDict()
+        for rtos in rule_to_lists:
+            for rto in rtos:
+                rule_tos.pop(rto.vmNicInternalName, None)
+                rule_tos[rto.vmNicInternalName] = rto
+
+        logger.debug('apply rules of %s vnics merged from %s requests' % (len(rule_tos), len(rule_to_lists)))
+        with lock.NamedLock('iptables'):
+            self._apply_rules(rule_tos.values())
+
     @kvmagent.replyerror
     def apply_rules(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = ApplySecurityGroupRuleResponse()
         try:
-            self._apply_rules_using_iprange_match(cmd)
-        except iptables.IPTablesError as e:
+            self.apply_queue.submit(cmd.ruleTOs)
+        except (iptables.IPTablesError, ipset.IPSetError) as e:
             err_log = linux.get_exception_stacktrace()
             logger.warn(err_log)
             rsp.error = str(e)
@@ -292,11 +446,13 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
     @lock.lock('iptables')
     @kvmagent.replyerror
     def refresh_rules_on_host(self, req):
-        cmd = jsonobject.loads(req[http.REQUEST_BODY])
+        # the body is streamed, the ruleTOs of a dense host are decoded one
+        # at a time instead of holding the whole command in memory
+        rule_tos = jsonobject.JsonArrayStream(req[http.REQUEST_BODY], 'ruleTOs')
         rsp = RefreshAllRulesOnHostResponse()
         try:
-            self._refresh_rules_on_host_using_iprange_match(cmd)
-        except iptables.IPTablesError as e:
+            self._refresh_rules_on_host(rule_tos)
+        except (iptables.IPTablesError, ipset.IPSetError) as e:
             err_log = linux.get_exception_stacktrace()
             logger.warn(err_log)
             rsp.error = str(e)
@@ -315,14 +471,20 @@ class SecurityGroupPlugin(kvmagent.KvmAgent):
         ipt = iptables.from_iptables_save()
         self._cleanup_stale_chains(ipt)
         ipt.iptable_restore()
+        if self.use_ipset:
+            self._cleanup_unused_ipsets(ipt)
 
         return jsonobject.dumps(rsp)
 
     def start(self):
+        self.use_ipset = self.IPSET_ENABLED and ipset.is_ipset_available()
+        self.apply_queue = thread.Coalescer(self._apply_coalesced_rules)
+        logger.debug('security group rules of internal ips are applied by %s' % ('ipset' if self.use_ipset else 'iprange'))
+
         http_server = kvmagent.get_http_server()
         http_server.register_async_uri(self.SECURITY_GROUP_CLEANUP_UNUSED_RULE_ON_HOST_PATH, self.cleanup_unused_rules_on_host)
         http_server.register_async_uri(self.SECURITY_GROUP_APPLY_RULE_PATH, self.apply_rules)
-        http_server.register_async_uri(self.SECURITY_GROUP_REFRESH_RULE_ON_HOST_PATH, self.refresh_rules_on_host)
+        http_server.register_async_uri(self.SECURITY_GROUP_REFRESH_RULE_ON_HOST_PATH, self.refresh_rules_on_host, stream_body=True)
         
     def stop(self):
         pass
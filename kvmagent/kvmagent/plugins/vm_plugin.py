@@ -13,6 +13,7 @@ from zstacklib.utils import uuidhelper
 from zstacklib.utils import linux
 import zstacklib.utils.lock as lock
 from zstacklib.utils import thread
+from zstacklib.utils import sockstat
 import functools
 import zstacklib.utils.iptables as iptables
 import os.path
@@ -23,6 +24,7 @@ import traceback
 import Queue
 import sys
 import time
+import threading
 
 logger = log.get_logger(__name__)
 
@@ -91,6 +93,19 @@ class DestroyVmResponse(kvmagent.AgentResponse):
     def __init__(self):
         super(DestroyVmResponse, self).__init__()
 
+class BatchVmCmd(kvmagent.AgentCommand):
+    def __init__(self):
+        super(BatchVmCmd, self).__init__()
+        # StartVmCmd/StopVmCmd/DestroyVmCmd, each may carry a taskUuid
+        # under which its own response is posted as soon as it finishes
+        self.cmds = None
+
+class BatchVmResponse(kvmagent.AgentResponse):
+    def __init__(self):
+        super(BatchVmResponse, self).__init__()
+        # a list of {vmUuid, success, error} in the order of cmds
+        self.results = None
+
 class VmSyncCmd(kvmagent.AgentCommand):
     def __init__(self):
         super(VmSyncCmd, self).__init__()
@@ -280,6 +295,8 @@ class LibvirtAutoReconnect(object):
         LibvirtAutoReconnect.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, reboot_callback, None)
 
         def lifecycle_callback(conn, dom, event, detail, opaque):
+            DomainCache.invalidate(dom.name())
+
             cbs = LibvirtAutoReconnect.libvirt_event_callbacks.get(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE)
             if not cbs:
                 return
@@ -534,12 +551,79 @@ class VirtioIscsi(object):
         secret.setValue(self.chap_password)
         return secret.UUIDString()
 
+class DomainCache(object):
+    '''
+    virDomain handles by vm uuid. Any lifecycle event of a domain drops its
+    handle, see LibvirtAutoReconnect.register_libvirt_callbacks()
+    '''
+    _lock = threading.Lock()
+    _domains = {}
+
+    @staticmethod
+    def get(uuid):
+        with DomainCache._lock:
+            return DomainCache._domains.get(uuid)
+
+    @staticmethod
+    def put(uuid, domain):
+        with DomainCache._lock:
+            DomainCache._domains[uuid] = domain
+
+    @staticmethod
+    def invalidate(uuid):
+        with DomainCache._lock:
+            DomainCache._domains.pop(uuid, None)
+
+class VmLifecycleWaiter(object):
+    '''
+    lets a thread sleep until a lifecycle event of a vm arrives instead of
+    polling the domain state. Waiters are woken up by
+    VmPlugin._update_vm_state_table()
+    '''
+    _lock = threading.Lock()
+    _waiters = {}
+
+    @staticmethod
+    def expect(uuid, evstr):
+        # register before triggering the operation so the event can't be missed
+        ev = threading.Event()
+        with VmLifecycleWaiter._lock:
+            VmLifecycleWaiter._waiters.setdefault((uuid, evstr), []).append(ev)
+        return ev
+
+    @staticmethod
+    def cancel(uuid, evstr, ev):
+        with VmLifecycleWaiter._lock:
+            evs = VmLifecycleWaiter._waiters.get((uuid, evstr))
+            if evs and ev in evs:
+                evs.remove(ev)
+                if not evs:
+                    del VmLifecycleWaiter._waiters[(uuid, evstr)]
+
+    @staticmethod
+    def notify(uuid, evstr):
+        with VmLifecycleWaiter._lock:
+            evs = VmLifecycleWaiter._waiters.pop((uuid, evstr), [])
+
+        for ev in evs:
+            ev.set()
+
 def get_vm_by_uuid(uuid, exception_if_not_existing=True):
+    domain = DomainCache.get(uuid)
+    if domain:
+        try:
+            return Vm.from_virt_domain(domain)
+        except libvirt.libvirtError:
+            # the domain is gone without an event reaching us, look it up again
+            DomainCache.invalidate(uuid)
+
     try:
         @LibvirtAutoReconnect
         def call_libvirt(conn):
             return conn.lookupByName(uuid)
-        vm = Vm.from_virt_domain(call_libvirt())
+        domain = call_libvirt()
+        vm = Vm.from_virt_domain(domain)
+        DomainCache.put(uuid, domain)
         return vm
     except libvirt.libvirtError as e:
         error_code = e.get_error_code()
@@ -552,23 +636,23 @@ def get_vm_by_uuid(uuid, exception_if_not_existing=True):
         err = 'error happened when looking up vm[uuid:%(uuid)s], libvirt error code: %(error_code)s, %(e)s' % locals()
         raise libvirt.libvirtError(err)
 
-def get_running_vm_uuids():
+def get_running_domains():
     @LibvirtAutoReconnect
     def call_libvirt(conn):
-        return conn.listDomainsID()
-    ids = call_libvirt()
-    uuids = []
+        if hasattr(conn, 'listAllDomains'):
+            # one round trip for all domains
+            return conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
 
-    @LibvirtAutoReconnect
-    def get_domain(conn):
-        # i is for..loop's control variable
-        # it's Python's local scope tricky
-        return conn.lookupByID(i)
+        # libvirt older than 0.9.13
+        return [conn.lookupByID(i) for i in conn.listDomainsID()]
 
-    for i in ids:
-        domain = get_domain()
-        uuids.append(domain.name())
-    return uuids
+    domains = call_libvirt()
+    for domain in domains:
+        DomainCache.put(domain.name(), domain)
+    return domains
+
+def get_running_vm_uuids():
+    return [domain.name() for domain in get_running_domains()]
 
 def get_all_vm_states():
     ret = {}
@@ -577,31 +661,196 @@ def get_all_vm_states():
         ret[r] = Vm.VM_STATE_RUNNING
     return ret
 
+class VmStateTable(object):
+    '''
+    states of vms on this host, seeded from libvirt on the first query and
+    then maintained by lifecycle events. reconcile() resyncs it with libvirt
+    in case an event is lost
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = None
+        # uuid -> (seq, state) of events received, a state of None means
+        # the vm is stopped
+        self._events = {}
+        self._seq = 0
+
+    def _set(self, uuid, state):
+        with self._lock:
+            self._seq += 1
+            self._events[uuid] = (self._seq, state)
+            if self._states is None:
+                return
+
+            if state:
+                self._states[uuid] = state
+            else:
+                self._states.pop(uuid, None)
+
+    def set_running(self, uuid):
+        self._set(uuid, Vm.VM_STATE_RUNNING)
+
+    def set_stopped(self, uuid):
+        self._set(uuid, None)
+
+    def reconcile(self):
+        with self._lock:
+            seq = self._seq
+
+        states = get_all_vm_states()
+
+        with self._lock:
+            # events came during listing may be newer than the listing
+            for uuid, (event_seq, state) in self._events.items():
+                if event_seq <= seq:
+                    del self._events[uuid]
+                elif state:
+                    states[uuid] = state
+                else:
+                    states.pop(uuid, None)
+
+            if self._states is not None and self._states != states:
+                logger.debug('vm states drifted from libvirt, reconciled them. vm states: %s' % states)
+            self._states = states
+
+    def get_states(self):
+        with self._lock:
+            if self._states is not None:
+                return dict(self._states)
+
+        self.reconcile()
+        with self._lock:
+            return dict(self._states)
+
 def get_running_vms():
-    @LibvirtAutoReconnect
-    def get_all_ids(conn):
-        return conn.listDomainsID()
-    ids = get_all_ids()
-    vms = []
+    return [Vm.from_virt_domain(domain) for domain in get_running_domains()]
+
+class VmCapacityAccountant(object):
+    '''
+    cpu and memory used by running vms. The footprint of a vm is taken from
+    its StartVmCmd, or from parsing its domain xml once if the vm is not
+    started by us, lifecycle events keep the totals up to date
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._seeded = False
+        # uuid -> (cpu, memory)
+        self._footprints = {}
+        # running vms whose footprints are not known yet
+        self._unknown = set()
+        # vms changed by events while reconcile() is listing domains
+        self._touched = None
+        self._used_cpu = 0
+        self._used_memory = 0
 
-    @LibvirtAutoReconnect
-    def get_domain(conn):
-        return conn.lookupByID(i)
+    @staticmethod
+    def _footprint_of_vm(vm):
+        return (vm.get_cpu_num() * vm.get_cpu_speed(), vm.get_memory())
+
+    def _add(self, uuid, footprint):
+        self._remove(uuid)
+        self._footprints[uuid] = footprint
+        self._used_cpu += footprint[0]
+        self._used_memory += footprint[1]
+
+    def _remove(self, uuid):
+        old = self._footprints.pop(uuid, None)
+        if old:
+            self._used_cpu -= old[0]
+            self._used_memory -= old[1]
+
+    def _touch(self, uuid):
+        if self._touched is not None:
+            self._touched.add(uuid)
+
+    def vm_started(self, uuid, cmd=None):
+        with self._lock:
+            self._touch(uuid)
+            if cmd:
+                # the same as what get_cpu_speed()/get_memory() read from the domain xml
+                self._add(uuid, (cmd.cpuNum * cmd.cpuSpeed, cmd.memory / 1024 * 1024))
+                self._unknown.discard(uuid)
+            elif uuid not in self._footprints:
+                self._unknown.add(uuid)
+
+    def vm_stopped(self, uuid):
+        with self._lock:
+            self._touch(uuid)
+            self._remove(uuid)
+            self._unknown.discard(uuid)
+
+    def reconcile(self):
+        '''
+        parses running vms unknown to us and drops vms not running any more
+        '''
+        with self._reconcile_lock:
+            self._do_reconcile()
+
+    def _do_reconcile(self):
+        with self._lock:
+            self._touched = set()
+            known = dict(self._footprints)
+
+        footprints = {}
+        try:
+            for domain in get_running_domains():
+                uuid = domain.name()
+                if uuid in known:
+                    footprints[uuid] = known[uuid]
+                    continue
 
-    for i in ids:
-        vm = Vm.from_virt_domain(get_domain())
-        vms.append(vm)
-    return vms
+                try:
+                    footprints[uuid] = self._footprint_of_vm(Vm.from_virt_domain(domain))
+                except libvirt.libvirtError:
+                    # the vm stopped after being listed
+                    logger.warn(linux.get_exception_stacktrace())
+        finally:
+            with self._lock:
+                touched = self._touched
+                self._touched = None
+
+        with self._lock:
+            # events came during listing are newer than the listing
+            for uuid in touched:
+                footprints.pop(uuid, None)
+                if uuid in self._footprints:
+                    footprints[uuid] = self._footprints[uuid]
+
+            self._footprints = {}
+            self._used_cpu = 0
+            self._used_memory = 0
+            for uuid, footprint in footprints.items():
+                self._add(uuid, footprint)
+            self._unknown &= touched
+            self._seeded = True
+
+    def _resolve_unknown(self):
+        with self._lock:
+            unknown = list(self._unknown)
+
+        for uuid in unknown:
+            vm = get_vm_by_uuid(uuid, False)
+            with self._lock:
+                if uuid not in self._unknown:
+                    continue
+
+                self._unknown.discard(uuid)
+                if vm and vm.state == Vm.VM_STATE_RUNNING:
+                    self._add(uuid, self._footprint_of_vm(vm))
+
+    def get_used(self):
+        if not self._seeded:
+            self.reconcile()
+        self._resolve_unknown()
+
+        with self._lock:
+            return (self._used_cpu, self._used_memory)
+
+vm_capacity = VmCapacityAccountant()
 
 def get_cpu_memory_used_by_running_vms():
-    runnings = get_running_vms()
-    used_cpu = 0
-    used_memory = 0
-    for vm  in runnings:
-        used_cpu += (vm.get_cpu_num() * vm.get_cpu_speed())
-        used_memory += vm.get_memory()
-
-    return (used_cpu, used_memory)
+    return vm_capacity.get_used()
 
 class VmOperationJudger(object):
     def __init__(self, op):
@@ -671,8 +920,14 @@ class Vm(object):
     # letter 'c' is reserved for cdrom
     DEVICE_LETTERS = 'abdefghijklmnopqrstuvwxyz'
 
+    # seconds between checks of the domain state while waiting for its Started event
+    STARTED_EVENT_WAIT_SLICE = 0.5
+
     timeout_object = linux.TimeoutObject()
 
+    # see _get_static_elements()
+    _static_elements = None
+
     def __init__(self):
         self.uuid = None
         self.domain_xmlobject = None
@@ -722,19 +977,28 @@ class Vm(object):
         except:
             return False
 
-    def _wait_for_vm_running(self, timeout=60):
-        if not linux.wait_callback_success(self.wait_for_state_change, self.VM_STATE_RUNNING, interval=0.5, timeout=timeout):
+    def _wait_for_vm_running(self, timeout=60, started=None, wait_vnc=True):
+        if started:
+            # the Started event is lost if libvirt reconnects meanwhile, wait
+            # for it in short slices and check the state of the domain after each
+            deadline = time.time() + timeout
+            while not started.wait(self.STARTED_EVENT_WAIT_SLICE) and time.time() < deadline:
+                state, _ = self.domain.state(0)
+                if self.power_state.get(state) == self.VM_STATE_RUNNING:
+                    break
+            wait_timeout = max(deadline - time.time(), 0)
+        else:
+            wait_timeout = timeout
+
+        if not linux.wait_callback_success(self.wait_for_state_change, self.VM_STATE_RUNNING, interval=0.5, timeout=wait_timeout):
             raise kvmagent.KvmError('unable to start vm[uuid:%s, name:%s], vm state is not changing to '
                                     'running after %s seconds' % (self.uuid, self.get_name(), timeout))
 
-        vnc_port = self.get_console_port()
-
-        def wait_vnc_port_open(_):
-            cmd = shell.ShellCmd('netstat -na | grep ":%s" > /dev/null' % vnc_port)
-            cmd(is_exception=False)
-            return cmd.return_code == 0
+        if not wait_vnc:
+            return
 
-        if not linux.wait_callback_success(wait_vnc_port_open, None, interval=0.5, timeout=30):
+        vnc_port = self.get_console_port()
+        if sockstat.wait_ports_listening([vnc_port], timeout=30, interval=0.5):
             raise kvmagent.KvmError("unable to start vm[uuid:%s, name:%s]; its vnc port does"
                                     " not open after 30 seconds" % (self.uuid, self.get_name()))
 
@@ -753,7 +1017,11 @@ class Vm(object):
 
         self.start(cmd.timeout)
 
-    def start(self, timeout=60):
+    def start(self, timeout=60, wait_vnc=True):
+        '''
+        with wait_vnc False the caller checks the vnc port, see
+        VmPlugin.batch_start_vm()
+        '''
         #TODO: 1. enbale hair_pin mode
         logger.debug('creating vm:\n%s' % self.domain_xml)
 
@@ -763,8 +1031,13 @@ class Vm(object):
 
         domain = define_xml()
         self.domain = domain
-        self.domain.createWithFlags(0)
-        self._wait_for_vm_running(timeout)
+        uuid = domain.name()
+        started = VmLifecycleWaiter.expect(uuid, LibvirtEventManager.EVENT_STARTED)
+        try:
+            self.domain.createWithFlags(0)
+            self._wait_for_vm_running(timeout, started, wait_vnc)
+        finally:
+            VmLifecycleWaiter.cancel(uuid, LibvirtEventManager.EVENT_STARTED, started)
 
     def stop(self, graceful=True, timeout=5, undefine=True):
         def cleanup_addons():
@@ -773,13 +1046,15 @@ class Vm(object):
                     path = chan.source.path_
                     shell.call('rm -f %s' % path)
 
-        def loop_shutdown(_):
+        def loop_shutdown(stopped):
             try:
                 self.domain.shutdown()
             except:
                 #domain has been shut down
                 pass
 
+            # wake up on the Stopped event rather than at the next poll
+            stopped.wait(1)
             return self.wait_for_state_change(self.VM_STATE_SHUTDOWN)
 
         def iscsi_cleanup():
@@ -814,8 +1089,13 @@ class Vm(object):
 
         do_destroy = True
         if graceful:
-            if linux.wait_callback_success(loop_shutdown, None, timeout=60):
-                do_destroy = False
+            uuid = self.domain.name()
+            stopped = VmLifecycleWaiter.expect(uuid, LibvirtEventManager.EVENT_STOPPED)
+            try:
+                if linux.wait_callback_success(loop_shutdown, stopped, timeout=60, interval=0):
+                    do_destroy = False
+            finally:
+                VmLifecycleWaiter.cancel(uuid, LibvirtEventManager.EVENT_STOPPED, stopped)
 
         iscsi_cleanup()
 
@@ -1504,9 +1784,57 @@ class Vm(object):
 
         return vm
 
+    @staticmethod
+    def _get_static_elements():
+        '''
+        parts of the domain xml that are the same for every vm on this host.
+        They are built once and appended to each domain as they are, an
+        ElementTree element can have many parents as long as nobody changes it
+        '''
+        if Vm._static_elements:
+            return Vm._static_elements
+
+        static = {}
+        def element(tag, value=None, attrib={}):
+            el = etree.Element(tag, attrib)
+            if value:
+                el.text = value
+            return el
+
+        features = element('features')
+        for f in ['acpi', 'apic', 'pae']:
+            e(features, f)
+        static['features'] = [features]
+
+        static['devices'] = [
+            element('emulator', kvmagent.get_qemu_path()),
+            element('input', None, {'type':'tablet', 'bus':'usb'})
+        ]
+
+        static['meta'] = [
+            element('clock', None, {'offset':'utc'}),
+            element('on_poweroff', 'destroy'),
+            element('on_crash', 'restart'),
+            element('on_reboot', 'restart')
+        ]
+
+        b = element('memballoon', None, {'model':'virtio'})
+        e(b, 'stats', None, {'period':'10'})
+        static['balloon'] = [b]
+
+        serial = element('serial', None, {'type':'pty'})
+        e(serial, 'target', None, {'port':'0'})
+        console = element('console', None, {'type':'pty'})
+        e(console, 'target', None, {'type':'serial', 'port':'0'})
+        static['console'] = [serial, console]
+
+        Vm._static_elements = static
+        return static
+
     @staticmethod
     def from_StartVmCmd(cmd):
         use_virtio = cmd.useVirtio
+        static = Vm._get_static_elements()
 
         elements = {}
         def make_root():
@@ -1549,15 +1877,12 @@ class Vm(object):
 
         def make_features():
             root = elements['root']
-            features = e(root, 'features')
-            for f in ['acpi', 'apic', 'pae']:
-                e(features, f)
+            root.extend(static['features'])
 
         def make_devices():
             root = elements['root']
             devices = e(root, 'devices')
-            e(devices, 'emulator', kvmagent.get_qemu_path())
-            e(devices, 'input', None, {'type':'tablet', 'bus':'usb'})
+            devices.extend(static['devices'])
             elements['devices'] = devices
 
         def make_cdrom():
@@ -1760,10 +2085,7 @@ class Vm(object):
             e(root, 'name', cmd.vmInstanceUuid)
             e(root, 'uuid', uuidhelper.to_full_uuid(cmd.vmInstanceUuid))
             e(root, 'description', cmd.vmName)
-            e(root, 'clock', None, {'offset':'utc'})
-            e(root, 'on_poweroff', 'destroy')
-            e(root, 'on_crash', 'restart')
-            e(root, 'on_reboot', 'restart')
+            root.extend(static['meta'])
             meta = e(root, 'metadata')
             e(meta, 'zstack', 'True')
             e(meta, 'internalId', str(cmd.vmInternalId))
@@ -1800,15 +2122,11 @@ class Vm(object):
 
         def make_balloon_memory():
             devices = elements['devices']
-            b = e(devices, 'memballoon', None, {'model':'virtio'})
-            e(b, 'stats', None, {'period':'10'})
+            devices.extend(static['balloon'])
 
         def make_console():
             devices = elements['devices']
-            serial = e(devices, 'serial', None, {'type':'pty'})
-            e(serial, 'target', None, {'port':'0'})
-            console = e(devices, 'console', None, {'type':'pty'})
-            e(console, 'target', None, {'type':'serial', 'port':'0'})
+            devices.extend(static['console'])
 
 
         make_root()
@@ -1827,12 +2145,12 @@ class Vm(object):
         make_console()
 
         root = elements['root']
-        xml = etree.tostring(root)
 
         vm = Vm()
         vm.uuid = cmd.vmInstanceUuid
-        vm.domain_xml = xml
-        vm.domain_xmlobject = xmlobject.loads(xml)
+        vm.domain_xml = etree.tostring(root)
+        # no need to parse the xml just serialized
+        vm.domain_xmlobject = xmlobject.loads_from_element(root)
         return vm
 
 class VmPlugin(kvmagent.KvmAgent):
@@ -1855,6 +2173,9 @@ class VmPlugin(kvmagent.KvmAgent):
     KVM_ATTACH_ISO_PATH = "/vm/iso/attach"
     KVM_DETACH_ISO_PATH = "/vm/iso/detach"
     KVM_VM_CHECK_STATE = "/vm/checkstate"
+    KVM_BATCH_START_VM_PATH = "/vm/batchstart"
+    KVM_BATCH_STOP_VM_PATH = "/vm/batchstop"
+    KVM_BATCH_DESTROY_VM_PATH = "/vm/batchdestroy"
 
     VM_OP_START = "start"
     VM_OP_STOP = "stop"
@@ -1862,9 +2183,20 @@ class VmPlugin(kvmagent.KvmAgent):
     VM_OP_MIGRATE = "migrate"
     VM_OP_DESTROY = "destroy"
 
+    # migrations beyond this are queued by the http server instead of
+    # competing for the bandwidth of the host
+    MAX_CONCURRENT_MIGRATIONS = 4
+
     timeout_object = linux.TimeoutObject()
     queue = Queue.Queue()
 
+    # answers vmsync/checkvmstate without asking libvirt
+    vm_states = VmStateTable()
+    VM_STATE_RECONCILE_INTERVAL = 60
+
+    # vms of batch start/stop/destroy operated on at the same time
+    BATCH_VM_OPERATION_CONCURRENCY = 10
+
     def _record_operation(self, uuid, op):
         j = VmOperationJudger(op)
         self.timeout_object.put(uuid, j, 300)
@@ -1878,7 +2210,7 @@ class VmPlugin(kvmagent.KvmAgent):
             return None
         return o[0]
 
-    def _start_vm(self, cmd):
+    def _start_vm(self, cmd, wait_vnc=True):
         try:
             vm = get_vm_by_uuid(cmd.vmInstanceUuid)
         except kvmagent.KvmError:
@@ -1892,7 +2224,8 @@ class VmPlugin(kvmagent.KvmAgent):
                     vm.destroy()
 
             vm = Vm.from_StartVmCmd(cmd)
-            vm.start(cmd.timeout)
+            vm.start(cmd.timeout, wait_vnc)
+            return vm
         except libvirt.libvirtError as e:
             logger.warn(linux.get_exception_stacktrace())
             raise kvmagent.KvmError('unable to start vm[uuid:%s, name:%s], libvirt error: %s' % (cmd.vmInstanceUuid, cmd.vmName, str(e)))
@@ -1948,23 +2281,34 @@ class VmPlugin(kvmagent.KvmAgent):
     @kvmagent.replyerror
     def start_vm(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
+        return jsonobject.dumps(self._handle_start_vm(cmd))
+
+    def _handle_start_vm(self, cmd, vnc_ports=None):
+        '''
+        if vnc_ports is a dict, the vnc port is not waited for but put in it by
+        vm uuid
+        '''
         rsp = StartVmResponse()
         try:
             self._record_operation(cmd.vmInstanceUuid, self.VM_OP_START)
 
-            self._start_vm(cmd)
+            vm = self._start_vm(cmd, wait_vnc=vnc_ports is None)
+            if vnc_ports is not None:
+                vnc_ports[cmd.vmInstanceUuid] = vm.get_console_port()
+            self.vm_states.set_running(cmd.vmInstanceUuid)
+            vm_capacity.vm_started(cmd.vmInstanceUuid, cmd)
             logger.debug('successfully started vm[uuid:%s, name:%s]' % (cmd.vmInstanceUuid, cmd.vmName))
         except kvmagent.KvmError as e:
             logger.warn(linux.get_exception_stacktrace())
             rsp.error = str(e)
             rsp.success = False
 
-        return jsonobject.dumps(rsp)
+        return rsp
 
     @kvmagent.replyerror
     def check_vm_state(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        states = get_all_vm_states()
+        states = self.vm_states.get_states()
         rsp = CheckVmStateRsp()
         for uuid in cmd.vmUuids:
             s = states.get(uuid)
@@ -1977,7 +2321,7 @@ class VmPlugin(kvmagent.KvmAgent):
     def vm_sync(self, req):
         rsp = VmSyncResponse()
         try:
-            rsp.states = get_all_vm_states()
+            rsp.states = self.vm_states.get_states()
         except kvmagent.KvmError as e:
             logger.warn(linux.get_exception_stacktrace())
             rsp.error = str(e)
@@ -2014,18 +2358,23 @@ class VmPlugin(kvmagent.KvmAgent):
     @kvmagent.replyerror
     def stop_vm(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
+        return jsonobject.dumps(self._handle_stop_vm(cmd))
+
+    def _handle_stop_vm(self, cmd):
         rsp = StopVmResponse()
         try:
             self._record_operation(cmd.uuid, self.VM_OP_STOP)
 
             self._stop_vm(cmd)
+            self.vm_states.set_stopped(cmd.uuid)
+            vm_capacity.vm_stopped(cmd.uuid)
             logger.debug("successfully stopped vm[uuid:%s]" % cmd.uuid)
         except kvmagent.KvmError as e:
             logger.warn(linux.get_exception_stacktrace())
             rsp.error = str(e)
             rsp.success = False
 
-        return jsonobject.dumps(rsp)
+        return rsp
 
     @kvmagent.replyerror
     def reboot_vm(self, req):
@@ -2047,6 +2396,9 @@ class VmPlugin(kvmagent.KvmAgent):
     @kvmagent.replyerror
     def destroy_vm(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
+        return jsonobject.dumps(self._handle_destroy_vm(cmd))
+
+    def _handle_destroy_vm(self, cmd):
         rsp = DestroyVmResponse()
         try:
             self._record_operation(cmd.uuid, self.VM_OP_DESTROY)
@@ -2055,13 +2407,109 @@ class VmPlugin(kvmagent.KvmAgent):
             if vm:
                 vm.destroy()
                 logger.debug('successfully destroyed vm[uuid:%s]' % cmd.uuid)
+            self.vm_states.set_stopped(cmd.uuid)
+            vm_capacity.vm_stopped(cmd.uuid)
         except kvmagent.KvmError as e:
             logger.warn(linux.get_exception_stacktrace())
             rsp.error = str(e)
             rsp.success = False
 
+        return rsp
+
+    def _run_batch(self, req, handle, get_vm_uuid, finish=None):
+        '''
+        finish(cmds, rsps), if given, is called once every vm is handled and
+        may fail some of them, the callback of each vm is posted after it
+        '''
+        cmd = jsonobject.loads(req[http.REQUEST_BODY])
+        cmds = cmd.cmds if cmd.cmds else []
+        http_server = kvmagent.get_http_server()
+        callback_uri = req[http.REQUEST_HEADER].get(http.CALLBACK_URI, http_server.async_callback_uri)
+
+        rsps = [None] * len(cmds)
+        handled = [False] * len(cmds)
+        remaining = [len(cmds)]
+        cond = threading.Condition()
+
+        def post_callback(c, r):
+            if c.taskUuid and callback_uri:
+                try:
+                    http_server.post_callback(callback_uri, jsonobject.dumps(r), {http.TASK_UUID: c.taskUuid})
+                except:
+                    logger.warn(linux.get_exception_stacktrace())
+
+        def done(index, r):
+            rsps[index] = r
+            with cond:
+                remaining[0] -= 1
+                cond.notify_all()
+
+        def run(index, c):
+            try:
+                r = handle(c)
+            except Exception as e:
+                logger.warn(linux.get_exception_stacktrace())
+                r = kvmagent.AgentResponse()
+                r.success = False
+                r.error = str(e)
+
+            handled[index] = True
+            # let the caller track each vm without waiting for the whole batch
+            if not finish:
+                post_callback(c, r)
+
+            done(index, r)
+
+        for i, c in enumerate(cmds):
+            try:
+                self.batch_pool.submit(run, i, c)
+            except thread.ThreadPoolFullError as e:
+                r = kvmagent.AgentResponse()
+                r.success = False
+                r.error = str(e)
+                done(i, r)
+
+        with cond:
+            while remaining[0] > 0:
+                cond.wait()
+
+        if finish:
+            finish(cmds, rsps)
+            for i, c in enumerate(cmds):
+                if handled[i]:
+                    post_callback(c, rsps[i])
+
+        rsp = BatchVmResponse()
+        rsp.results = [{'vmUuid': get_vm_uuid(c), 'success': r.success, 'error': r.error} for c, r in zip(cmds, rsps)]
         return jsonobject.dumps(rsp)
 
+    @kvmagent.replyerror
+    def batch_start_vm(self, req):
+        # the vnc ports of all vms are waited for at once, rather than each vm
+        # reading the socket tables on its own
+        vnc_ports = {}
+
+        def wait_vnc_ports(cmds, rsps):
+            if not vnc_ports:
+                return
+
+            pending = sockstat.wait_ports_listening(vnc_ports.values(), timeout=30, interval=0.5)
+            for c, r in zip(cmds, rsps):
+                port = vnc_ports.get(c.vmInstanceUuid)
+                if port is not None and int(port) in pending:
+                    r.success = False
+                    r.error = 'unable to start vm[uuid:%s, name:%s]; its vnc port does not open after 30 seconds' % (c.vmInstanceUuid, c.vmName)
+
+        return self._run_batch(req, lambda c: self._handle_start_vm(c, vnc_ports), lambda c: c.vmInstanceUuid, wait_vnc_ports)
+
+    @kvmagent.replyerror
+    def batch_stop_vm(self, req):
+        return self._run_batch(req, self._handle_stop_vm, lambda c: c.uuid)
+
+    @kvmagent.replyerror
+    def batch_destroy_vm(self, req):
+        return self._run_batch(req, self._handle_destroy_vm, lambda c: c.uuid)
+
     @kvmagent.replyerror
     def attach_data_volume(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
@@ -2251,7 +2699,7 @@ class VmPlugin(kvmagent.KvmAgent):
         http_server.register_async_uri(self.KVM_DETACH_VOLUME, self.detach_data_volume)
         http_server.register_async_uri(self.KVM_ATTACH_ISO_PATH, self.attach_iso)
         http_server.register_async_uri(self.KVM_DETACH_ISO_PATH, self.detach_iso)
-        http_server.register_async_uri(self.KVM_MIGRATE_VM_PATH, self.migrate_vm)
+        http_server.register_async_uri(self.KVM_MIGRATE_VM_PATH, self.migrate_vm, concurrency=self.MAX_CONCURRENT_MIGRATIONS)
         http_server.register_async_uri(self.KVM_TAKE_VOLUME_SNAPSHOT_PATH, self.take_volume_snapshot)
         http_server.register_async_uri(self.KVM_MERGE_SNAPSHOT_PATH, self.merge_snapshot_to_volume)
         http_server.register_async_uri(self.KVM_LOGOUT_ISCSI_TARGET_PATH, self.logout_iscsi_target)
@@ -2260,9 +2708,21 @@ class VmPlugin(kvmagent.KvmAgent):
         http_server.register_async_uri(self.KVM_DETACH_NIC_PATH, self.detach_nic)
         http_server.register_async_uri(self.KVM_CREATE_SECRET, self.create_ceph_secret_key)
         http_server.register_async_uri(self.KVM_VM_CHECK_STATE, self.check_vm_state)
+        http_server.register_async_uri(self.KVM_BATCH_START_VM_PATH, self.batch_start_vm)
+        http_server.register_async_uri(self.KVM_BATCH_STOP_VM_PATH, self.batch_stop_vm)
+        http_server.register_async_uri(self.KVM_BATCH_DESTROY_VM_PATH, self.batch_destroy_vm)
+
+        self.batch_pool = thread.ThreadPool(self.BATCH_VM_OPERATION_CONCURRENCY, name='vm-batch')
 
         self.register_libvirt_event()
 
+        def reconcile_vm_states():
+            self.vm_states.reconcile()
+            vm_capacity.reconcile()
+            return True
+
+        thread.timer(self.VM_STATE_RECONCILE_INTERVAL, reconcile_vm_states, stop_on_exception=False).start()
+
         @thread.AsyncThread
         def wait_end_signal():
             while True:
@@ -2411,7 +2871,18 @@ class VmPlugin(kvmagent.KvmAgent):
             content = traceback.format_exc()
             logger.warn(content)
 
+    def _update_vm_state_table(self, conn, dom, event, detail, opaque):
+        evstr = LibvirtEventManager.event_to_string(event)
+        VmLifecycleWaiter.notify(dom.name(), evstr)
+        if evstr == LibvirtEventManager.EVENT_STARTED:
+            self.vm_states.set_running(dom.name())
+            vm_capacity.vm_started(dom.name())
+        elif evstr == LibvirtEventManager.EVENT_STOPPED:
+            self.vm_states.set_stopped(dom.name())
+            vm_capacity.vm_stopped(dom.name())
+
     def register_libvirt_event(self):
+        LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._update_vm_state_table)
         LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._vm_lifecycle_event)
         LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._set_vnc_port_iptable_rule)
         LibvirtAutoReconnect.add_libvirt_callback(libvirt.VIR_DOMAIN_EVENT_ID_REBOOT, self._vm_reboot_event)
@@ -0,0 +1,217 @@
+'''
+rules and ipsets the security group plugin makes of ruleTOs, applied to a
+kernel faked from a canned iptables-save
+'''
+import collections
+import hashlib
+import re
+import unittest
+from kvmagent.plugins import securitygroup_plugin
+from zstacklib.utils import ipset
+from zstacklib.utils import iptables
+from zstacklib.utils import jsonobject
+from zstacklib.utils import shell
+
+SAVE = '''# Generated by iptables-save v1.4.21
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A INPUT -p tcp -m tcp --dport 7070 -j ACCEPT
+COMMIT
+'''
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.kernel = SAVE
+        self.restored = []
+        self.ipsets = []
+        self._call = shell.call
+        self._get_table_digests = iptables._get_table_digests
+        self._get_all_ethernet_device_names = securitygroup_plugin.linux.get_all_ethernet_device_names
+        shell.call = self._shell_call
+        iptables._get_table_digests = self._table_digests
+        securitygroup_plugin.linux.get_all_ethernet_device_names = lambda: ['vnic1.0', 'vnic2.0']
+        iptables._cache.invalidate()
+
+        self.plugin = securitygroup_plugin.SecurityGroupPlugin()
+        self.plugin.use_ipset = True
+
+    def tearDown(self):
+        shell.call = self._call
+        iptables._get_table_digests = self._get_table_digests
+        securitygroup_plugin.linux.get_all_ethernet_device_names = self._get_all_ethernet_device_names
+        iptables._cache.invalidate()
+
+    def _shell_call(self, cmd):
+        if cmd.startswith('/sbin/iptables-save'):
+            return self.kernel
+        if cmd.startswith('/sbin/iptables-restore'):
+            with open(cmd.split('<')[1].strip(), 'r') as fd:
+                content = fd.read()
+            self.restored.append(content)
+            self._restore(content, '--noflush' in cmd)
+        elif cmd.startswith('ipset restore'):
+            with open(cmd.split('<')[1].strip(), 'r') as fd:
+                self.ipsets.append(fd.read())
+        return ''
+
+    def _tables(self, content, tables):
+        table = None
+        for l in content.split('\n'):
+            if l.startswith('*'):
+                table = tables.setdefault(l[1:], collections.OrderedDict())
+            elif l.startswith(':'):
+                # declaring a chain flushes it
+                name, policy = l[1:].split()[:2]
+                table[name] = (policy, [])
+            elif l.startswith('-F '):
+                table[l.split()[1]][1][:] = []
+            elif l.startswith('-X '):
+                del table[l.split()[1]]
+            elif l.startswith('-A '):
+                # iptables-save prints rules in its own way
+                l = re.sub(r'--dport (\d+):\1 ', r'--dport \1 ', ' '.join(l.split()))
+                table[l.split()[1]][1].append(l)
+        return tables
+
+    def _restore(self, content, noflush):
+        tables = self._tables(content, self._tables(self.kernel, collections.OrderedDict()) if noflush else collections.OrderedDict())
+        lst = []
+        for table_name, chains in tables.items():
+            lst.append('*%s' % table_name)
+            lst.extend([':%s %s [0:0]' % (name, policy) for name, (policy, _) in chains.items()])
+            for _, rules in chains.values():
+                lst.extend(rules)
+            lst.append('COMMIT')
+        lst.append('')
+        self.kernel = '\n'.join(lst)
+
+    def _table_digests(self, table_names):
+        tables = self._tables(self.kernel, collections.OrderedDict())
+        ret = {}
+        for name in table_names:
+            chains = tables.get(name)
+            ret[name] = chains and dict([(c, hashlib.md5('\n'.join(rules)).hexdigest()) for c, (_, rules) in chains.items()])
+        return ret
+
+    def _chain(self, chain_name):
+        return self._tables(self.kernel, collections.OrderedDict())['filter'].get(chain_name, (None, None))[1]
+
+    def _sto(self, nic_name, ips, security_group_uuid=None, action_code='applyRule'):
+        rule = {'type': 'Ingress', 'protocol': 'TCP', 'startPort': 22, 'endPort': 22,
+                'allowedCidr': '192.168.1.0/24', 'allowedInternalIpRange': ips}
+        if security_group_uuid:
+            rule['securityGroupUuid'] = security_group_uuid
+        return jsonobject.loads(jsonobject.dumps({
+            'vmNicInternalName': nic_name, 'vmNicIp': '10.0.0.2', 'vmNicMac': 'fa:16:3e:00:00:01',
+            'actionCode': action_code, 'ingressDefaultPolicy': 'deny', 'egressDefaultPolicy': 'accept',
+            'rules': [rule]}))
+
+    def _set_name(self, sto):
+        return self.plugin._make_ipset_name(sto, sto.rules[0])
+
+    def test_ipset_rules(self):
+        sto1 = self._sto('vnic1.0', ['10.0.0.5', '10.0.0.6-10.0.0.8'])
+        sto2 = self._sto('vnic2.0', ['10.0.0.9'])
+        self.plugin._apply_rules([sto1, sto2])
+
+        set1 = self._set_name(sto1)
+        set2 = self._set_name(sto2)
+        self.assertNotEqual(set1, set2)
+        self.assertTrue(set1.startswith(self.plugin.IPSET_NAME_PREFIX))
+        self.assertTrue(len(set1) <= ipset.MAX_SET_NAME_LEN)
+
+        self.assertEqual(1, len(self.restored))
+        self.assertIn('-A vnic1.0-in -p tcp -m tcp --dport 22 -m state --state NEW -m set --match-set %s src -j RETURN' % set1, self.kernel)
+        self.assertIn('-A vnic2.0-in -p tcp -m tcp --dport 22 -m state --state NEW -m set --match-set %s src -j RETURN' % set2, self.kernel)
+        self.assertNotIn('iprange', self.kernel)
+
+        self.assertEqual(1, len(self.ipsets))
+        self.assertIn('add %s-tmp 10.0.0.5 -exist' % set1, self.ipsets[0])
+        self.assertIn('add %s-tmp 10.0.0.6-10.0.0.8 -exist' % set1, self.ipsets[0])
+        self.assertIn('swap %s-tmp %s' % (set1, set1), self.ipsets[0])
+        self.assertIn('add %s-tmp 10.0.0.9 -exist' % set2, self.ipsets[0])
+
+    def test_ipset_of_security_group(self):
+        sg_uuid = 'f7a8c0e5b1a54bd39b5e4a2c3d1e0f98'
+        sto1 = self._sto('vnic1.0', ['10.0.0.5'], sg_uuid)
+        sto2 = self._sto('vnic2.0', ['10.0.0.9'], sg_uuid)
+        self.plugin._apply_rules([sto1, sto2])
+
+        set_name = (self.plugin.IPSET_NAME_PREFIX + sg_uuid)[:ipset.MAX_SET_NAME_LEN]
+        self.assertEqual(set_name, self._set_name(sto1))
+        self.assertEqual(set_name, self._set_name(sto2))
+        self.assertEqual(1, self.ipsets[0].count('create %s hash:net -exist' % set_name))
+
+    def test_members_changed(self):
+        sto = self._sto('vnic1.0', ['10.0.0.5'])
+        self.plugin._apply_rules([sto])
+        self.plugin._apply_rules([self._sto('vnic1.0', ['10.0.0.5', '10.0.0.6'])])
+
+        # only the set is synced
+        self.assertEqual(1, len(self.restored))
+        self.assertEqual(2, len(self.ipsets))
+        self.assertIn('add %s-tmp 10.0.0.6 -exist' % self._set_name(sto), self.ipsets[1])
+
+    def test_unchanged_vnics_skipped(self):
+        self.plugin._apply_rules([self._sto('vnic1.0', ['10.0.0.5']), self._sto('vnic2.0', ['10.0.0.9'])])
+        # another chain is changed by others, the model is parsed again
+        self.kernel = self.kernel.replace('--dport 7070 -j ACCEPT', '--dport 7070 -j ACCEPT\n-A INPUT -p tcp -m tcp --dport 5900 -j ACCEPT')
+        self.plugin._apply_rules([self._sto('vnic1.0', ['10.0.0.5']), self._sto('vnic2.0', ['10.0.0.9'])])
+        self.plugin._refresh_rules_on_host([self._sto('vnic1.0', ['10.0.0.5']), self._sto('vnic2.0', ['10.0.0.9'])])
+        self.assertEqual(1, len(self.restored))
+
+    def test_changed_vnic_chain_rebuilt(self):
+        sto = self._sto('vnic1.0', ['10.0.0.5'])
+        self.plugin._apply_rules([sto])
+        rules = self._chain('vnic1.0-in')
+
+        # the same number of rules but one is changed
+        self.kernel = self.kernel.replace('--dport 22 -m state --state NEW -s 192.168.1.0/24', '--dport 23 -m state --state NEW -s 192.168.1.0/24')
+        self.plugin._apply_rules([sto])
+        self.assertEqual(2, len(self.restored))
+        self.assertEqual(rules, self._chain('vnic1.0-in'))
+
+    def test_reordered_vnic_chain_rebuilt(self):
+        sto = self._sto('vnic1.0', ['10.0.0.5'])
+        self.plugin._apply_rules([sto])
+        rules = self._chain('vnic1.0-in')
+
+        self.kernel = self.kernel.replace('\n'.join(rules), '\n'.join([rules[1], rules[0]] + rules[2:]))
+        self.plugin._refresh_rules_on_host([sto])
+        self.assertEqual(2, len(self.restored))
+        self.assertEqual(rules, self._chain('vnic1.0-in'))
+
+    def test_default_chain_rebuilt(self):
+        stos = [self._sto('vnic1.0', ['10.0.0.5']), self._sto('vnic2.0', ['10.0.0.9'])]
+        self.plugin._refresh_rules_on_host(stos)
+        rules = self._chain('sg-default')
+        self.assertEqual('-A sg-default -j ACCEPT', rules[-1])
+
+        self.kernel = self.kernel.replace('\n'.join(rules), '\n'.join([rules[1], rules[0]] + rules[2:]))
+        self.plugin._refresh_rules_on_host(stos)
+        self.assertEqual(2, len(self.restored))
+        self.assertEqual(rules, self._chain('sg-default'))
+
+        self.plugin._refresh_rules_on_host(stos)
+        self.assertEqual(2, len(self.restored))
+
+    def test_coalesced_apply(self):
+        sto1 = self._sto('vnic1.0', ['10.0.0.5'])
+        self.plugin._apply_coalesced_rules([[sto1], [self._sto('vnic1.0', ['10.0.0.6']), self._sto('vnic2.0', ['10.0.0.9'])]])
+
+        self.assertEqual(1, len(self.restored))
+        self.assertIn('vnic2.0-in', self.kernel)
+        # the last ruleTO of a vnic wins
+        self.assertIn('add %s-tmp 10.0.0.6 -exist' % self._set_name(sto1), self.ipsets[0])
+        self.assertNotIn('10.0.0.5', self.ipsets[0])
+
+    def test_delete_chain(self):
+        self.plugin._apply_rules([self._sto('vnic1.0', ['10.0.0.5']), self._sto('vnic2.0', ['10.0.0.9'])])
+        self.plugin._apply_rules([self._sto('vnic1.0', None, action_code='deleteChain')])
+        self.assertNotIn('vnic1.0', self.kernel)
+        self.assertIn('vnic2.0-in', self.kernel)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import json
+import unittest
+
+from virtualrouter.plugins import eip
+from zstacklib.utils import http
+from zstacklib.utils import iptables
+from zstacklib.utils import jsonobject
+
+SAVE = '''*nat
+:PREROUTING ACCEPT [0:0]
+:INPUT ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+COMMIT
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+COMMIT
+'''
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.kernel = SAVE
+        self.restored = []
+        self._call = iptables.shell.call
+        self._get_table_digests = iptables._get_table_digests
+        self._linux = (eip.linux.get_nic_name_by_mac, eip.linux.get_nic_name_by_ip, eip.linux.get_ip_by_nic_name)
+        iptables.shell.call = self._shell_call
+        iptables._get_table_digests = lambda table_names: None
+        eip.linux.get_nic_name_by_mac = lambda mac: {'52:54:00:00:00:02': 'eth1'}.get(mac)
+        eip.linux.get_nic_name_by_ip = lambda ip: 'eth0' if ip.startswith('192.168.0.') else None
+        eip.linux.get_ip_by_nic_name = lambda nic: '10.0.0.1'
+        self.agent = eip.Eip()
+
+    def tearDown(self):
+        iptables.shell.call = self._call
+        iptables._get_table_digests = self._get_table_digests
+        eip.linux.get_nic_name_by_mac, eip.linux.get_nic_name_by_ip, eip.linux.get_ip_by_nic_name = self._linux
+
+    def _shell_call(self, cmd):
+        if cmd.startswith('/sbin/iptables-save'):
+            return self.kernel
+        self.restored.append(cmd)
+        return ''
+
+    def _eip(self, vip, guest_ip, mac='52:54:00:00:00:02'):
+        return {'vipIp': vip, 'guestIp': guest_ip, 'privateMac': mac, 'snatInboundTraffic': False}
+
+    def _request(self, f, eips):
+        return json.loads(f({http.REQUEST_BODY: jsonobject.dumps({'eips': eips})}))
+
+    def test_create_eips(self):
+        rsp = self._request(self.agent.create_eips, [self._eip('192.168.0.10', '10.0.0.2')])
+        self.assertTrue(rsp['success'])
+        self.assertEqual([{'vipIp': '192.168.0.10', 'guestIp': '10.0.0.2'}], rsp['createdEips'])
+        self.assertNotIn('failedEips', rsp)
+        self.assertEqual(1, len(self.restored))
+
+    def test_partial_failure(self):
+        eips = [self._eip('192.168.0.10', '10.0.0.2'), self._eip('172.16.0.10', '10.0.0.3')]
+        for f in (self.agent.create_eips, self.agent.sync_eip):
+            rsp = self._request(f, eips)
+            self.assertFalse(rsp['success'])
+            self.assertEqual([{'vipIp': '192.168.0.10', 'guestIp': '10.0.0.2'}], rsp['createdEips'])
+            self.assertEqual(['172.16.0.10'], [e['vipIp'] for e in rsp['failedEips']])
+        self.assertEqual(2, len(self.restored))
+
+    def test_all_failed(self):
+        rsp = self._request(self.agent.create_eips, [self._eip('192.168.0.10', '10.0.0.2', mac='52:54:00:00:00:03')])
+        self.assertFalse(rsp['success'])
+        self.assertEqual([], rsp['createdEips'])
+        self.assertEqual(0, len(self.restored))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,247 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from virtualrouter import virtualrouter
+from virtualrouter.plugins import lb
+from zstacklib.utils import jsonobject
+from zstacklib.utils import lock
+
+LEGACY_CONF = '''global
+    maxconn 1000
+    log 127.0.0.1 local1
+    user haproxy
+    group haproxy
+    daemon
+
+listen %s
+    mode tcp
+    timeout client 60s
+    timeout server 60s
+    timeout connect 60s
+    balance roundrobin
+    bind 192.168.0.10:%s
+    server nic-10.0.0.2 10.0.0.2:%s check port %s inter 5s rise 2 fall 2
+'''
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.procs = []
+        self.calls = []
+        self._call = lb.shell.call
+        lb.shell.call = self._shell_call
+
+        self.haproxy = lb.HaproxyManager()
+        self.haproxy.CONF_DIR = os.path.join(self.dir, 'etc')
+        self.haproxy.RUN_DIR = os.path.join(self.dir, 'run')
+        self.haproxy.BATCH_WINDOW = 0.2
+        os.makedirs(self.haproxy.CONF_DIR)
+        os.makedirs(self.haproxy.RUN_DIR)
+
+    def tearDown(self):
+        lb.shell.call = self._call
+        for p in self.procs:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        shutil.rmtree(self.dir)
+
+    def _shell_call(self, cmd):
+        self.calls.append(cmd)
+        if cmd == 'haproxy -v':
+            return 'HA-Proxy version 1.8.8 2018/04/19'
+        if cmd.startswith('haproxy -c'):
+            with open(cmd.split()[-1], 'r') as fd:
+                if 'bad-option' in fd.read():
+                    raise Exception('invalid config')
+        if cmd.startswith('haproxy -D'):
+            time.sleep(0.05)
+        if cmd.startswith('/sbin/iptables-save'):
+            return '*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n:OUTPUT ACCEPT [0:0]\nCOMMIT\n'
+        return ''
+
+    def _reloads(self, lb_uuid):
+        return [c for c in self.calls if c.startswith('haproxy -D') and self.haproxy._make_conf_file_path(lb_uuid) in c]
+
+    def _listener(self, lb_uuid, listener_uuid, port, algorithm='roundrobin'):
+        to = jsonobject.loads(jsonobject.dumps({'lbUuid': lb_uuid, 'listenerUuid': listener_uuid}))
+        context = {
+            'listenerUuid': listener_uuid,
+            'mode': 'tcp',
+            'maxConnection': 2000,
+            'connectionIdleTimeout': 60,
+            'balancerAlgorithm': algorithm,
+            'vip': '192.168.0.10',
+            'loadBalancerPort': port,
+            'nicIps': ['10.0.0.2'],
+            'checkPort': port,
+            'healthCheckInterval': 5,
+            'healthyThreshold': 2,
+            'unhealthyThreshold': 2,
+        }
+        return to, context
+
+    def _spawn(self, pid_file):
+        # a process having the pid file in its cmdline, like a legacy haproxy
+        p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)', pid_file])
+        self.procs.append(p)
+        for i in range(100):
+            with open('/proc/%s/cmdline' % p.pid, 'r') as fd:
+                if pid_file in fd.read():
+                    break
+            time.sleep(0.01)
+        with open(pid_file, 'w') as fd:
+            fd.write('%s\n' % p.pid)
+        return p
+
+    def test_reload(self):
+        self.haproxy.set_listener(*self._listener('lb1', 'l1', 80))
+        self.haproxy.set_listener(*self._listener('lb1', 'l2', 443))
+        self.assertEqual({}, self.haproxy.reload(['lb1']))
+
+        self.assertEqual(1, len(self._reloads('lb1')))
+        with open(self.haproxy._make_conf_file_path('lb1'), 'r') as fd:
+            conf = fd.read()
+        self.assertIn('listen l1', conf)
+        self.assertIn('listen l2', conf)
+        self.assertIn('maxconn 4000', conf)
+        self.assertIn('expose-fd listeners', conf)
+
+    def test_concurrent_reloads_coalesced(self):
+        self.haproxy.set_listener(*self._listener('lb1', 'l1', 80))
+        self.haproxy.set_listener(*self._listener('lb2', 'l2', 80))
+
+        errors = []
+        def reload(lb_uuids):
+            errors.append(self.haproxy.reload(lb_uuids))
+
+        threads = [threading.Thread(target=reload, args=(uuids,)) for uuids in (['lb1'], ['lb2'], ['lb1', 'lb2'])]
+        for t in threads:
+            t.start()
+            time.sleep(0.02)
+        for t in threads:
+            t.join()
+
+        self.assertEqual([{}, {}, {}], errors)
+        self.assertEqual(1, len(self._reloads('lb1')))
+        self.assertEqual(1, len(self._reloads('lb2')))
+
+    def test_request_during_reload_not_lost(self):
+        self.haproxy.set_listener(*self._listener('lb1', 'l1', 80))
+        t = threading.Thread(target=self.haproxy.reload, args=(['lb1'],))
+        t.start()
+        # after the batch window of the first reload is closed
+        time.sleep(self.haproxy.BATCH_WINDOW + 0.02)
+        self.haproxy.set_listener(*self._listener('lb1', 'l1', 80, 'leastconn'))
+        self.assertEqual({}, self.haproxy.reload(['lb1']))
+        t.join()
+
+        self.assertEqual(2, len(self._reloads('lb1')))
+        with open(self.haproxy._make_conf_file_path('lb1'), 'r') as fd:
+            self.assertIn('balance leastconn', fd.read())
+
+    def test_errors_per_lb(self):
+        self.haproxy.set_listener(*self._listener('lb1', 'l1', 80, 'bad-option'))
+        self.haproxy.set_listener(*self._listener('lb2', 'l2', 80))
+
+        errors = self.haproxy.reload(['lb1', 'lb2'])
+        self.assertEqual(['lb1'], errors.keys())
+        self.assertEqual(0, len(self._reloads('lb1')))
+        self.assertEqual(1, len(self._reloads('lb2')))
+
+        # the error is kept until the load balancer reloads
+        self.assertEqual(['lb1'], self.haproxy.reload(['lb1']).keys())
+        to, context = self._listener('lb1', 'l1', 80)
+        self.haproxy.set_listener(to, context)
+        self.assertEqual({}, self.haproxy.reload(['lb1']))
+
+    def test_restore_listener(self):
+        to, context = self._listener('lb1', 'l1', 80)
+        old, new = self.haproxy.set_listener(to, context)
+        self.assertIsNone(old)
+
+        old, new = self.haproxy.set_listener(*self._listener('lb1', 'l1', 80, 'bad-option'))
+        self.assertIn('balance roundrobin', old)
+        self.assertTrue(self.haproxy.restore_listener(to, old, new))
+        self.assertEqual(old, self.haproxy._read_listener('lb1', 'l1'))
+
+        # changed by someone else since
+        self.assertFalse(self.haproxy.restore_listener(to, None, new))
+        self.assertEqual(old, self.haproxy._read_listener('lb1', 'l1'))
+
+    def test_rollback_on_failed_reload(self):
+        agent = lb.Lb()
+        agent.haproxy = self.haproxy
+        def listener_to(algorithm):
+            return jsonobject.loads(jsonobject.dumps({
+                'lbUuid': 'lb1', 'listenerUuid': 'l1', 'vip': '192.168.0.10', 'loadBalancerPort': 80,
+                'instancePort': 80, 'mode': 'tcp', 'nicIps': ['10.0.0.2'],
+                'parameters': ['balancerAlgorithm::%s' % algorithm, 'maxConnection::2000', 'connectionIdleTimeout::60',
+                               'healthCheckTarget::tcp:default', 'healthCheckInterval::5', 'healthyThreshold::2',
+                               'unhealthyThreshold::2']}))
+
+        agent._apply([listener_to('roundrobin')])
+        good = self.haproxy._read_listener('lb1', 'l1')
+        self.assertRaises(virtualrouter.VirtualRouterError, agent._apply, [listener_to('bad-option')])
+        self.assertEqual(good, self.haproxy._read_listener('lb1', 'l1'))
+
+        # the load balancer is not stuck on the bad listener
+        agent._apply([listener_to('leastconn')])
+        self.assertIn('balance leastconn', self.haproxy._read_listener('lb1', 'l1'))
+
+    def test_reload_waits_for_listener_updates(self):
+        self.haproxy.set_listener(*self._listener('lb1', 'l1', 80))
+        self.assertEqual({}, self.haproxy.reload(['lb1']))
+
+        # the last listener is removed while another one is being written
+        to, context = self._listener('lb1', 'l1', 80)
+        errors = []
+        with lock.NamedLock('lb'):
+            self.haproxy.remove_listener(to)
+            t = threading.Thread(target=lambda: errors.append(self.haproxy.reload(['lb1'])))
+            t.start()
+            time.sleep(self.haproxy.BATCH_WINDOW + 0.1)
+            self.haproxy.set_listener(*self._listener('lb1', 'l2', 443))
+        t.join()
+
+        self.assertEqual([{}], errors)
+        self.assertEqual(2, len(self._reloads('lb1')))
+        self.assertIsNotNone(self.haproxy._read_listener('lb1', 'l2'))
+
+    def test_legacy_listeners_migrated(self):
+        for listener_uuid, port in (('l1', 80), ('l2', 443)):
+            with open(os.path.join(self.haproxy.CONF_DIR, 'lb1-%s.cfg' % listener_uuid), 'w') as fd:
+                fd.write(LEGACY_CONF % (listener_uuid, port, port, port))
+        p1 = self._spawn(os.path.join(self.haproxy.RUN_DIR, 'haproxy-lb1-l1.pid'))
+        p2 = self._spawn(os.path.join(self.haproxy.RUN_DIR, 'haproxy-lb1-l2.pid'))
+
+        # only l1 is refreshed, l2 has to be served by the new haproxy too
+        self.haproxy.set_listener(*self._listener('lb1', 'l1', 80, 'leastconn'))
+        self.assertEqual({}, self.haproxy.reload(['lb1']))
+
+        reloads = self._reloads('lb1')
+        self.assertEqual(1, len(reloads))
+        self.assertIn('-sf', reloads[0])
+        self.assertIn(str(p1.pid), reloads[0])
+        self.assertIn(str(p2.pid), reloads[0])
+
+        with open(self.haproxy._make_conf_file_path('lb1'), 'r') as fd:
+            conf = fd.read()
+        self.assertEqual(1, conf.count('\nglobal') + conf.startswith('global'))
+        self.assertIn('balance leastconn', conf)
+        self.assertIn('listen l2', conf)
+        self.assertIn('bind 192.168.0.10:443', conf)
+        # maxconn of the legacy global section goes into the listener
+        self.assertIn('maxconn 3000', conf)
+
+        self.assertEqual([], self.haproxy._get_legacy_conf_files('lb1'))
+        self.assertEqual([], self.haproxy._get_legacy_pid_files('lb1'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,14 +19,26 @@ class RemoveEipRsp(virtualrouter.AgentResponse):
     def __init__(self):
         super(RemoveEipRsp, self).__init__()
 
+# success is False if any eip fails. The rules of eips in createdEips are
+# applied anyway, only those in failedEips need to be sent again; sending the
+# whole batch again adds no rule twice
 class SyncEipRsp(virtualrouter.AgentResponse):
     def __init__(self):
         super(SyncEipRsp, self).__init__()
+        self.createdEips = None
+        self.failedEips = None
+
+class CreateEipsRsp(virtualrouter.AgentResponse):
+    def __init__(self):
+        super(CreateEipsRsp, self).__init__()
+        self.createdEips = None
+        self.failedEips = None
 
 class Eip(virtualrouter.VRAgent):
     VR_CREATE_EIP = "/createeip"
     VR_REMOVE_EIP = "/removeeip"
     VR_SYNC_EIP = "/synceip"
+    VR_CREATE_EIPS = "/createeips"
 
     def _make_chain_name(self, vip_nic_name, priv_nic_name, prefix):
         name = 'eip-{0}-{1}-{2}'.format(prefix, vip_nic_name, priv_nic_name)
@@ -52,10 +64,20 @@ class Eip(virtualrouter.VRAgent):
 
         return chain_name.split('-')[2]
 
-    def _create_eip(self, eip):
-        ipt = iptables.from_iptables_save()
+    def _add_eip_rules(self, ipt, eip):
+        # validate the eip before touching ipt, so a bad eip leaves no rules behind
         private_nic_name = linux.get_nic_name_by_mac(eip.privateMac)
+        if not private_nic_name:
+            raise virtualrouter.VirtualRouterError('cannot find private nic by MAC[%s]' % eip.privateMac)
         vip_nic_name = linux.get_nic_name_by_ip(eip.vipIp)
+        if not vip_nic_name:
+            raise virtualrouter.VirtualRouterError('cannot find vip nic by IP[%s]' % eip.vipIp)
+        guest_gw_ip = None
+        if eip.snatInboundTraffic:
+            guest_gw_ip = linux.get_ip_by_nic_name(private_nic_name)
+            if not guest_gw_ip:
+                raise virtualrouter.VirtualRouterError('cannot find ip of private nic[%s]' % private_nic_name)
+
         guest_ip = eip.guestIp
         vip = eip.vipIp
 
@@ -88,12 +110,43 @@ class Eip(virtualrouter.VRAgent):
 
         if eip.snatInboundTraffic:
             gw_snat_name = self._make_gateway_snat_name(vip_nic_name, private_nic_name)
-            guest_gw_ip = linux.get_ip_by_nic_name(private_nic_name)
             ipt.add_rule('-A POSTROUTING -d {0} -j {1}'.format(guest_ip, gw_snat_name), ipt.NAT_TABLE_NAME, order=order)
             ipt.add_rule('-A {0} -j SNAT --to-source {1}'.format(gw_snat_name, guest_gw_ip), ipt.NAT_TABLE_NAME, order=order)
 
+        return vip_nic_name, private_nic_name
+
+    def _create_eip(self, eip):
+        ipt = iptables.from_iptables_save(cached=True)
+        vip_nic_name, private_nic_name = self._add_eip_rules(ipt, eip)
         ipt.iptable_restore()
-        logger.debug('successfully created eip[{0}] to guest ip[{1}] from device[{2}] to device[{3}]'.format(vip, guest_ip, vip_nic_name, private_nic_name))
+        logger.debug('successfully created eip[{0}] to guest ip[{1}] from device[{2}] to device[{3}]'.format(eip.vipIp, eip.guestIp, vip_nic_name, private_nic_name))
+
+    def _create_eips(self, ipt, eips):
+        '''
+        adds rules of eips to ipt without restoring it. Returns the eips added
+        as a list of {vipIp, guestIp}, and the eips failed to validate as a list
+        of {vipIp, guestIp, error}, no rule is added for them
+        '''
+        created = []
+        failures = []
+        for eip in eips:
+            try:
+                self._add_eip_rules(ipt, eip)
+                created.append({'vipIp': eip.vipIp, 'guestIp': eip.guestIp})
+            except virtualrouter.VirtualRouterError as e:
+                logger.warning('failed to create eip[%s] to guest ip[%s], %s' % (eip.vipIp, eip.guestIp, str(e)))
+                failures.append({'vipIp': eip.vipIp, 'guestIp': eip.guestIp, 'error': str(e)})
+        return created, failures
+
+    def _report(self, rsp, eips, created, failures):
+        rsp.createdEips = created
+        if not failures:
+            return
+
+        rsp.failedEips = failures
+        rsp.success = False
+        rsp.error = 'failed to create %s of %s eips: %s' % (len(failures), len(eips),
+                ', '.join(['eip[%s]: %s' % (f['vipIp'], f['error']) for f in failures]))
 
     @virtualrouter.replyerror
     @lock.lock('eip')
@@ -152,33 +205,50 @@ class Eip(virtualrouter.VRAgent):
         rsp = SyncEipRsp()
 
         def remove_eip_chain(table):
-            for c in table.children:
+            for c in list(table.children):
                 if c.name.startswith('eip-'):
                     c.delete()
 
-        ipt = iptables.from_iptables_save()
+        ipt = iptables.from_iptables_save(cached=True)
         nat = ipt.get_table(ipt.NAT_TABLE_NAME)
         if nat:
             remove_eip_chain(nat)
         filter_table = ipt.get_table(ipt.FILTER_TABLE_NAME)
         if filter_table:
             remove_eip_chain(filter_table)
+
+        # old chains are replaced by the new ones in one iptables-restore, NAT
+        # is never left half configured
+        eips = cmd.eips or []
+        created, failures = self._create_eips(ipt, eips)
         ipt.iptable_restore()
+        logger.debug('synced %s eips, %s failed' % (len(created), len(failures)))
 
-        try:
-            for eip in cmd.eips:
-                self._create_eip(eip)
-        except virtualrouter.VirtualRouterError as e:
-            logger.warning(linux.get_exception_stacktrace())
-            rsp.error = str(e)
-            rsp.success = False
+        self._report(rsp, eips, created, failures)
+        return jsonobject.dumps(rsp)
+
+    @virtualrouter.replyerror
+    @lock.lock('eip')
+    @lock.file_lock('iptables')
+    def create_eips(self, req):
+        cmd = jsonobject.loads(req[http.REQUEST_BODY])
+        rsp = CreateEipsRsp()
+
+        eips = cmd.eips or []
+        ipt = iptables.from_iptables_save(cached=True)
+        created, failures = self._create_eips(ipt, eips)
+        if created:
+            ipt.iptable_restore()
+        logger.debug('created %s eips, %s failed' % (len(created), len(failures)))
 
+        self._report(rsp, eips, created, failures)
         return jsonobject.dumps(rsp)
 
     def start(self):
         virtualrouter.VirtualRouter.http_server.register_async_uri(self.VR_CREATE_EIP, self.create_eip)
         virtualrouter.VirtualRouter.http_server.register_async_uri(self.VR_REMOVE_EIP, self.remove_eip)
         virtualrouter.VirtualRouter.http_server.register_async_uri(self.VR_SYNC_EIP, self.sync_eip)
+        virtualrouter.VirtualRouter.http_server.register_async_uri(self.VR_CREATE_EIPS, self.create_eips)
 
     def stop(self):
         pass
@@ -6,40 +6,34 @@ from zstacklib.utils import jsonobject
 from zstacklib.utils import linux
 from zstacklib.utils import log
 from zstacklib.utils import lock
+from zstacklib.utils import proctable
 import zstacklib.utils.iptables as iptables
-from zstacklib.utils.rollback import rollback, rollbackable
 import zstacklib.utils.shell as shell
 from jinja2 import Template
+import glob
 import os
+import re
+import threading
+import time
 
 
 logger = log.get_logger(__name__)
 
-class Lb(virtualrouter.VRAgent):
-
-    REFRESH_LB_PATH = "/lb/refresh"
-    DELETE_LB_PATH = "/lb/delete"
-
-    def _make_pid_file_path(self, lbUuid, listenerUuid):
-        return '/var/run/haproxy-%s-%s.pid' % (lbUuid, listenerUuid)
-
-    def _make_conf_file_path(self, lbuuid, listener_uuid):
-        return '/etc/haproxy/%s-%s.cfg' % (lbuuid, listener_uuid)
-
-    def _make_chain_name(self, to):
-        return "lb-%s-%s" % (to.vip.replace('.', '-'), to.loadBalancerPort)
-
-    @rollback
-    def _refresh(self, to):
-        conf = '''global
+GLOBAL_CONF = '''global
     maxconn {{maxConnection}}
     log 127.0.0.1 local1
     user haproxy
     group haproxy
     daemon
+    {% if socketPath %}
+    stats socket {{socketPath}} mode 600 level admin expose-fd listeners
+    {% endif %}
 
-listen {{listenerUuid}}
+'''
+
+LISTENER_CONF = '''listen {{listenerUuid}}
     mode {{mode}}
+    maxconn {{maxConnection}}
     timeout client {{connectionIdleTimeout}}s
     timeout server {{connectionIdleTimeout}}s
     timeout connect 60s
@@ -48,19 +42,318 @@ listen {{listenerUuid}}
     {% for ip in nicIps %}
     server nic-{{ip}} {{ip}}:{{loadBalancerPort}} check port {{checkPort}} inter {{healthCheckInterval}}s rise {{healthyThreshold}} fall {{unhealthyThreshold}}
     {% endfor %}
+
 '''
 
-        pid_file = self._make_pid_file_path(to.lbUuid, to.listenerUuid)
-        if not os.path.exists(pid_file):
-            shell.call('touch %s' % pid_file)
+class HaproxyManager(object):
+    '''
+    runs one haproxy per load balancer, serving all listeners of it. The
+    section of each listener is kept in its own file, a reload renders all of
+    them into the config of the load balancer.
+
+    Reloads requested while another reload is running, or within
+    BATCH_WINDOW seconds, are done together, so a burst of refreshes costs
+    one reload per load balancer. With haproxy 1.8+ the new process takes
+    the listening sockets over from the old one through the stats socket,
+    no connection is refused during the reload. Sections of listeners served
+    by the haproxy of each listener, as earlier versions did, are moved into
+    the listener files before the first reload and their haproxy stopped by it
+    '''
+    BATCH_WINDOW = 0.1
+    CONF_DIR = '/etc/haproxy'
+    RUN_DIR = '/var/run'
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._done_seq = 0
+        self._reloading = False
+        # lb uuid -> seq of the latest request of it
+        self._pending = {}
+        # lb uuid -> error of the last reload of it, None if it succeeded
+        self._errors = {}
+        self._seamless = None
+
+    def _make_listener_dir(self, lb_uuid):
+        return os.path.join(self.CONF_DIR, lb_uuid)
+
+    def _make_listener_file_path(self, lb_uuid, listener_uuid):
+        return os.path.join(self._make_listener_dir(lb_uuid), '%s.cfg' % listener_uuid)
+
+    def _make_conf_file_path(self, lb_uuid):
+        return os.path.join(self.CONF_DIR, '%s.cfg' % lb_uuid)
+
+    def _make_pid_file_path(self, lb_uuid):
+        return os.path.join(self.RUN_DIR, 'haproxy-%s.pid' % lb_uuid)
+
+    def _make_socket_path(self, lb_uuid):
+        return os.path.join(self.RUN_DIR, 'haproxy-%s.sock' % lb_uuid)
+
+    def _get_legacy_pid_files(self, lb_uuid):
+        # each listener had its own haproxy before
+        return glob.glob(os.path.join(self.RUN_DIR, 'haproxy-%s-*.pid' % lb_uuid))
+
+    def _get_legacy_conf_files(self, lb_uuid):
+        return glob.glob(os.path.join(self.CONF_DIR, '%s-*.cfg' % lb_uuid))
+
+    @staticmethod
+    def _strip_global(conf):
+        # the listen section of a legacy config, with the maxconn of its global
+        # section which was the one of the listener
+        lines = conf.split('\n')
+        start = 0
+        while start < len(lines) and (not lines[start].strip() or lines[start].startswith('global') or lines[start][0].isspace()):
+            start += 1
+
+        m = re.search(r'(?m)^\s*maxconn (\d+)', '\n'.join(lines[:start]))
+        section = lines[start:]
+        if not section:
+            return None
+        if m and not re.search(r'(?m)^\s*maxconn ', '\n'.join(section)):
+            section.insert(1, '    maxconn %s' % m.group(1))
+        return '\n'.join(section).rstrip() + '\n\n'
+
+    def _migrate_legacy_listeners(self, lb_uuid):
+        '''
+        moves the sections of listeners served by the haproxy of each listener
+        into the listener directory, so all of them are served after the reload
+        '''
+        for f in self._get_legacy_conf_files(lb_uuid):
+            listener_uuid = os.path.basename(f)[len(lb_uuid) + 1:-len('.cfg')]
+            listener_file = self._make_listener_file_path(lb_uuid, listener_uuid)
+            if not os.path.exists(listener_file):
+                with open(f, 'r') as fd:
+                    section = self._strip_global(fd.read())
+
+                if section:
+                    listener_dir = self._make_listener_dir(lb_uuid)
+                    if not os.path.exists(listener_dir):
+                        os.makedirs(listener_dir, 0755)
+                    linux.write_file_atomically(listener_file, section)
+                    logger.debug('migrated listener[uuid:%s] of load balancer[uuid:%s] from %s' % (listener_uuid, lb_uuid, f))
+            os.remove(f)
+
+    def _is_seamless_reload_supported(self):
+        if self._seamless is None:
+            # HA-Proxy version 1.8.8 2018/04/19
+            m = re.search(r'version (\d+)\.(\d+)', shell.call('haproxy -v'))
+            self._seamless = m is not None and (int(m.group(1)), int(m.group(2))) >= (1, 8)
+            logger.debug('seamless reload of haproxy is %s' % ('supported' if self._seamless else 'not supported'))
+        return self._seamless
+
+    def _read_listener(self, lb_uuid, listener_uuid):
+        listener_file = self._make_listener_file_path(lb_uuid, listener_uuid)
+        if not os.path.exists(listener_file):
+            return None
+
+        with open(listener_file, 'r') as fd:
+            return fd.read()
+
+    def set_listener(self, to, context):
+        '''
+        writes the section of the listener. Returns the section replaced, None
+        if there was none, and the new one
+        '''
+        self._migrate_legacy_listeners(to.lbUuid)
+        old = self._read_listener(to.lbUuid, to.listenerUuid)
+
+        listener_dir = self._make_listener_dir(to.lbUuid)
+        if not os.path.exists(listener_dir):
+            os.makedirs(listener_dir, 0755)
+
+        conf = Template(LISTENER_CONF).render(context)
+        linux.write_file_atomically(self._make_listener_file_path(to.lbUuid, to.listenerUuid), conf)
+        return old, conf
+
+    def remove_listener(self, to):
+        '''
+        returns the section removed, None if there was none, and None
+        '''
+        self._migrate_legacy_listeners(to.lbUuid)
+        old = self._read_listener(to.lbUuid, to.listenerUuid)
+        if old is not None:
+            os.remove(self._make_listener_file_path(to.lbUuid, to.listenerUuid))
+        return old, None
+
+    def restore_listener(self, to, old, new):
+        '''
+        puts back the section old which was replaced by new. Returns False
+        without doing anything if the section is no longer new
+        '''
+        if self._read_listener(to.lbUuid, to.listenerUuid) != new:
+            return False
+
+        listener_file = self._make_listener_file_path(to.lbUuid, to.listenerUuid)
+        if old is None:
+            if os.path.exists(listener_file):
+                os.remove(listener_file)
+            return True
+
+        listener_dir = self._make_listener_dir(to.lbUuid)
+        if not os.path.exists(listener_dir):
+            os.makedirs(listener_dir, 0755)
+        linux.write_file_atomically(listener_file, old)
+        return True
+
+    def _read_listeners(self, lb_uuid):
+        listener_dir = self._make_listener_dir(lb_uuid)
+        if not os.path.isdir(listener_dir):
+            return []
+
+        sections = []
+        for f in sorted(glob.glob(os.path.join(listener_dir, '*.cfg'))):
+            with open(f, 'r') as fd:
+                sections.append(fd.read())
+        return sections
+
+    def _get_running_pids(self, lb_uuid):
+        pid_files = [self._make_pid_file_path(lb_uuid)] + self._get_legacy_pid_files(lb_uuid)
+        pids = [proctable.get_pid_from_pidfile(f, [f]) for f in pid_files]
+        return [p for p in pids if p]
 
-        @rollbackable
-        def _0():
-            shell.call('rm -f %s' % pid_file)
-        _0()
+    def _remove_legacy_files(self, lb_uuid):
+        for f in self._get_legacy_pid_files(lb_uuid) + self._get_legacy_conf_files(lb_uuid):
+            os.remove(f)
 
-        conf_file = self._make_conf_file_path(to.lbUuid, to.listenerUuid)
+    def _stop(self, lb_uuid, pids):
+        if pids:
+            shell.call('kill %s' % ' '.join(pids))
 
+        self._remove_legacy_files(lb_uuid)
+        shell.call('rm -f %s %s %s' % (self._make_pid_file_path(lb_uuid), self._make_conf_file_path(lb_uuid), self._make_socket_path(lb_uuid)))
+        listener_dir = self._make_listener_dir(lb_uuid)
+        if os.path.isdir(listener_dir):
+            os.rmdir(listener_dir)
+        logger.debug('stopped haproxy of load balancer[uuid:%s]' % lb_uuid)
+
+    def _write_conf(self, lb_uuid, sections, seamless):
+        max_conn = sum([int(m) for s in sections for m in re.findall(r'(?m)^\s*maxconn (\d+)', s)])
+        context = {
+            'maxConnection': max_conn,
+            'socketPath': self._make_socket_path(lb_uuid) if seamless else None,
+        }
+        conf = Template(GLOBAL_CONF).render(context) + ''.join(sections)
+
+        # check the new config before replacing the one of the running haproxy
+        conf_file = self._make_conf_file_path(lb_uuid)
+        tmp_file = linux.write_to_temp_file(conf)
+        try:
+            shell.call('haproxy -c -q -f %s' % tmp_file)
+        finally:
+            os.remove(tmp_file)
+        linux.write_file_atomically(conf_file, conf)
+        return conf_file
+
+    def _reload_lb(self, lb_uuid):
+        # set_listener and remove_listener migrate and write the listener files
+        # under the lock, the listener directory must not change until the
+        # haproxy is stopped
+        with lock.NamedLock('lb'):
+            self._migrate_legacy_listeners(lb_uuid)
+            sections = self._read_listeners(lb_uuid)
+            pids = self._get_running_pids(lb_uuid)
+            if not sections:
+                self._stop(lb_uuid, pids)
+                return
+
+        seamless = self._is_seamless_reload_supported()
+        conf_file = self._write_conf(lb_uuid, sections, seamless)
+        pid_file = self._make_pid_file_path(lb_uuid)
+        socket_path = self._make_socket_path(lb_uuid)
+
+        cmd = ['haproxy -D -f %s -p %s' % (conf_file, pid_file)]
+        if seamless and pids and os.path.exists(socket_path):
+            cmd.append('-x %s' % socket_path)
+        if pids:
+            cmd.append('-sf %s' % ' '.join(pids))
+        cmd = ' '.join(cmd)
+
+        if seamless or not pids:
+            shell.call(cmd)
+        else:
+            # without the socket handoff, connections queued on the sockets of
+            # the old process are reset when it exits. Drop SYNs during the
+            # reload so clients retry instead
+            binds = set()
+            for s in sections:
+                binds.update(re.findall(r'(?m)^\s*bind (\S+):(\d+)', s))
+
+            drops = ['INPUT -d %s -p tcp --dport %s --syn -j DROP' % b for b in binds]
+            with lock.FileLock('iptables'):
+                for d in drops:
+                    shell.call('iptables -I %s' % d)
+                try:
+                    shell.call(cmd)
+                finally:
+                    for d in drops:
+                        shell.call('iptables -D %s' % d)
+
+        self._remove_legacy_files(lb_uuid)
+        logger.debug('reloaded haproxy of load balancer[uuid:%s] with %s listeners' % (lb_uuid, len(sections)))
+
+    def reload(self, lb_uuids):
+        '''
+        reloads haproxy of lb_uuids with the listener files written before the
+        call. Returns a dict of lb uuid -> error for load balancers failed to
+        reload
+        '''
+        with self._cond:
+            self._seq += 1
+            seq = self._seq
+            for uuid in lb_uuids:
+                self._pending[uuid] = seq
+
+            while self._done_seq < seq and self._reloading:
+                self._cond.wait()
+
+            if self._done_seq >= seq:
+                # done by the reload of another request
+                return self._collect_errors(lb_uuids)
+
+            self._reloading = True
+
+        try:
+            # let requests arriving close together join this reload
+            time.sleep(self.BATCH_WINDOW)
+
+            with self._cond:
+                batch = self._pending.keys()
+                self._pending = {}
+                done_seq = self._seq
+
+            errors = {}
+            for uuid in batch:
+                try:
+                    self._reload_lb(uuid)
+                    errors[uuid] = None
+                except Exception as e:
+                    logger.warn(linux.get_exception_stacktrace())
+                    errors[uuid] = str(e)
+        except:
+            with self._cond:
+                self._reloading = False
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._errors.update(errors)
+            self._done_seq = done_seq
+            self._reloading = False
+            self._cond.notify_all()
+            return self._collect_errors(lb_uuids)
+
+    def _collect_errors(self, lb_uuids):
+        return dict([(uuid, self._errors[uuid]) for uuid in lb_uuids if self._errors.get(uuid)])
+
+class Lb(virtualrouter.VRAgent):
+
+    REFRESH_LB_PATH = "/lb/refresh"
+    DELETE_LB_PATH = "/lb/delete"
+
+    def _make_chain_name(self, to):
+        return "lb-%s-%s" % (to.vip.replace('.', '-'), to.loadBalancerPort)
+
+    def _make_listener_context(self, to):
         context = {}
         context.update(to.__dict__)
         for p in to.parameters:
@@ -73,66 +366,86 @@ listen {{listenerUuid}}
                     context['checkPort'] = check_port
 
             context[k] = v
+        return context
 
-        conf_tmpt = Template(conf)
-        conf = conf_tmpt.render(context)
-        with open(conf_file, 'w') as fd:
-            fd.write(conf)
-
-        shell.call("iptables -I INPUT -d %s -p tcp --dport %s --syn -j DROP && sleep 0.5" % (to.vip, to.loadBalancerPort))
-        @rollbackable
-        def _1():
-            shell.call("iptables -D INPUT -d %s -p tcp --dport %s --syn -j DROP" % (to.vip, to.loadBalancerPort))
-        _1()
-
-        shell.call('haproxy -D -f %s -p %s -sf $(cat %s)' % (conf_file, pid_file, pid_file))
-        shell.call("iptables -D INPUT -d %s -p tcp --dport %s --syn -j DROP" % (to.vip, to.loadBalancerPort))
-
-        ipt = iptables.from_iptables_save()
+    def _add_chain_rules(self, ipt, to):
         chain_name = self._make_chain_name(to)
         ipt.add_rule('-A INPUT -d %s/32 -j %s' % (to.vip, chain_name))
         ipt.add_rule('-A %s -p tcp -m tcp --dport %s -j ACCEPT' % (chain_name, to.loadBalancerPort))
-        ipt.iptable_restore()
 
+    def _restore_listeners(self, changes):
+        # the latest change first, in case a listener is changed twice
+        restored = []
+        for to, old, new in reversed(changes):
+            if self.haproxy.restore_listener(to, old, new):
+                restored.append((to, old, new))
+            else:
+                logger.warn('listener[uuid:%s] of load balancer[uuid:%s] has been changed again, not rolled back' % (to.listenerUuid, to.lbUuid))
+        return restored
 
-    def _kill_lb(self, to):
-        pid_file_path = self._make_pid_file_path(to.lbUuid, to.listenerUuid)
-
-        pid = linux.find_process_by_cmdline([pid_file_path])
-        if pid:
-            shell.call('kill %s' % pid)
+    @lock.lock('lb')
+    @lock.file_lock('iptables')
+    def _update_listeners(self, tos, delete=False):
+        '''
+        returns the changes as a list of (to, old section, new section)
+        '''
+        ipt = iptables.from_iptables_save(cached=True)
+        changes = []
+        try:
+            for to in tos:
+                if delete or len(to.nicIps) == 0:
+                    old, new = self.haproxy.remove_listener(to)
+                    changes.append((to, old, new))
+                    ipt.delete_chain(self._make_chain_name(to))
+                else:
+                    old, new = self.haproxy.set_listener(to, self._make_listener_context(to))
+                    changes.append((to, old, new))
+                    self._add_chain_rules(ipt, to)
+            ipt.iptable_restore()
+        except:
+            self._restore_listeners(changes)
+            raise
 
-        shell.call('rm -f %s' % pid_file_path)
-        shell.call('rm -f %s' % self._make_conf_file_path(to.lbUuid, to.listenerUuid))
+        return changes
 
-        ipt = iptables.from_iptables_save()
-        ipt.delete_chain(self._make_chain_name(to))
+    @lock.lock('lb')
+    @lock.file_lock('iptables')
+    def _rollback_listeners(self, changes):
+        ipt = iptables.from_iptables_save(cached=True)
+        for to, old, new in self._restore_listeners(changes):
+            if old is None:
+                ipt.delete_chain(self._make_chain_name(to))
+            else:
+                self._add_chain_rules(ipt, to)
         ipt.iptable_restore()
 
+    def _apply(self, tos, delete=False):
+        changes = self._update_listeners(tos, delete)
+        errors = self.haproxy.reload(list(set([to.lbUuid for to, _, _ in changes])))
+        if errors:
+            # a bad listener would fail every later reload of its load balancer
+            self._rollback_listeners([c for c in changes if c[0].lbUuid in errors])
+            raise virtualrouter.VirtualRouterError('failed to reload haproxy of load balancers: %s, changes of their listeners are rolled back' %
+                    ', '.join(['%s[%s]' % (uuid, err) for uuid, err in errors.items()]))
+
     @virtualrouter.replyerror
-    @lock.file_lock('iptables')
     def refresh(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        for to in cmd.lbs:
-            if len(to.nicIps) == 0:
-                self._kill_lb(to)
-            else:
-                self._refresh(to)
+        self._apply(cmd.lbs)
 
         rsp = virtualrouter.AgentResponse()
         return jsonobject.dumps(rsp)
 
     @virtualrouter.replyerror
-    @lock.file_lock('iptables')
     def delete(self, req):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
-        for to in cmd.lbs:
-            self._kill_lb(to)
+        self._apply(cmd.lbs, delete=True)
 
         rsp = virtualrouter.AgentResponse()
         return jsonobject.dumps(rsp)
 
     def start(self):
+        self.haproxy = HaproxyManager()
         virtualrouter.VirtualRouter.http_server.register_async_uri(self.REFRESH_LB_PATH, self.refresh)
         virtualrouter.VirtualRouter.http_server.register_async_uri(self.DELETE_LB_PATH, self.delete)
 
@@ -89,7 +89,7 @@ class PortForwarding(virtualrouter.VRAgent):
         cmd = jsonobject.loads(req[http.REQUEST_BODY])
         rsp = CreatePortForwardingRuleRsp()
 
-        iptc = iptables.from_iptables_save()
+        iptc = iptables.from_iptables_save(cached=True)
         for to in cmd.rules:
             self._create_rule(iptc, to)
         iptc.iptable_restore()
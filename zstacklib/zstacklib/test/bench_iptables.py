@@ -0,0 +1,62 @@
+'''
+micro benchmark of parsing iptables-save output of hosts having many vnic
+chains, compared to the former pyparsing based parser. Run it from the
+zstacklib folder:
+
+    python -m zstacklib.test.bench_iptables
+'''
+import timeit
+from zstacklib.utils import iptables
+
+RULES_PER_CHAIN = 10
+
+def _iptables_save(rule_num):
+    chain_num = rule_num / RULES_PER_CHAIN
+    counters = [':INPUT ACCEPT [1024:65536]', ':FORWARD ACCEPT [0:0]', ':OUTPUT ACCEPT [2048:131072]']
+    rules = []
+    for i in range(chain_num):
+        nic = 'vnic%s.%s' % (i / 4, i % 4)
+        chain = '%s-in' % nic
+        counters.append(':%s - [0:0]' % chain)
+        rules.append('-A FORWARD -o %s -m physdev --physdev-is-bridged -j %s' % (nic, chain))
+        for j in range(RULES_PER_CHAIN - 1):
+            rules.append('-A %s -s 10.%s.%s.0/24 -p tcp -m tcp --dport %s -j ACCEPT' % (chain, i % 255, j, 1000 + j))
+
+    lst = ['# Generated by iptables-save v1.4.21', '*filter']
+    lst.extend(counters)
+    lst.extend(rules)
+    lst.append('COMMIT')
+    lst.append('# Completed')
+    lst.append('')
+    return '\n'.join(lst)
+
+def _parse(txt):
+    ipt = iptables.IPTables()
+    ipt._from_iptables_save(txt)
+    return ipt
+
+def _parse_with_pyparsing(txt):
+    ipt = iptables.IPTables()
+    ipt._reset()
+    ipt._construct_pyparsing()
+    for l in txt.split('\n'):
+        l = l.strip()
+        if l:
+            ipt._parser.parseString(l)
+    return ipt
+
+def _bench(rule_num, number):
+    txt = _iptables_save(rule_num)
+    assert str(_parse(txt)) == str(_parse_with_pyparsing(txt))
+
+    fast = timeit.timeit(lambda: _parse(txt), number=number) / number * 1000
+    slow = timeit.timeit(lambda: _parse_with_pyparsing(txt), number=number) / number * 1000
+    print '%-14s lines: %8d  pyparsing: %10.1fms  tokenizer: %10.1fms' % ('%s rules' % rule_num, txt.count('\n'), slow, fast)
+
+def main():
+    _bench(1000, 10)
+    _bench(10000, 3)
+    _bench(100000, 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''
+micro benchmark of jsonobject.loads/dumps on payloads the agents exchange
+with the management node. Run it from the zstacklib folder:
+
+    python -m zstacklib.test.bench_jsonobject
+'''
+import timeit
+import simplejson
+from zstacklib.utils import jsonobject
+from zstacklib.utils import uuidhelper
+
+def _start_vm_cmd():
+    def volume(device_id):
+        return {
+            'installPath': '/zstack_ps/rootVolumes/acct-36c27e8ff05c4780bf6d2fa65700f22e/vol-%s/%s.qcow2' % (uuidhelper.uuid(), uuidhelper.uuid()),
+            'deviceId': device_id,
+            'deviceType': 'file',
+            'volumeUuid': uuidhelper.uuid(),
+            'useVirtio': True,
+            'cacheMode': 'none',
+        }
+
+    def nic(device_id):
+        return {
+            'mac': 'fa:de:41:2c:9d:0%s' % device_id,
+            'bridgeName': 'br_eth0',
+            'uuid': uuidhelper.uuid(),
+            'nicInternalName': 'vnic1.%s' % device_id,
+            'deviceId': device_id,
+            'useVirtio': True,
+        }
+
+    return {
+        'vmInstanceUuid': uuidhelper.uuid(),
+        'vmInternalId': 1,
+        'vmName': 'vm-for-benchmark',
+        'memory': 2147483648,
+        'cpuNum': 2,
+        'cpuSpeed': 2600,
+        'socketNum': 1,
+        'cpuOnSocket': 2,
+        'bootDev': ['hd'],
+        'rootVolume': volume(0),
+        'dataVolumes': [volume(i) for i in range(1, 4)],
+        'nics': [nic(i) for i in range(3)],
+        'timeout': 300,
+        'consoleMode': 'vnc',
+        'nestedVirtualization': 'none',
+        'hostManagementIp': '192.168.0.10',
+        'useVirtio': True,
+        'addons': {'channel': {'socketPath': '/var/lib/libvirt/qemu/vm', 'targetName': 'applianceVm.vport'}},
+    }
+
+def _apply_security_group_rule_cmd(rule_num):
+    rules = []
+    for i in range(rule_num):
+        rules.append({
+            'protocol': 'TCP',
+            'type': 'Ingress',
+            'startPort': i % 65535,
+            'endPort': i % 65535,
+            'allowedCidr': '10.0.%s.0/24' % (i % 255),
+            'allowedInternalIpRange': ['10.1.%s.%s' % (i % 255, j) for j in range(1, 11)],
+        })
+
+    return {'ruleTOs': [{
+        'vmNicInternalName': 'vnic1.0',
+        'vmNicIp': '10.1.1.1',
+        'vmNicMac': 'fa:de:41:2c:9d:00',
+        'actionCode': 'applyRule',
+        'ingressDefaultPolicy': 'deny',
+        'egressDefaultPolicy': 'allow',
+        'rules': rules,
+    }]}
+
+def _check_vm_state_rsp(vm_num):
+    return {
+        'success': True,
+        'error': '',
+        'states': dict([(uuidhelper.uuid(), 'Running') for i in range(vm_num)]),
+    }
+
+def _bench(name, jstr, number):
+    obj = jsonobject.loads(jstr)
+    raw = timeit.timeit(lambda: simplejson.loads(jstr), number=number) / number * 1000
+    loads = timeit.timeit(lambda: jsonobject.loads(jstr), number=number) / number * 1000
+    dumps = timeit.timeit(lambda: jsonobject.dumps(obj), number=number) / number * 1000
+    print '%-40s size: %8d bytes  simplejson.loads: %8.3fms  loads: %8.3fms  dumps: %8.3fms' % (name, len(jstr), raw, loads, dumps)
+
+def main():
+    _bench('StartVmCmd', simplejson.dumps(_start_vm_cmd()), 2000)
+    _bench('ApplySecurityGroupRuleCmd(100 rules)', simplejson.dumps(_apply_security_group_rule_cmd(100)), 200)
+    _bench('ApplySecurityGroupRuleCmd(5000 rules)', simplejson.dumps(_apply_security_group_rule_cmd(5000)), 10)
+    _bench('CheckVmStateRsp(300 vms)', simplejson.dumps(_check_vm_state_rsp(300)), 500)
+
+if __name__ == '__main__':
+    main()
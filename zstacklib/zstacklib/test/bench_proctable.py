@@ -0,0 +1,55 @@
+'''
+micro benchmark of looking a process up by its cmdline in the process table
+of proctable, compared to reading the cmdline of every process as
+linux.find_process_by_cmdline did before. Run it from the zstacklib folder:
+
+    python -m zstacklib.test.bench_proctable
+'''
+import os
+import subprocess
+import time
+import timeit
+from zstacklib.utils import proctable
+from zstacklib.utils import uuidhelper
+
+def _scan(cmdlines):
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', pid, 'cmdline'), 'r') as fd:
+                cmdline = fd.read()
+        except IOError:
+            continue
+        if proctable._matches(cmdline, cmdlines):
+            return pid
+    return None
+
+def _bench(process_num, number):
+    procs = [subprocess.Popen(['sleep', '600']) for i in range(process_num)]
+    try:
+        # until all children have exec'ed sleep
+        time.sleep(1)
+        # not in the cmdline of any process, so both have to go through all
+        cmdlines = [uuidhelper.uuid()]
+        table = proctable.ProcessTable()
+        # measure the steady state, not the processes just started being
+        # read again within the recheck window
+        table.RECHECK_WINDOW = 0
+        table.find(cmdlines)
+
+        total = len([pid for pid in os.listdir('/proc') if pid.isdigit()])
+        scan = timeit.timeit(lambda: _scan(cmdlines), number=number) / number * 1000
+        find = timeit.timeit(lambda: table.find(cmdlines), number=number) / number * 1000
+        print '%-16s scan: %8.2fms  process table: %8.2fms' % ('%s processes' % total, scan, find)
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def main():
+    _bench(100, 50)
+    _bench(1500, 20)
+
+if __name__ == '__main__':
+    main()
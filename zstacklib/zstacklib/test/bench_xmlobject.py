@@ -0,0 +1,139 @@
+'''
+micro benchmark of xmlobject on domain xmls the size libvirt returns for
+vms with many volumes and nics. Run it from the zstacklib folder:
+
+    python -m zstacklib.test.bench_xmlobject
+'''
+import timeit
+from zstacklib.utils import xmlobject
+from zstacklib.utils import uuidhelper
+
+def _domain_xml(volume_num, nic_num):
+    disks = []
+    for i in range(volume_num):
+        disks.append('''
+    <disk type='file' device='disk' snapshot='external'>
+      <driver name='qemu' type='qcow2' cache='none'/>
+      <source file='/zstack_ps/rootVolumes/acct-36c27e8ff05c4780bf6d2fa65700f22e/vol-%s/%s.qcow2'/>
+      <backingStore/>
+      <target dev='vd%s' bus='virtio'/>
+      <alias name='virtio-disk%s'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x%02x' function='0x0'/>
+    </disk>''' % (uuidhelper.uuid(), uuidhelper.uuid(), chr(ord('a') + i), i, i + 8))
+
+    nics = []
+    for i in range(nic_num):
+        nics.append('''
+    <interface type='bridge'>
+      <mac address='fa:de:41:2c:9d:%02x'/>
+      <source bridge='br_eth0'/>
+      <target dev='vnic1.%s'/>
+      <model type='virtio'/>
+      <alias name='net%s'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x%02x' function='0x0'/>
+    </interface>''' % (i, i, i, i + 3))
+
+    return '''<domain type='kvm' id='1' xmlns:qemu='http://libvirt.org/schemas/domain/qemu/1.0'>
+  <name>%s</name>
+  <uuid>%s</uuid>
+  <description>vm-for-benchmark</description>
+  <metadata>
+    <zstack>True</zstack>
+    <internalId>1</internalId>
+    <hostManagementIp>192.168.0.10</hostManagementIp>
+  </metadata>
+  <memory unit='KiB'>2097152</memory>
+  <currentMemory unit='KiB'>2097152</currentMemory>
+  <vcpu placement='static'>2</vcpu>
+  <cputune>
+    <shares>5200</shares>
+  </cputune>
+  <resource>
+    <partition>/machine</partition>
+  </resource>
+  <os>
+    <type arch='x86_64' machine='pc-i440fx-rhel7.0.0'>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+    <pae/>
+  </features>
+  <cpu>
+    <topology sockets='1' cores='2' threads='1'/>
+  </cpu>
+  <clock offset='utc'/>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>restart</on_crash>
+  <devices>
+    <emulator>/usr/libexec/qemu-kvm</emulator>%s
+    <disk type='file' device='cdrom'>
+      <driver name='qemu' type='raw'/>
+      <target dev='hdc' bus='ide'/>
+      <readonly/>
+      <alias name='ide0-1-0'/>
+      <address type='drive' controller='0' bus='1' target='0' unit='0'/>
+    </disk>
+    <controller type='usb' index='0'>
+      <alias name='usb0'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x2'/>
+    </controller>
+    <controller type='pci' index='0' model='pci-root'>
+      <alias name='pci.0'/>
+    </controller>
+    <controller type='ide' index='0'>
+      <alias name='ide0'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x1'/>
+    </controller>%s
+    <serial type='pty'>
+      <source path='/dev/pts/1'/>
+      <target port='0'/>
+      <alias name='serial0'/>
+    </serial>
+    <console type='pty' tty='/dev/pts/1'>
+      <source path='/dev/pts/1'/>
+      <target type='serial' port='0'/>
+      <alias name='serial0'/>
+    </console>
+    <input type='tablet' bus='usb'>
+      <alias name='input0'/>
+    </input>
+    <graphics type='vnc' port='5900' autoport='yes' listen='0.0.0.0'>
+      <listen type='address' address='0.0.0.0'/>
+    </graphics>
+    <memballoon model='virtio'>
+      <stats period='10'/>
+      <alias name='balloon0'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x1f' function='0x0'/>
+    </memballoon>
+  </devices>
+</domain>
+''' % (uuidhelper.uuid(), uuidhelper.uuid(), ''.join(disks), ''.join(nics))
+
+def _query(xml):
+    # what the agent typically reads from a domain xml
+    xo = xmlobject.loads(xml)
+    xo.name.text_
+    for g in xo.devices.get_child_node_as_list('graphics'):
+        g.port_
+    for d in xo.devices.get_child_node_as_list('disk'):
+        d.target.dev_
+    return xo
+
+def _bench(name, xml, number):
+    xo = xmlobject.loads(xml)
+    xo.dump()
+    parse = timeit.timeit(lambda: xmlobject.etree.fromstring(xml), number=number) / number * 1000
+    loads = timeit.timeit(lambda: xmlobject.loads(xml), number=number) / number * 1000
+    query = timeit.timeit(lambda: _query(xml), number=number) / number * 1000
+    dump = timeit.timeit(lambda: xmlobject.loads(xml).dump(), number=number) / number * 1000
+    print '%-28s size: %6d bytes  etree.fromstring: %7.3fms  loads: %7.3fms  loads+query: %7.3fms  loads+dump: %7.3fms' % (name, len(xml), parse, loads, query, dump)
+
+def main():
+    _bench('4 volumes, 2 nics', _domain_xml(4, 2), 1000)
+    _bench('26 volumes, 20 nics', _domain_xml(26, 20), 500)
+
+if __name__ == '__main__':
+    main()
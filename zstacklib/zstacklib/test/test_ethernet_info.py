@@ -0,0 +1,56 @@
+import unittest
+from zstacklib.utils import linux
+from zstacklib.utils import shell
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.cache = linux.EthernetInfoCache()
+        self.addr = '127.255.%s.1/32' % (id(self) % 250)
+
+    def tearDown(self):
+        shell.run('ip addr del %s dev lo > /dev/null 2>&1' % self.addr)
+
+    def _count_loads(self):
+        loads = []
+        load = self.cache._load
+        def counted():
+            loads.append(1)
+            load()
+        self.cache._load = counted
+        return loads
+
+    def test_cached(self):
+        loads = self._count_loads()
+        devices = self.cache.lookup(lambda c: c.devices)
+        self.cache.lookup(lambda c: c.devices)
+        self.assertEqual(1, len(loads))
+
+        for e in devices:
+            self.assertIs(e, self.cache.by_name[e.interface])
+            if e.mac:
+                self.assertIn(e.interface, self.cache.by_mac[e.mac])
+
+    def test_copies_returned(self):
+        devices = linux.get_ethernet_info()
+        for e in devices:
+            e.ip = '0.0.0.0'
+        for e in linux.get_ethernet_info():
+            self.assertNotEqual('0.0.0.0', e.ip)
+
+    def test_invalidated_by_address_change(self):
+        loads = self._count_loads()
+        self.cache.lookup(lambda c: c.devices)
+        if shell.run('ip addr add %s dev lo > /dev/null 2>&1' % self.addr) != 0:
+            self.skipTest('unable to add an address')
+
+        self.cache.lookup(lambda c: c.devices)
+        self.assertEqual(2, len(loads))
+        self.cache.lookup(lambda c: c.devices)
+        self.assertEqual(2, len(loads))
+
+        shell.call('ip addr del %s dev lo' % self.addr)
+        self.cache.lookup(lambda c: c.devices)
+        self.assertEqual(3, len(loads))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+import hashlib
+import socket
+import struct
+import unittest
+from zstacklib.utils import iptables
+from zstacklib.test import test_iptables_restore
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.kernel = test_iptables_restore.SAVE
+        self.saved = 0
+        self.restored = []
+        self._call = iptables.shell.call
+        self._get_table_digests = iptables._get_table_digests
+        iptables.shell.call = self._shell_call
+        iptables._get_table_digests = self._table_digests
+
+    def tearDown(self):
+        iptables.shell.call = self._call
+        iptables._get_table_digests = self._get_table_digests
+
+    def _shell_call(self, cmd):
+        if cmd.startswith('/sbin/iptables-save'):
+            self.saved += 1
+            return self.kernel
+        self.restored.append(cmd)
+        return ''
+
+    def _table_digests(self, table_names):
+        # the rules of each chain the kernel has, without counters
+        tables = {}
+        table = None
+        for l in self.kernel.split('\n'):
+            if l.startswith('*'):
+                table = tables.setdefault(l[1:], {})
+            elif l.startswith(':'):
+                table.setdefault(l.split()[0][1:], '')
+            elif l.startswith('-A'):
+                table[l.split()[1]] += l
+        return dict([(n, n in tables and dict([(c, hashlib.md5(r).hexdigest()) for c, r in tables[n].items()]) or None) for n in table_names])
+
+    def _restore(self, ipt):
+        # what the kernel reports after restoring the model
+        self.kernel = '# Generated by iptables-save at another time\n' + str(ipt)
+        ipt.iptable_restore()
+
+    def test_reuse(self):
+        cache = iptables.IPTablesCache()
+        ipt = cache.get()
+        ipt.add_rule('-A vnic1.0-in -p tcp -m tcp --dport 8080 -j ACCEPT')
+        self._restore(ipt)
+        self.assertEqual(1, len(self.restored))
+        self.assertIs(ipt, cache.get())
+        self.assertEqual(1, self.saved)
+
+    def test_changed_outside(self):
+        cache = iptables.IPTablesCache()
+        ipt = cache.get()
+        self._restore(ipt)
+        self.kernel = self.kernel.replace('--dport 80 ', '--dport 81 ')
+        ipt2 = cache.get()
+        self.assertIsNot(ipt, ipt2)
+        self.assertEqual(2, self.saved)
+        self.assertIsNotNone(ipt2.search_rule('-A vnic1.0-in -p tcp -m tcp --dport 81 -j ACCEPT'))
+
+    def test_unchanged_chains_kept_as_written(self):
+        cache = iptables.IPTablesCache()
+        ipt = cache.get()
+        rule = '-A vnic1.0-in -p tcp -m tcp --dport 8080:8080 -j ACCEPT'
+        ipt.add_rule(rule)
+        # iptables-save prints the rule in another way
+        self.kernel = str(ipt).replace('--dport 8080:8080', '--dport 8080')
+        ipt.iptable_restore()
+        self.kernel = self.kernel.replace('--dport 443 ', '--dport 444 ')
+
+        ipt2 = cache.get()
+        self.assertIsNot(ipt, ipt2)
+        self.assertEqual(2, self.saved)
+        self.assertIsNotNone(ipt2.search_rule(rule))
+        self.assertIsNotNone(ipt2.search_rule('-A vnic1.1-in -p tcp -m tcp --dport 444 -j ACCEPT'))
+        restored = len(self.restored)
+        ipt2.iptable_restore()
+        self.assertEqual(restored, len(self.restored))
+
+    def test_counters_ignored(self):
+        cache = iptables.IPTablesCache()
+        ipt = cache.get()
+        self._restore(ipt)
+        self.kernel = self.kernel.replace(':INPUT ACCEPT [0:0]', ':INPUT ACCEPT [100:2048]')
+        self.assertIs(ipt, cache.get())
+
+    def test_modified_without_restore(self):
+        cache = iptables.IPTablesCache()
+        ipt = cache.get()
+        self._restore(ipt)
+        ipt.remove_rule('-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT')
+        self.assertIsNot(ipt, cache.get())
+
+    def test_taken_once(self):
+        cache = iptables.IPTablesCache()
+        ipt = cache.get()
+        self._restore(ipt)
+        self.assertIs(ipt, cache.get())
+        self.assertIsNot(ipt, cache.get())
+
+    def test_kernel_not_readable(self):
+        iptables._get_table_digests = lambda table_names: None
+        cache = iptables.IPTablesCache()
+        ipt = cache.get()
+        self._restore(ipt)
+        self.assertIsNot(ipt, cache.get())
+
+    def test_nft_backend_not_cached(self):
+        iptables._get_table_digests = self._get_table_digests
+        _is_nft_backend = iptables._is_nft_backend
+        iptables._is_nft_backend = lambda: True
+        try:
+            cache = iptables.IPTablesCache()
+            ipt = cache.get()
+            self._restore(ipt)
+            self.assertIsNot(ipt, cache.get())
+        finally:
+            iptables._is_nft_backend = _is_nft_backend
+
+    def _entries(self, input_rules, chain_rules, counters=0):
+        '''
+        the entries IPT_SO_GET_ENTRIES returns for the INPUT chain and a user
+        chain vnic1.0-in, rules are (source ip, verdict). Verdict 'vnic1.0-in'
+        jumps to the chain
+        '''
+        def entry(src, target):
+            e = bytearray(112)
+            e[0:4] = socket.inet_aton(src)
+            struct.pack_into('HH', e, 88, 112, 112 + len(target))
+            struct.pack_into('QQ', e, 96, counters, counters * 64)
+            return e + target
+
+        def standard_target(verdict):
+            return struct.pack('H30si4x', 40, '', verdict)
+
+        def error_target(name):
+            return struct.pack('H30s30s2x', 64, 'ERROR', name)
+
+        # ACCEPT, and RETURN at the end of a user chain
+        accept = -2
+        ret = -5
+        input_size = (len(input_rules) + 1) * 152
+        first_rule_of_chain = input_size + 176
+        entries = bytearray()
+        for src, verdict in input_rules + [('0.0.0.0', accept)]:
+            entries += entry(src, standard_target(first_rule_of_chain if verdict == 'vnic1.0-in' else verdict))
+        entries += entry('0.0.0.0', error_target('vnic1.0-in'))
+        for src, verdict in chain_rules + [('0.0.0.0', ret)]:
+            entries += entry(src, standard_target(verdict))
+        entries += entry('0.0.0.0', error_target('ERROR'))
+
+        info = iptables._IptGetInfo()
+        info.valid_hooks = 1 << 1
+        info.size = len(entries)
+        return entries, info
+
+    def test_chain_digests(self):
+        input_rules = [('10.0.0.1', 'vnic1.0-in')]
+        chain_rules = [('10.0.0.2', -2)]
+        digests = iptables._chain_digests(*self._entries(input_rules, chain_rules))
+        self.assertEqual(['INPUT', 'vnic1.0-in'], sorted(digests.keys()))
+        self.assertEqual(digests, iptables._chain_digests(*self._entries(input_rules, chain_rules, counters=100)))
+
+        # the chain moves in the table but is the same
+        digests2 = iptables._chain_digests(*self._entries([('10.0.0.3', -2)] + input_rules, chain_rules))
+        self.assertNotEqual(digests['INPUT'], digests2['INPUT'])
+        self.assertEqual(digests['vnic1.0-in'], digests2['vnic1.0-in'])
+
+        digests3 = iptables._chain_digests(*self._entries(input_rules, [('10.0.0.3', -2)]))
+        self.assertEqual(digests['INPUT'], digests3['INPUT'])
+        self.assertNotEqual(digests['vnic1.0-in'], digests3['vnic1.0-in'])
+
+    def test_not_cached_by_default(self):
+        ipt = iptables.from_iptables_save()
+        self.assertIsNone(ipt._cache)
+        self._restore(ipt)
+        self.assertIsNot(ipt, iptables.from_iptables_save())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from zstacklib.utils import iptables
+from zstacklib.test import test_iptables_restore
+
+class Test(unittest.TestCase):
+    def _parse(self):
+        ipt = iptables.IPTables()
+        ipt._from_iptables_save(test_iptables_restore.SAVE)
+        return ipt
+
+    def test_search_rule(self):
+        ipt = self._parse()
+        rule = '-A vnic1.0-in  -p tcp -m tcp --dport 80 -j ACCEPT'
+        r = ipt.search_rule(rule)
+        self.assertEqual('vnic1.0-in', r.parent.name)
+        self.assertIs(r, ipt.get_chain('vnic1.0-in').children[0])
+
+        # already in the chain
+        for i in range(100):
+            ipt.add_rule(rule)
+        self.assertEqual(1, len(ipt.search_all_rule(rule)))
+        self.assertEqual(1, len(ipt.get_chain('vnic1.0-in').children))
+        ipt.add_rule(rule, ipt.NAT_TABLE_NAME)
+        self.assertEqual(2, len(ipt.search_all_rule(rule)))
+        ipt.remove_rule(rule)
+        self.assertEqual([], ipt.search_all_rule(rule))
+        self.assertEqual([], ipt.get_chain('vnic1.0-in').children)
+
+    def test_search_rules_by_target(self):
+        ipt = self._parse()
+        rules = ipt.search_rules_by_target('vnic1.1-in')
+        self.assertEqual(['-A FORWARD -o vnic1.1 -j vnic1.1-in'], [r.identity for r in rules])
+        self.assertEqual(1, len(ipt.search_rules_by_target('MASQUERADE', ipt.NAT_TABLE_NAME)))
+
+        ipt.get_chain('FORWARD').delete_all_rules()
+        self.assertEqual([], ipt.search_rules_by_target('vnic1.1-in'))
+        self.assertIsNone(ipt.search_rule('-A FORWARD -o vnic1.0 -j vnic1.0-in'))
+
+    def test_builtin_targets_not_indexed(self):
+        ipt = self._parse()
+        self.assertNotIn(('filter', 'ACCEPT'), ipt._targets)
+        rules = ipt.search_rules_by_target('ACCEPT')
+        self.assertIn('-A vnic1.0-in -p tcp -m tcp --dport 80 -j ACCEPT', [r.identity for r in rules])
+
+    def test_delete_chain(self):
+        ipt = self._parse()
+        ipt.delete_chain('vnic1.0-in')
+        self.assertIsNone(ipt.get_chain('vnic1.0-in'))
+        self.assertIsNone(ipt.search_rule('-A vnic1.0-in -p tcp -m tcp --dport 80 -j ACCEPT'))
+
+    def test_cleanup_empty_chain(self):
+        ipt = self._parse()
+        ipt.get_chain('vnic1.0-in').delete_all_rules()
+        ipt.add_rule('-A empty-chain -j ACCEPT')
+        ipt.get_chain('empty-chain').delete_all_rules()
+        ipt.delete_chain('vnic1.1-in')
+        ipt._cleanup_empty_chain()
+
+        # still targeted by FORWARD
+        self.assertIsNotNone(ipt.get_chain('vnic1.0-in'))
+        self.assertIsNone(ipt.get_chain('empty-chain'))
+        self.assertIsNone(ipt.search_rule('-A FORWARD -o vnic1.1 -j vnic1.1-in'))
+        self.assertEqual(['-A FORWARD -o vnic1.0 -j vnic1.0-in'], [r.identity for r in ipt.get_chain('FORWARD').children])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,23 @@
+import unittest
+from zstacklib.utils import iptables
+from zstacklib.test import test_iptables_restore
+from zstacklib.test import bench_iptables
+
+class Test(unittest.TestCase):
+    def test_same_as_pyparsing(self):
+        for txt in [test_iptables_restore.SAVE, bench_iptables._iptables_save(100)]:
+            self.assertEqual(str(bench_iptables._parse_with_pyparsing(txt)), str(bench_iptables._parse(txt)))
+
+    def test_fallback(self):
+        ipt = iptables.IPTables()
+        ipt._from_iptables_save('*filter\n:  vnic1.0-in - [0:0]\n-A\tvnic1.0-in -j ACCEPT\nCOMMIT\n')
+        self.assertTrue(ipt.get_chain('vnic1.0-in').counter_str.startswith(':vnic1.0-in '))
+        self.assertIsNotNone(ipt.search_rule('-A vnic1.0-in -j ACCEPT'))
+
+    def test_add_rule(self):
+        ipt = iptables.IPTables()
+        ipt.add_rule('-A vnic1.0-in  -p tcp -j ACCEPT')
+        self.assertEqual('-A vnic1.0-in -p tcp -j ACCEPT', ipt.get_chain('vnic1.0-in').children[0].identity)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+from zstacklib.utils import iptables
+
+SAVE = '''# Generated by iptables-save v1.4.21
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:vnic1.0-in - [0:0]
+:vnic1.1-in - [0:0]
+-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT
+-A FORWARD -o vnic1.0 -j vnic1.0-in
+-A FORWARD -o vnic1.1 -j vnic1.1-in
+-A vnic1.0-in -p tcp -m tcp --dport 80 -j ACCEPT
+-A vnic1.1-in -p tcp -m tcp --dport 443 -j ACCEPT
+COMMIT
+*nat
+:PREROUTING ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A POSTROUTING -s 10.0.0.0/24 -j MASQUERADE
+COMMIT
+'''
+
+class Test(unittest.TestCase):
+    def _parse(self):
+        ipt = iptables.IPTables()
+        ipt._from_iptables_save(SAVE)
+        return ipt
+
+    def test_no_change(self):
+        ipt = self._parse()
+        content, _ = ipt._to_iptables_diff_string()
+        self.assertIsNone(content)
+
+    def test_changed_chain_only(self):
+        ipt = self._parse()
+        ipt.add_rule('-A vnic1.0-in -p tcp -m tcp --dport 8080 -j ACCEPT')
+        content, baseline = ipt._to_iptables_diff_string()
+        lines = content.split('\n')
+        self.assertEqual('*filter', lines[0])
+        self.assertIn(':vnic1.0-in - [0:0]', lines)
+        self.assertIn('-A vnic1.0-in -p tcp -m tcp --dport 8080 -j ACCEPT', lines)
+        self.assertNotIn('*nat', lines)
+        self.assertFalse([l for l in lines if 'vnic1.1' in l or 'INPUT' in l])
+
+        ipt._baseline = baseline
+        content, _ = ipt._to_iptables_diff_string()
+        self.assertIsNone(content)
+
+    def test_deleted_chain(self):
+        ipt = self._parse()
+        ipt.delete_chain('vnic1.1-in')
+        ipt.remove_rule('-A FORWARD -o vnic1.1 -j vnic1.1-in')
+        content, _ = ipt._to_iptables_diff_string()
+        lines = content.split('\n')
+        self.assertIn('-F FORWARD', lines)
+        self.assertIn('-A FORWARD -o vnic1.0 -j vnic1.0-in', lines)
+        self.assertTrue(lines.index('-F vnic1.1-in') < lines.index('-X vnic1.1-in'))
+        self.assertEqual('-X vnic1.1-in', lines[-3])
+        self.assertNotIn(':vnic1.0-in - [0:0]', lines)
+
+if __name__ == "__main__":
+    unittest.main()
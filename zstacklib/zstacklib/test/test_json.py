@@ -5,6 +5,7 @@
 import unittest
 import types
 import inspect
+import StringIO
 from zstacklib.utils import jsonobject
 
 class A(object):
@@ -42,6 +43,46 @@ class Test(unittest.TestCase):
         print jb.xxxxx
         print jb.lst
 
+    def test_nested_objects(self):
+        jstr = '{"ruleTOs": [{"vmNicInternalName": "vnic1.0", "rules": [{"startPort": 22, "allowedInternalIpRange": ["10.0.0.1", "10.0.0.2"]}]}], "rebuild": null}'
+        cmd = jsonobject.loads(jstr)
+        self.assertTrue(isinstance(cmd, jsonobject.JsonObject))
+        self.assertEqual('vnic1.0', cmd.ruleTOs[0].vmNicInternalName)
+        self.assertEqual(22, cmd.ruleTOs[0].rules[0].startPort)
+        self.assertEqual(2, len(cmd.ruleTOs[0].rules[0].allowedInternalIpRange))
+        self.assertEqual(None, cmd.rebuild)
+        self.assertEqual(None, cmd.notexisting)
+        self.assertEqual('vnic1.0', cmd.ruleTOs[0].__dict__['vmNicInternalName'])
+        ncmd = jsonobject.loads(jsonobject.dumps(cmd))
+        self.assertEqual(22, ncmd.ruleTOs[0].rules[0].startPort)
+        self.assertEqual(None, ncmd.rebuild)
+
+    def test_list_root(self):
+        lst = jsonobject.loads('[{"a": 1}, 2]')
+        self.assertEqual(1, lst[0].a)
+        self.assertEqual(2, lst[1])
+
+    def test_array_stream(self):
+        jstr = '{"rebuild": true, "ruleTOs": [{"vmNicInternalName": "vnic1.0", "rules": [{"startPort": 22}]}, 12345, "x,]}", {"a": [1, 2]}], "count": 4}'
+        stream = jsonobject.JsonArrayStream(StringIO.StringIO(jstr), 'ruleTOs', chunk_size=3)
+        items = list(stream)
+        self.assertEqual(4, len(items))
+        self.assertEqual('vnic1.0', items[0].vmNicInternalName)
+        self.assertEqual(22, items[0].rules[0].startPort)
+        self.assertEqual(12345, items[1])
+        self.assertEqual('x,]}', items[2])
+        self.assertEqual([1, 2], items[3].a)
+        self.assertTrue(stream.fields.rebuild)
+        self.assertEqual(4, stream.fields.count)
+        self.assertEqual(4, len(list(stream)))
+
+        stream = jsonobject.JsonArrayStream(StringIO.StringIO('{"ruleTOs": [], "rebuild": false}'), 'ruleTOs')
+        self.assertFalse(stream.load_fields().rebuild)
+        self.assertEqual([], list(stream))
+
+        stream = jsonobject.JsonArrayStream(StringIO.StringIO('{"ruleTOs": [1, 2'), 'ruleTOs')
+        self.assertRaises(jsonobject.NoneSupportedTypeError, list, stream)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
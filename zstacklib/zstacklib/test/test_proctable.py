@@ -0,0 +1,95 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from zstacklib.utils import proctable
+from zstacklib.utils import uuidhelper
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tag = uuidhelper.uuid()
+        self.procs = []
+
+    def tearDown(self):
+        for p in self.procs:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+
+    def _spawn(self, *args):
+        p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'] + list(args))
+        self.procs.append(p)
+        # before the child execs it's a copy of this process with our cmdline
+        for i in range(100):
+            with open('/proc/%s/cmdline' % p.pid, 'r') as fd:
+                if self.tag in fd.read():
+                    break
+            time.sleep(0.01)
+        return p
+
+    def test_find(self):
+        table = proctable.ProcessTable()
+        self.assertIsNone(table.find([self.tag]))
+
+        p = self._spawn(self.tag)
+        self.assertEqual(str(p.pid), table.find(['time.sleep', self.tag]))
+        self.assertIsNone(table.find(['time.sleep', self.tag, 'no-such-arg']))
+
+        p.kill()
+        p.wait()
+        self.assertIsNone(table.find([self.tag]))
+
+    def test_pid_reused(self):
+        table = proctable.ProcessTable()
+        p = self._spawn(self.tag)
+        # the pid was seen long ago with the cmdline of another process
+        table._processes[str(p.pid)] = ('/usr/bin/old-process', '1', 0)
+        self.assertEqual(str(p.pid), table.find([self.tag]))
+
+    def test_refresh_reads_new_pids_only(self):
+        table = proctable.ProcessTable()
+        table.refresh()
+        # all processes were seen long ago
+        for pid, (cmdline, ctime, _) in table._processes.items():
+            table._processes[pid] = (cmdline, ctime, 0)
+
+        read = []
+        def read_cmdline(pid):
+            read.append(pid)
+            return _read_cmdline(pid)
+
+        _read_cmdline = proctable._read_cmdline
+        proctable._read_cmdline = read_cmdline
+        try:
+            p = self._spawn(self.tag)
+            table.refresh()
+        finally:
+            proctable._read_cmdline = _read_cmdline
+        self.assertIn(str(p.pid), read)
+        self.assertTrue(len(read) < len(table._processes))
+
+    def test_find_many(self):
+        table = proctable.ProcessTable()
+        p1 = self._spawn(self.tag, 'alpha')
+        p2 = self._spawn(self.tag, 'beta')
+        ret = table.find_many({'p1': [self.tag, '\x00alpha\x00'], 'p2': [self.tag, '\x00beta\x00'], 'p3': [self.tag, '\x00gamma\x00']})
+        self.assertEqual({'p1': str(p1.pid), 'p2': str(p2.pid), 'p3': None}, ret)
+
+    def test_pidfile(self):
+        p = self._spawn(self.tag)
+        fd, pidfile = tempfile.mkstemp()
+        os.write(fd, '%s\n' % p.pid)
+        os.close(fd)
+        try:
+            self.assertEqual(str(p.pid), proctable.get_pid_from_pidfile(pidfile, [self.tag]))
+            self.assertIsNone(proctable.get_pid_from_pidfile(pidfile, ['no-such-arg']))
+            p.kill()
+            p.wait()
+            self.assertIsNone(proctable.get_pid_from_pidfile(pidfile))
+        finally:
+            os.remove(pidfile)
+
+if __name__ == "__main__":
+    unittest.main()
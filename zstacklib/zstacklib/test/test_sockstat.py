@@ -0,0 +1,35 @@
+import os
+import socket
+import unittest
+from zstacklib.utils import sockstat
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_listening(self):
+        self.assertFalse(sockstat.is_port_listening(self.port))
+        self.assertEqual(set([self.port]), sockstat.wait_ports_listening([self.port], timeout=0.2, interval=0.1))
+
+        self.server.listen(1)
+        self.assertTrue(sockstat.is_port_listening(str(self.port)))
+        self.assertEqual(set(), sockstat.wait_ports_listening([self.port], timeout=1, interval=0.1))
+
+    def test_pid(self):
+        self.assertIsNone(sockstat.get_pid_listening_on_port(self.port))
+        self.server.listen(1)
+        self.assertEqual(os.getpid(), sockstat.get_pid_listening_on_port(self.port))
+
+    def test_shared_scan(self):
+        self.server.listen(1)
+        ports = sockstat.get_listening_ports()
+        self.assertIs(ports, sockstat.get_listening_ports(60))
+        self.assertIsNot(ports, sockstat.get_listening_ports())
+
+if __name__ == "__main__":
+    unittest.main()
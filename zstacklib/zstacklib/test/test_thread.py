@@ -7,6 +7,9 @@ import time
 import threading
 from ..utils.thread import ThreadFacade
 from ..utils.thread import AsyncThread
+from ..utils.thread import ThreadPool
+from ..utils.thread import ThreadPoolFullError
+from ..utils.thread import Coalescer
 
 
 class TestThreadFacade(unittest.TestCase):
@@ -34,6 +37,59 @@ class TestThreadFacade(unittest.TestCase):
         self.assertEqual("ok", self.async_ok)
         self.assertEqual("world", self.async_value)
 
+    def test_thread_pool(self):
+        pool = ThreadPool(2, 10, 'test')
+        self.pool_ok = []
+        for i in range(5):
+            pool.submit(self.pool_ok.append, i)
+        pool.join()
+        self.assertEqual([0, 1, 2, 3, 4], sorted(self.pool_ok))
+        self.assertEqual(2, len(pool.workers))
+        pool.shutdown()
+
+    def test_thread_pool_full(self):
+        pool = ThreadPool(1, 1, 'test')
+        event = threading.Event()
+        pool.submit(event.wait)
+        # give the only worker time to take the first task off the queue
+        time.sleep(0.5)
+        pool.submit(event.wait)
+        self.assertRaises(ThreadPoolFullError, pool.submit, event.wait)
+        event.set()
+        pool.join()
+        pool.shutdown()
+
+    def test_coalescer(self):
+        batches = []
+        def apply(items):
+            time.sleep(0.1)
+            if 'bad' in items:
+                raise Exception('bad item')
+            batches.append(items)
+
+        coalescer = Coalescer(apply)
+        errors = []
+        def submit(item):
+            try:
+                coalescer.submit(item)
+            except Exception as e:
+                errors.append((item, str(e)))
+
+        threads = [ThreadFacade.run_in_thread(submit, [i]) for i in range(10)]
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(range(10), sorted(sum(batches, [])))
+        self.assertTrue(len(batches) < 10)
+
+        # the failed batch is retried item by item
+        del batches[:]
+        threads = [ThreadFacade.run_in_thread(submit, [i]) for i in ['bad', 10, 11]]
+        for t in threads:
+            t.join()
+        self.assertEqual([('bad', 'bad item')], errors)
+        self.assertEqual([10, 11], sorted(sum(batches, [])))
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -25,6 +25,33 @@ class Test(unittest.TestCase):
             prettyXml = text_re.sub('>\g<1></', xmlstr)
             print prettyXml
 
+    def test_lazy(self):
+        xo = xmlobject.loads('<domain type="kvm"><name> vm1 </name><devices><disk device="disk"><target dev="vda"/></disk>'
+                             '<disk device="cdrom"><target dev="hdc"/></disk><graphics type="vnc" port="5900"/></devices>'
+                             '<os><boot dev="cdrom"/></os></domain>')
+        self.assertEqual('kvm', xo.type_)
+        self.assertEqual('vm1', xo.name.text_)
+        self.assertIsNone(xo.id__)
+        self.assertFalse(xo.hasattr('metadata'))
+        self.assertRaises(AttributeError, getattr, xo, 'metadata')
+        self.assertEqual(['vda', 'hdc'], [d.target.dev_ for d in xo.devices.get_child_node_as_list('disk')])
+        self.assertEqual('5900', xo.devices.get_child_node('graphics').port_)
+        self.assertEqual([], xo.devices.get_child_node_as_list('interface'))
+
+        # modify a node never read
+        boot = xmlobject.XmlObject('boot')
+        boot.put_attr('dev', 'hd')
+        xo.os.replace_node('boot', boot)
+        self.assertEqual('hd', xo.os.boot.dev_)
+        self.assertIn('<boot dev="hd"></boot>', xo.dump())
+
+    def test_dump(self):
+        xmlstr = '<domain type="kvm"><name>vm1</name><devices><disk device="disk" /><disk device="cdrom" /></devices></domain>'
+        xo = xmlobject.loads(xmlobject.loads(xmlstr).dump())
+        self.assertEqual('vm1', xo.name.text_)
+        self.assertEqual(['disk', 'cdrom'], [d.device_ for d in xo.devices.disk])
+        self.assertEqual(['devices', 'name'], sorted(xo.get_children_nodes().keys()))
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
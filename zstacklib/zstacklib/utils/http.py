@@ -5,6 +5,9 @@
 import copy
 import traceback
 import types
+import threading
+import collections
+import tempfile
 
 import cherrypy
 import thread
@@ -12,6 +15,7 @@ import logging
 import logging.handlers
 
 import urllib3
+import simplejson
 from zstacklib.utils import jsonobject
 from zstacklib.utils import log
 from zstacklib.utils import linux
@@ -21,6 +25,7 @@ ERROR_CODE = 'error'
 REQUEST_HEADER = 'header'
 REQUEST_BODY = 'body'
 CALLBACK_URI = 'callbackurl'
+BATCH_CALLBACK = 'batchcallback'
 
 logger = log.get_logger(__name__)
 
@@ -29,26 +34,65 @@ class SyncUri(object):
         self.uri = None
         self.func = None
         self.controller = None
+        # if True, the handler gets the request body as a file-like object
+        # spooled to disk instead of a string
+        self.stream_body = False
         
 class AsyncUri(SyncUri):
     def __init__(self):
+        super(AsyncUri, self).__init__()
         self.callback_uri = None
+        # max number of concurrent running handlers of this uri, None means
+        # only bounded by the worker pool of the http server
+        self.concurrency = None
+        self.server = None
 
 class Request(object):
+    # streamed bodies smaller than this stay in memory
+    STREAM_SPOOL_SIZE = 1024 * 1024
+    STREAM_CHUNK_SIZE = 64 * 1024
+
     def __init__(self):
         self.headers = None
         self.body = None
+        self.body_size = 0
+        self.streamed = False
         self.method = None
         self.query_string = None
     
     @staticmethod
-    def from_cherrypy_request(creq):
+    def from_cherrypy_request(creq, stream_body=False):
         req = Request()
         req.headers = copy.copy(creq.headers)
-        req.body = creq.body.fp.read() if creq.body else None
+        if not creq.body:
+            req.body = None
+        elif not stream_body:
+            req.body = creq.body.fp.read()
+            req.body_size = len(req.body)
+        else:
+            # the handler runs after cherrypy has finished the request, so the
+            # socket stream is copied chunk by chunk to a spooled file
+            req.streamed = True
+            req.body = tempfile.SpooledTemporaryFile(Request.STREAM_SPOOL_SIZE)
+            while True:
+                chunk = creq.body.fp.read(Request.STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                req.body.write(chunk)
+                req.body_size += len(chunk)
+            req.body.seek(0)
         req.method = copy.copy(creq.method)
         req.query_string = copy.copy(creq.query_string) if creq.query_string else None
         return req
+
+    def body_for_log(self):
+        if self.streamed:
+            return '[streamed body of %s bytes]' % self.body_size
+        return self.body
+
+    def close(self):
+        if self.streamed:
+            self.body.close()
         
 class SyncUriHandler(object):
     def _check_response(self, rsp):
@@ -71,18 +115,38 @@ class SyncUriHandler(object):
     
     @cherrypy.expose
     def index(self):
-        req = Request.from_cherrypy_request(cherrypy.request)
-        logger.debug('sync http call: %s' % req.body)
-        rsp = self._do_index(req)
+        req = Request.from_cherrypy_request(cherrypy.request, self.uri_obj.stream_body)
+        logger.debug('sync http call: %s' % req.body_for_log())
+        try:
+            rsp = self._do_index(req)
+        finally:
+            req.close()
         self._check_response(rsp)
         return rsp
         
 class AsyncUirHandler(SyncUriHandler):
     def __init__(self, uri_obj):
         super(AsyncUirHandler, self).__init__(uri_obj)
-    
-    @thread.AsyncThread
+        self.running = 0
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+
     def _run_index(self, task_uuid, request):
+        # the worker keeps the concurrency slot of the uri and drains calls
+        # parked by _dispatch() before giving it back
+        while True:
+            try:
+                self._do_run_index(task_uuid, request)
+            except Exception:
+                logger.warn('[WARN]: %s' % traceback.format_exc())
+
+            with self.lock:
+                if not self.pending:
+                    self.running -= 1
+                    return
+                (task_uuid, request) = self.pending.popleft()
+
+    def _do_run_index(self, task_uuid, request):
         callback_uri = self._get_callback_uri(request)
         headers = {TASK_UUID : task_uuid}
         try:
@@ -92,9 +156,28 @@ class AsyncUirHandler(SyncUriHandler):
             content = traceback.format_exc()
             logger.warn('[WARN]: %s]' % content)
             headers[ERROR_CODE] = content
+        finally:
+            request.close()
             
-        json_post(callback_uri, content, headers)
-        
+        self.uri_obj.server.post_callback(callback_uri, content, headers)
+
+    def _dispatch(self, task_uuid, request):
+        server = self.uri_obj.server
+        with self.lock:
+            if self.uri_obj.concurrency and self.running >= self.uri_obj.concurrency:
+                if len(self.pending) >= server.worker_queue_size:
+                    raise thread.ThreadPoolFullError('too many pending calls on uri[%s]' % self.uri_obj.uri)
+                self.pending.append((task_uuid, request))
+                return
+            self.running += 1
+
+        try:
+            server.worker_pool.submit(self._run_index, task_uuid, request)
+        except thread.ThreadPoolFullError:
+            with self.lock:
+                self.running -= 1
+            raise
+
     def _get_callback_uri(self, req):
         callback_uri = None
         if req.headers.has_key(CALLBACK_URI):
@@ -115,20 +198,85 @@ class AsyncUirHandler(SyncUriHandler):
             raise cherrypy.HTTPError(400, err)
         
         task_uuid = cherrypy.request.headers[TASK_UUID]
-        req = Request.from_cherrypy_request(cherrypy.request)
-        logger.debug('async http call[task uuid: %s], body: %s' % (task_uuid, req.body))
-        self._run_index(task_uuid, req)
+        req = Request.from_cherrypy_request(cherrypy.request, self.uri_obj.stream_body)
+        logger.debug('async http call[task uuid: %s], body: %s' % (task_uuid, req.body_for_log()))
+        try:
+            self._dispatch(task_uuid, req)
+        except thread.ThreadPoolFullError as e:
+            logger.warn('reject async http call[task uuid: %s], %s' % (task_uuid, str(e)))
+            raise cherrypy.HTTPError(503, str(e))
         
+class CallbackBatcher(object):
+    '''
+    coalesces async replies bound for the same callback uri. Replies are
+    flushed as one json array every interval seconds or as soon as
+    max_batch_size replies are queued for a uri, each element carries the
+    taskuuid/error headers of its task and the reply content as body
+    '''
+
+    def __init__(self, interval=0.1, max_batch_size=100):
+        self.interval = interval
+        self.max_batch_size = max_batch_size
+        self.replies = {}
+        self.cond = threading.Condition()
+        self.flusher = None
+
+    def _start_flusher(self):
+        with self.cond:
+            if self.flusher:
+                return
+            self.flusher = threading.Thread(target=self._flush_loop, name='callback-batcher')
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def post(self, uri, content, headers):
+        if not self.flusher:
+            self._start_flusher()
+
+        entry = {REQUEST_BODY: content}
+        entry.update(headers)
+        with self.cond:
+            replies = self.replies.setdefault(uri, [])
+            replies.append(entry)
+            if len(replies) >= self.max_batch_size:
+                self.cond.notify()
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait(self.interval)
+                batches = self.replies
+                self.replies = {}
+
+            for uri, replies in batches.items():
+                for i in range(0, len(replies), self.max_batch_size):
+                    self._flush(uri, replies[i:i + self.max_batch_size])
+
+    def _flush(self, uri, replies):
+        try:
+            json_post(uri, simplejson.dumps(replies), {BATCH_CALLBACK: str(len(replies))})
+        except Exception:
+            task_uuids = [r[TASK_UUID] for r in replies]
+            logger.warn('unable to post batch callback of tasks%s to %s\n%s' % (task_uuids, uri, linux.get_exception_stacktrace()))
+
 class HttpServer(object):
     '''
     classdocs
     '''
 
-    def __init__(self, port=7070, async_callback_uri = None):
+    DEFAULT_WORKER_POOL_SIZE = 100
+    DEFAULT_WORKER_QUEUE_SIZE = 1000
+
+    def __init__(self, port=7070, async_callback_uri = None, worker_pool_size=DEFAULT_WORKER_POOL_SIZE,
+                 worker_queue_size=DEFAULT_WORKER_QUEUE_SIZE):
         '''
         Constructor
         '''
         self.async_callback_uri = async_callback_uri
+        self.worker_pool_size = worker_pool_size
+        self.worker_queue_size = worker_queue_size
+        self.worker_pool = None
+        self.callback_batcher = None
         self.async_uri_handlers = {}
         self.sync_uri_handlers = {}
         self.server = None
@@ -137,9 +285,12 @@ class HttpServer(object):
         self.port = port
         self.mapper = None
     
-    def register_async_uri(self, uri, func, callback_uri=None):
+    def register_async_uri(self, uri, func, callback_uri=None, concurrency=None, stream_body=False):
         async_uri_obj = AsyncUri()
         async_uri_obj.callback_uri = callback_uri
+        async_uri_obj.concurrency = concurrency
+        async_uri_obj.stream_body = stream_body
+        async_uri_obj.server = self
         if async_uri_obj.callback_uri is None:
             async_uri_obj.callback_uri = self.async_callback_uri
         async_uri_obj.uri = uri
@@ -148,9 +299,19 @@ class HttpServer(object):
         
         self.async_uri_handlers[uri] = async_uri_obj
     
-    def register_sync_uri(self, uri, func):
+    def enable_callback_batching(self, interval_ms=100, max_batch_size=100):
+        self.callback_batcher = CallbackBatcher(interval_ms / 1000.0, max_batch_size)
+
+    def post_callback(self, callback_uri, content, headers):
+        if self.callback_batcher:
+            self.callback_batcher.post(callback_uri, content, headers)
+        else:
+            json_post(callback_uri, content, headers)
+
+    def register_sync_uri(self, uri, func, stream_body=False):
         sync_uri = SyncUri()
         sync_uri.func = func
+        sync_uri.stream_body = stream_body
         sync_uri.uri = uri 
         sync_uri.controller = SyncUriHandler(sync_uri)
         self.sync_uri_handlers[uri] = sync_uri
@@ -172,6 +333,8 @@ class HttpServer(object):
             logger.debug('function[%s] registered uri: %s' % (uri_obj.func.__name__, nuri))
         
     def _build(self):
+        self.worker_pool = thread.ThreadPool(self.worker_pool_size, self.worker_queue_size, 'http-worker')
+
         for akey in self.async_uri_handlers.keys():
             aval = self.async_uri_handlers[akey]
             self._add_mapping(aval)
@@ -221,27 +384,53 @@ class HttpServer(object):
     def stop(self):
         cherrypy.engine.exit()
 
+# callbacks to the management node reuse the connections of a process-wide
+# pool manager, which keeps one connection pool per callback host
+HTTP_CLIENT_NUM_POOLS = 10
+HTTP_CLIENT_POOL_SIZE = 20
+HTTP_CLIENT_CONNECT_TIMEOUT = 120.0
+HTTP_CLIENT_READ_TIMEOUT = 120.0
+
+_http_client = None
+_http_client_lock = threading.RLock()
+
+def configure_http_client(num_pools=HTTP_CLIENT_NUM_POOLS, pool_size=HTTP_CLIENT_POOL_SIZE,
+                          connect_timeout=HTTP_CLIENT_CONNECT_TIMEOUT, read_timeout=HTTP_CLIENT_READ_TIMEOUT):
+    global _http_client
+    with _http_client_lock:
+        old = _http_client
+        _http_client = urllib3.PoolManager(num_pools=num_pools, maxsize=pool_size,
+                                           timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout))
+    if old:
+        old.clear()
+
+def _get_http_client():
+    if not _http_client:
+        with _http_client_lock:
+            if not _http_client:
+                configure_http_client()
+    return _http_client
+
 def json_post(uri, body=None, headers={}, method='POST', fail_soon=False):
     ret = []
     def post(_):
         try:
-            pool = urllib3.PoolManager(timeout=120.0, retries=urllib3.util.retry.Retry(15))
-            header = {'Content-Type': 'application/json', 'Connection': 'close'}
+            pool = _get_http_client()
+            header = {'Content-Type': 'application/json'}
             for k in headers.keys():
                 header[k] = headers[k]
 
             if body is not None:
                 assert isinstance(body, types.StringType)
                 header['Content-Length'] = str(len(body))
-                content = pool.urlopen(method, uri, headers=header, body=str(body)).data
+                content = pool.urlopen(method, uri, headers=header, body=str(body), retries=urllib3.util.retry.Retry(15)).data
 
                 #(resp, content) = http_obj.request(uri, 'POST', body='%s' % body, headers=header)
             else:
                 header['Content-Length'] = '0'
                 #(resp, content) = http_obj.request(uri, 'POST', headers=header)
-                content = pool.urlopen(method, uri, headers=header).data
+                content = pool.urlopen(method, uri, headers=header, retries=urllib3.util.retry.Retry(15)).data
 
-            pool.clear()
             ret.append(content)
             return True
         except Exception as e:
@@ -0,0 +1,69 @@
+import os
+from zstacklib.utils import shell
+from zstacklib.utils import linux
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+# ipset limits set names to 31 characters, the suffix of the swap set must fit
+MAX_SET_NAME_LEN = 26
+TMP_SET_SUFFIX = '-tmp'
+
+class IPSetError(Exception):
+    '''ipset error'''
+
+def is_ipset_available():
+    return shell.run('ipset -v > /dev/null 2>&1') == 0
+
+def list_set_names():
+    out = shell.call('ipset list -n')
+    return [l.strip() for l in out.split('\n') if l.strip()]
+
+def _restore(content):
+    f = linux.write_to_temp_file(content)
+    try:
+        shell.call('ipset restore < %s' % f)
+    except Exception as e:
+        err = '''Failed to apply ipset:
+shell error description:
+%s
+ipset content:
+%s
+''' % (str(e), content)
+        raise IPSetError(err)
+    finally:
+        os.remove(f)
+
+def sync_sets(sets, set_type='hash:net'):
+    '''
+    replace members of each set in sets (set name -> list of ips, cidrs or
+    ip ranges) atomically, missing sets are created. All sets are synced in
+    one 'ipset restore'
+    '''
+    if not sets:
+        return
+
+    lst = []
+    for name, members in sets.items():
+        if len(name) > MAX_SET_NAME_LEN:
+            raise IPSetError('ipset name[%s] is longer than %s characters' % (name, MAX_SET_NAME_LEN))
+
+        tmp_name = name + TMP_SET_SUFFIX
+        lst.append('create %s %s -exist' % (name, set_type))
+        lst.append('create %s %s -exist' % (tmp_name, set_type))
+        lst.append('flush %s' % tmp_name)
+        for m in members:
+            lst.append('add %s %s -exist' % (tmp_name, m))
+        lst.append('swap %s %s' % (tmp_name, name))
+        lst.append('destroy %s' % tmp_name)
+    lst.append('')
+
+    _restore('\n'.join(lst))
+
+def destroy_sets(names):
+    if not names:
+        return
+
+    lst = ['destroy %s' % n for n in names]
+    lst.append('')
+    _restore('\n'.join(lst))
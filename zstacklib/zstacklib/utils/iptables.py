@@ -3,6 +3,15 @@
 @author: frank
 '''
 import os
+import re
+import errno
+import socket
+import struct
+import hashlib
+import ctypes
+import ctypes.util
+import threading
+import collections
 from zstacklib.utils import shell
 from zstacklib.utils import linux
 from zstacklib.utils import log
@@ -24,6 +33,13 @@ class Node(object):
     def add_child(self, node):
         self.children.append(node)
         node.parent = self
+        self._child_added(node)
+
+    def _child_added(self, node):
+        pass
+
+    def _child_removed(self, node):
+        pass
     
     def get_child_by_name(self, name):
         for c in self.children:
@@ -41,11 +57,13 @@ class Node(object):
         pos = self.children.index(n1)
         self.children.insert(pos-1, n2)
         n2.parent = self
+        self._child_added(n2)
         
     def insert_child_after(self, n1, n2):
         pos = self.children.index(n1)
         self.children.insert(pos+1, n2)
         n2.parent = self
+        self._child_added(n2)
     
     def insert_child_all_after_by_name(self, name, node):
         n = self.search_by_name(name)
@@ -76,12 +94,14 @@ class Node(object):
         if c:
             self.children.remove(c)
             c.parent = None
+            self._child_removed(c)
     
     def delete_child_by_identity(self, identity):
         c = self.get_child_by_identity(identity)
         if c:
             self.children.remove(c)
             c.parent = None
+            self._child_removed(c)
     
     def walk(self, callback, data=None):
         def do_walk(node):
@@ -131,8 +151,10 @@ class Node(object):
     
     def delete(self):
         if self.parent:
-            self.parent.children.remove(self)
+            parent = self.parent
+            parent.children.remove(self)
             self.parent = None
+            parent._child_removed(self)
     
     def __str__(self):
         return self.identity
@@ -140,6 +162,26 @@ class Node(object):
 class IPTableTable(Node):
     def __init__(self):
         super(IPTableTable, self).__init__()
+        # chain name -> chain
+        self._chains = {}
+
+    def get_child_by_name(self, name):
+        return self._chains.get(name)
+
+    def _child_added(self, chain):
+        self._chains[chain.name] = chain
+        if self.parent:
+            self.parent._version += 1
+            for r in chain.children:
+                self.parent._index_rule(self, r)
+
+    def _child_removed(self, chain):
+        if self._chains.get(chain.name) is chain:
+            del self._chains[chain.name]
+        if self.parent:
+            self.parent._version += 1
+            for r in chain.children:
+                self.parent._unindex_rule(self, r)
         
     def __str__(self):
         # if the chain has been deleted, don't add the its counter
@@ -160,8 +202,25 @@ class IPTableChain(Node):
         super(IPTableChain, self).__init__()
         self.counter_str = None
     
+    def _root(self):
+        return self.parent.parent if self.parent else None
+
+    def _child_added(self, rule):
+        root = self._root()
+        if root:
+            root._index_rule(self.parent, rule)
+
+    def _child_removed(self, rule):
+        root = self._root()
+        if root:
+            root._unindex_rule(self.parent, rule)
+
     def delete_all_rules(self):
+        rules = self.children
         self.children = []
+        for r in rules:
+            r.parent = None
+            self._child_removed(r)
     
     def __str__(self):
         if not self.children:
@@ -190,6 +249,11 @@ class IPTableRule(Node):
         return self.identity
 
 class IPTables(Node):
+    BUILTIN_CHAIN_NAMES = ['INPUT', 'FORWARD', 'OUTPUT', 'PREROUTING', 'POSTROUTING']
+
+    # apply only chains changed since iptables-save, see iptable_restore()
+    DIFF_APPLY = True
+
     NAT_TABLE_NAME = 'nat'
     FILTER_TABLE_NAME = 'filter'
     MANGLE_TABLE_NAME = 'mangle'
@@ -205,6 +269,52 @@ class IPTables(Node):
         self._mangle_table = None
         self._raw_table = None
         self._security_table = None
+        # table name -> {chain name -> rules}, the state of the kernel when
+        # the model was parsed or last restored
+        self._baseline = None
+        # rule identity -> {id(rule) -> rule}
+        self._rules = {}
+        # (table name, user chain) -> {id(rule) -> rule} jumping to the chain,
+        # builtin targets like ACCEPT or RETURN are not indexed
+        self._targets = {}
+        # bumped on every change, tells IPTablesCache a model was modified
+        # without being restored
+        self._version = 0
+        self._cache = None
+
+    def _child_added(self, table):
+        self._version += 1
+        for c in table.children:
+            for r in c.children:
+                self._index_rule(table, r)
+
+    def _child_removed(self, table):
+        self._version += 1
+        for c in table.children:
+            for r in c.children:
+                self._unindex_rule(table, r)
+
+    def _index_rule(self, table, rule):
+        self._version += 1
+        self._rules.setdefault(rule.identity, collections.OrderedDict())[id(rule)] = rule
+        target = self.find_target_chain_name_in_rule(rule.identity)
+        if target:
+            self._targets.setdefault((table.name, target), collections.OrderedDict())[id(rule)] = rule
+
+    def _unindex_rule(self, table, rule):
+        self._version += 1
+        def remove(index, key):
+            rules = index.get(key)
+            if not rules:
+                return
+            rules.pop(id(rule), None)
+            if not rules:
+                del index[key]
+
+        remove(self._rules, rule.identity)
+        target = self.find_target_chain_name_in_rule(rule.identity)
+        if target:
+            remove(self._targets, (table.name, target))
     
     def get_table(self, table_name=FILTER_TABLE_NAME):
         return self.get_child_by_name(table_name)
@@ -304,6 +414,40 @@ class IPTables(Node):
         commit.setParseAction(self._parse_commit_action)
         
         self._parser = table | counter | comment | rule | commit
+
+    def _parse_line(self, l):
+        # lines of iptables-save are tokenized by hand as pyparsing is too
+        # slow for hosts having tens of thousands rules, the grammar above
+        # only handles lines not in the form iptables-save writes
+        c = l[0]
+        if c == '-' and l.startswith('-A '):
+            tokens = l.split(None, 2)
+            tokens[0] = '-A'
+            self._parse_rule_action(tokens)
+            return
+
+        if c == ':':
+            tokens = l[1:].split(None, 1)
+            if tokens and not l[1].isspace():
+                # keep the separator pyparsing leaves in restOfLine
+                rest = l[1 + len(tokens[0]):]
+                self._parse_counter_action([':', tokens[0], rest])
+                return
+
+        elif c == '#':
+            return
+
+        elif c == '*':
+            if l[1:].isalpha():
+                self._parse_table_action(['*', l[1:]])
+                return
+
+        elif l == 'COMMIT':
+            self._parse_commit_action([l])
+            return
+
+        self._construct_pyparsing()
+        self._parser.parseString(l)
         
     @staticmethod
     def find_target_in_rule(rule):
@@ -337,6 +481,8 @@ class IPTables(Node):
         
     def _reset(self):
         self.children = []
+        self._rules = {}
+        self._targets = {}
         self._current_table = None
         self._nat_table = None
         self._filter_table = None
@@ -344,13 +490,27 @@ class IPTables(Node):
         
     def _from_iptables_save(self, txt):
         self._reset()
-        self._construct_pyparsing()
         for l in txt.split('\n'):
-            l = l.strip('\n').strip('\r').strip('\t').strip()
+            l = l.strip()
             if not l:
                 continue
             
-            self._parser.parseString(l)
+            self._parse_line(l)
+
+        self._baseline = {}
+        for table in self.children:
+            self._baseline[table.name] = dict([(c.name, [r.identity for r in c.children]) for c in table.children])
+
+    def _snapshot(self):
+        # the chains and rules as they are written to iptables-restore
+        snapshot = {}
+        for table in self.children:
+            chains = {}
+            for chain in table.children:
+                cstr = str(chain)
+                chains[chain.name] = cstr.split('\n') if cstr else []
+            snapshot[table.name] = chains
+        return snapshot
     
     def iptables_save(self):
         out = shell.call('/sbin/iptables-save')
@@ -366,14 +526,7 @@ class IPTables(Node):
     
     def _cleanup_empty_chain(self):
         def _is_chain_not_targeted(chain,table):
-            need_deleted = True
-            for chain2 in table.children:
-                if chain2.children:
-                    for rule1 in chain2.children:
-                        if IPTables.is_target_in_rule(rule1,chain.name):
-                            need_deleted = False
-                            break
-            return need_deleted
+            return not self._targets.get((table.name, chain.name))
     
         def _clean_chain_having_no_rules():
             chains_to_delete = []
@@ -395,23 +548,18 @@ class IPTables(Node):
             
         
         def _clean_rule_having_stale_target_chain():
-            alive_chain_names = []
+            alive_chain_names = set()
             for t in self.children:
                 for c in t.children:
-                    alive_chain_names.append(c.name)
+                    alive_chain_names.add(c.name)
 
-            def walker(rule, data):
-                if not isinstance(rule, IPTableRule):
-                    return False
-                
-                chain_name = self.find_target_chain_name_in_rule(rule.identity)
-                if chain_name and (chain_name not in alive_chain_names):
-                    return True
-                
-                return False
-                
+            rules = []
+            for (table_name, target), lst in self._targets.items():
+                if target in alive_chain_names:
+                    continue
+                rules.extend(lst.values())
 
-            return self.walk_all(walker, None)
+            return rules
         
         empty_chain_names = _clean_chain_having_no_rules()
         logger.debug('removed empty chains:%s' % empty_chain_names)
@@ -468,7 +616,7 @@ class IPTables(Node):
         for cname in to_del:
             table.delete_child_by_name(cname)
 
-    def _to_iptables_string(self, marshall_func=None, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
+    def _prepare_restore(self, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
         self._cleanup_empty_chain()
 
         if sort_filter_func:
@@ -488,17 +636,64 @@ class IPTables(Node):
         for c in self._filter_table.children:
             c.children = sorted(c.children, make_reject_rule_last)
 
+    def _to_iptables_string(self, marshall_func=None, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
+        self._prepare_restore(sort_nat_func, sort_filter_func, sort_mangle_func)
+
         content = str(self)
         if marshall_func:
             content = marshall_func(content)
 
         return content
 
-    def iptable_restore(self, marshall_func=None, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
-        content = self._to_iptables_string(marshall_func, sort_nat_func, sort_filter_func, sort_mangle_func)
+    def _to_iptables_diff_string(self, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
+        '''
+        returns the input of 'iptables-restore --noflush' rewriting only the
+        chains differing from the baseline, and the new baseline. The content
+        is None if nothing changed
+        '''
+        self._prepare_restore(sort_nat_func, sort_filter_func, sort_mangle_func)
+
+        lst = []
+        baseline = self._snapshot()
+        for table in self.children:
+            old_chains = self._baseline.get(table.name, {})
+            new_chains = baseline[table.name]
+            declares = []
+            rules = []
+            for chain in table.children:
+                crules = new_chains[chain.name]
+                if old_chains.get(chain.name) == crules:
+                    continue
+
+                # with --noflush, declaring an existing user chain flushes it
+                # while built-in chains have to be flushed explicitly
+                if chain.name in self.BUILTIN_CHAIN_NAMES:
+                    declares.append('-F %s' % chain.name)
+                else:
+                    declares.append(':%s - [0:0]' % chain.name)
+                rules.extend(crules)
+
+            deleted = [c for c in old_chains.keys() if c not in new_chains and c not in self.BUILTIN_CHAIN_NAMES]
+            if not declares and not deleted:
+                continue
+
+            lst.append(table.identity)
+            lst.extend(declares)
+            lst.extend(['-F %s' % c for c in deleted])
+            lst.extend(rules)
+            lst.extend(['-X %s' % c for c in deleted])
+            lst.append('COMMIT')
+
+        if not lst:
+            return None, baseline
+
+        lst.append('')
+        return '\n'.join(lst), baseline
+
+    def _restore(self, content, noflush=False):
         f = linux.write_to_temp_file(content)
         try:
-            shell.call('/sbin/iptables-restore < %s' % f)
+            shell.call('/sbin/iptables-restore %s < %s' % ('--noflush' if noflush else '', f))
         except Exception as e:
             err ='''Failed to apply iptables rules:
 shell error description:
@@ -509,6 +704,23 @@ iptable rules:
             raise IPTablesError(err)
         finally:
             os.remove(f)
+
+    def iptable_restore(self, marshall_func=None, sort_nat_func=None, sort_filter_func=None, sort_mangle_func=None):
+        # a model parsed from iptables-save only rewrites the chains it
+        # changed, the tables are replaced as a whole otherwise
+        if self.DIFF_APPLY and self._baseline is not None and not marshall_func:
+            content, baseline = self._to_iptables_diff_string(sort_nat_func, sort_filter_func, sort_mangle_func)
+            if content:
+                self._restore(content, noflush=True)
+            self._baseline = baseline
+        else:
+            content = self._to_iptables_string(marshall_func, sort_nat_func, sort_filter_func, sort_mangle_func)
+            self._restore(content)
+            # the content written is unknown if it's marshalled
+            self._baseline = self._snapshot() if not marshall_func else None
+
+        if self._cache:
+            self._cache.put(self)
             
     @staticmethod
     def from_iptables_save():
@@ -524,22 +736,40 @@ iptable rules:
             raise IPTablesError('unknown table name[%s]' % table_name)
         
         self._create_table_if_not_exists(table_name)
-        chain_name = Word(printables + '-_+=%$#')
-        rule_p = Word('-A') + chain_name + restOfLine
-        res = rule_p.parseString(rule)
-        self._add_rule(res[1], rule, order)
+        tokens = rule.split(None, 2)
+        if len(tokens) < 2 or tokens[0] != '-A':
+            chain_name = Word(printables + '-_+=%$#')
+            rule_p = Word('-A') + chain_name + restOfLine
+            tokens = rule_p.parseString(rule)
+
+        # callers re-add the rules they need on every apply, keep one copy
+        for r in self._rules.get(self._normalize_rule(rule), {}).values():
+            if r.parent and r.parent.name == tokens[1] and r.parent.parent.name == table_name:
+                return
+
+        self._add_rule(tokens[1], rule, order)
     
     def remove_rule(self, rule_str):
-        rule_str = self._normalize_rule(rule_str)
-        self.delete_all_by_identity(rule_str)
+        for r in self.search_all_rule(rule_str):
+            r.delete()
     
     def search_all_rule(self, rule_str):
         rule_str = self._normalize_rule(rule_str)
-        return self.search_all_by_identity(rule_str)
+        return self._rules.get(rule_str, {}).values()
         
     def search_rule(self, rule_str):
-        rule_str = self._normalize_rule(rule_str)
-        return self.search_by_identity(rule_str)
+        rules = self.search_all_rule(rule_str)
+        return rules[0] if rules else None
+
+    def search_rules_by_target(self, target, table_name=FILTER_TABLE_NAME):
+        if not target.isupper():
+            return self._targets.get((table_name, target), {}).values()
+
+        # builtin targets are not indexed
+        table = self.get_child_by_name(table_name)
+        if not table:
+            return []
+        return [r for c in table.children for r in c.children if self.is_target_in_rule(r, target)]
     
     def delete_chain(self, chain_name, table_name=FILTER_TABLE_NAME):
         table = self.get_child_by_name(table_name)
@@ -547,7 +777,270 @@ iptable rules:
             return
         table.delete_child_by_name(chain_name)
 
-def from_iptables_save():
+    def _set_chain_rules(self, chain_name, rules, table_name=FILTER_TABLE_NAME):
+        # replaces the rules of a chain parsed from iptables-save by the same
+        # rules as they were written to the kernel
+        chain = self.get_chain(chain_name, table_name)
+        if not chain or self._baseline is None:
+            return
+
+        chain.delete_all_rules()
+        for identity in rules:
+            rule = IPTableRule()
+            rule.name = identity
+            rule.identity = identity
+            chain.add_child(rule)
+        self._baseline.setdefault(table_name, {})[chain_name] = list(rules)
+
+# IPT_SO_GET_INFO and IPT_SO_GET_ENTRIES of linux/netfilter_ipv4/ip_tables.h
+IPT_SO_GET_INFO = 64
+IPT_SO_GET_ENTRIES = 65
+
+class _IptGetInfo(ctypes.Structure):
+    _fields_ = [
+        ('name', ctypes.c_char * 32),
+        ('valid_hooks', ctypes.c_uint),
+        ('hook_entry', ctypes.c_uint * 5),
+        ('underflow', ctypes.c_uint * 5),
+        ('num_entries', ctypes.c_uint),
+        ('size', ctypes.c_uint),
+    ]
+
+class _IptGetEntries(ctypes.Structure):
+    _fields_ = [
+        ('name', ctypes.c_char * 32),
+        ('size', ctypes.c_uint),
+        # struct ipt_entry entrytable[0], aligned as its 64-bit counters
+        ('entrytable', ctypes.c_uint64 * 0),
+    ]
+
+# offsets in struct ipt_entry and struct xt_entry_target
+_IPT_ENTRY_TARGET_OFFSET = 88
+_IPT_ENTRY_NEXT_OFFSET = 90
+_IPT_ENTRY_COMEFROM = 92
+_IPT_ENTRY_SIZE = 112
+_XT_TARGET_NAME = 2
+_XT_TARGET_DATA = 32
+_XT_STANDARD_TARGET_SIZE = 40
+_XT_ERROR_TARGET = 'ERROR'
+
+# chains of the hooks in the order of valid_hooks and hook_entry
+_HOOK_CHAIN_NAMES = ['PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'POSTROUTING']
+
+_libc = None
+
+def _get_entries(s, name):
+    # returns the rules of the table as the kernel keeps them and the info of
+    # the table, or None if the table is not in kernel
+    for i in range(3):
+        info = _IptGetInfo()
+        info.name = name
+        size = ctypes.c_uint(ctypes.sizeof(info))
+        if _libc.getsockopt(s.fileno(), socket.IPPROTO_IP, IPT_SO_GET_INFO, ctypes.byref(info), ctypes.byref(size)) != 0:
+            if ctypes.get_errno() == errno.ENOENT:
+                return None
+            raise IPTablesError('unable to get info of iptables table[%s], %s' % (name, os.strerror(ctypes.get_errno())))
+
+        buf = ctypes.create_string_buffer(ctypes.sizeof(_IptGetEntries) + info.size)
+        entries = _IptGetEntries.from_buffer(buf)
+        entries.name = name
+        entries.size = info.size
+        size = ctypes.c_uint(len(buf))
+        if _libc.getsockopt(s.fileno(), socket.IPPROTO_IP, IPT_SO_GET_ENTRIES, buf, ctypes.byref(size)) == 0:
+            return bytearray(buf.raw[ctypes.sizeof(_IptGetEntries):]), info
+        if ctypes.get_errno() != errno.EAGAIN:
+            raise IPTablesError('unable to get entries of iptables table[%s], %s' % (name, os.strerror(ctypes.get_errno())))
+        # the table changed between the two calls
+
+    raise IPTablesError('iptables table[%s] keeps changing' % name)
+
+def _chain_digests(entries, info):
+    '''
+    returns {chain name -> digest of its rules} of the entries of a table.
+    The counters, which change all the time, are left out. A jump to a user
+    chain is kept by the kernel as the offset of the chain in the table, it's
+    hashed as the name of the chain instead, so a chain changed elsewhere in
+    the table doesn't change the digests of the chains jumping to others
+    '''
+    def target_of(offset):
+        target = offset + struct.unpack_from('H', entries, offset + _IPT_ENTRY_TARGET_OFFSET)[0]
+        name = str(entries[target + _XT_TARGET_NAME:target + _XT_TARGET_DATA]).split('\0')[0]
+        return target, name
+
+    # (offset, size) of each rule
+    rules = []
+    offset = 0
+    while offset + _IPT_ENTRY_SIZE <= len(entries):
+        size = struct.unpack_from('H', entries, offset + _IPT_ENTRY_NEXT_OFFSET)[0]
+        if not size:
+            break
+        rules.append((offset, size))
+        offset += size
+
+    # a built-in chain starts at the entry of its hook, a user chain at an
+    # ERROR entry naming it. The table ends with an ERROR entry named ERROR
+    starts = {}
+    for hook, chain_name in enumerate(_HOOK_CHAIN_NAMES):
+        if info.valid_hooks & (1 << hook):
+            starts[info.hook_entry[hook]] = chain_name
+    jumps = {}
+    for offset, size in rules:
+        target, name = target_of(offset)
+        if name == _XT_ERROR_TARGET:
+            chain_name = str(entries[target + _XT_TARGET_DATA:offset + size]).split('\0')[0]
+            starts[offset] = chain_name
+            jumps[offset + size] = chain_name
+
+    md5s = {}
+    md5 = None
+    zero = bytearray(_IPT_ENTRY_SIZE - _IPT_ENTRY_COMEFROM)
+    for offset, size in rules:
+        chain_name = starts.get(offset)
+        if chain_name == _XT_ERROR_TARGET:
+            break
+        if chain_name:
+            md5 = md5s[chain_name] = hashlib.md5()
+        if md5 is None:
+            continue
+
+        rule = entries[offset:offset + size]
+        rule[_IPT_ENTRY_COMEFROM:_IPT_ENTRY_SIZE] = zero
+        target, name = target_of(offset)
+        target -= offset
+        if not name and struct.unpack_from('H', rule, target)[0] == _XT_STANDARD_TARGET_SIZE:
+            verdict = struct.unpack_from('i', rule, target + _XT_TARGET_DATA)[0]
+            if verdict >= 0:
+                # a jump, or the offset of the next rule for a rule without
+                # target
+                struct.pack_into('i', rule, target + _XT_TARGET_DATA, 0)
+                md5.update(jumps.get(verdict, '%+d' % (verdict - offset)))
+        md5.update(rule)
+
+    return dict([(chain_name, m.hexdigest()) for chain_name, m in md5s.items()])
+
+def _is_nft_backend():
+    # iptables-save of the nf_tables backend is xtables-nft-multi or a link
+    # to it, its rules are not in the tables IPT_SO_GET_ENTRIES reads
+    return 'nft' in os.path.basename(os.path.realpath('/sbin/iptables-save'))
+
+def _get_table_digests(table_names):
+    '''
+    returns {table name -> {chain name -> digest of its rules}} read from the
+    kernel the way iptables-save does, without forking anything. Any change
+    of a rule but its counters changes the digest of its chain. A table not
+    in kernel maps to None. Returns None if the kernel can't be asked, or if
+    iptables uses the nf_tables backend whose rules can't be read this way
+    '''
+    global _libc
+    if _is_nft_backend():
+        return None
+
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+    except socket.error as e:
+        logger.debug('unable to open raw socket to read iptables, %s' % str(e))
+        return None
+
+    try:
+        ret = {}
+        for name in table_names:
+            table = _get_entries(s, name)
+            ret[name] = _chain_digests(*table) if table is not None else None
+        return ret
+    except IPTablesError as e:
+        logger.debug(str(e))
+        return None
+    finally:
+        s.close()
+
+class IPTablesCache(object):
+    '''
+    keeps the model restored by this process, so the next caller doesn't have
+    to fork iptables-save and parse its output. The model is trusted to be
+    what the kernel has after its own restore, it's reused as long as the
+    rules the kernel has, counters aside, are the same as after the restore.
+
+    Otherwise the model is parsed from iptables-save again, but the chains
+    the kernel still has as the restore wrote them keep the rules as they
+    were written, iptables-save prints many rules in another way. Callers
+    comparing rules of a chain to the ones they would write see the chains
+    changed by others only.
+
+    With the nf_tables backend of iptables nothing is cached, every caller
+    gets a model parsed from iptables-save
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ipt = None
+        self._digests = None
+        self._baseline = None
+        self._version = None
+
+    def invalidate(self):
+        with self._lock:
+            self._ipt = None
+            self._digests = None
+            self._baseline = None
+
+    def _get_table_digests(self, ipt):
+        return _get_table_digests(sorted([t.name for t in ipt.children]))
+
+    def get(self):
+        with self._lock:
+            # the model is handed to one caller at a time until it's restored
+            ipt = self._ipt
+            digests = self._digests
+            baseline = self._baseline
+            version = self._version
+            self._ipt = None
+
+        if ipt is None:
+            ipt = IPTables.from_iptables_save()
+        else:
+            current = self._get_table_digests(ipt)
+            if ipt._version != version or current != digests:
+                logger.debug('iptables changed since the last restore, reparse it')
+                ipt = IPTables.from_iptables_save()
+                if current:
+                    self._keep_unchanged_chains(ipt, baseline, digests, current)
+
+        ipt._cache = self
+        return ipt
+
+    def _keep_unchanged_chains(self, ipt, baseline, digests, current):
+        for table_name, chains in digests.items():
+            current_chains = current.get(table_name) or {}
+            for chain_name, digest in (chains or {}).items():
+                rules = baseline.get(table_name, {}).get(chain_name)
+                if rules is not None and current_chains.get(chain_name) == digest:
+                    ipt._set_chain_rules(chain_name, rules, table_name)
+
+    def put(self, ipt):
+        '''
+        called after ipt was restored
+        '''
+        # the content written is unknown if it's marshalled
+        digests = self._get_table_digests(ipt) if ipt._baseline is not None else None
+        with self._lock:
+            self._ipt = ipt if digests is not None else None
+            self._digests = digests
+            self._baseline = ipt._baseline
+            self._version = ipt._version
+
+_cache = IPTablesCache()
+
+def from_iptables_save(cached=False):
+    '''
+    returns the model of the current rules. With cached=True the model
+    restored last by this process is reused unless the rules have been
+    changed outside of it. Only callers changing iptables through the model
+    alone should pass it
+    '''
+    if cached:
+        return _cache.get()
     return IPTables.from_iptables_save()
 
 def insert_single_rule_to_filter_table(rule):
@@ -68,55 +68,122 @@ def _to_proper_type(val):
         return str(val)
     
     
-def _parse_list(lst):
-    vals = []
-    for l in lst:
-        if _is_unsupported_type(l):
-            raise NoneSupportedTypeError("Cannot parse object: %s, type: %s, list dump: %s" % (l, type(l), lst))
-            
-        if _is_primitive_types(l):
-            vals.append(l)
-        elif isinstance(l, types.DictType):
-            dobj = _parse_dict(l)
-            vals.append(dobj)
-        elif isinstance(l, types.ListType):
-            lobj = _parse_list(l)
-            vals.append(lobj)
-        else:
-            raise NoneSupportedTypeError("Cannot parse object: %s, type: %s, list dump: %s" % (l, type(l), lst))
-    return vals
-        
-def _parse_dict(d): 
-    dobj = JsonObject()
-    for key in d.keys():
-        val = d[key]
-        if _is_unsupported_type(val):
-            raise NoneSupportedTypeError("Cannot parse object: %s, type: %s, dict dump: %s" % (val, type(val), d))
-            
-        if _is_primitive_types(val):
-            setattr(dobj, key, val)    
-        elif isinstance(val, types.ListType):
-            lst = _parse_list(val)
-            setattr(dobj, key, lst)
-        elif isinstance(val, types.DictType):
-            nobj = _parse_dict(val)
-            setattr(dobj, key, nobj)
-        else:
-            raise NoneSupportedTypeError("Cannot parse object: %s, type: %s, dict dump: %s" % (val, type(val), d))
-        
+def _to_json_object(d):
+    # simplejson calls this for every json object it decodes, the decoded dict
+    # becomes the __dict__ of the JsonObject so no per key setattr is needed
+    dobj = JsonObject.__new__(JsonObject)
+    dobj.__dict__ = d
     return dobj
-            
+
 def loads(jstr):
     try:
-        root = simplejson.loads(jstr)
+        return simplejson.loads(jstr, object_hook=_to_json_object)
     except Exception as e:
         raise  NoneSupportedTypeError("Cannot compile string: %s to a jsonobject" % jstr)
-    if isinstance(root, types.DictType):
-        return _parse_dict(root)
-    if isinstance(root, types.ListType):
-        return _parse_list(root)
-    else:
-        return root
+
+class JsonArrayStream(object):
+    '''
+    iterates the elements of the array stored under the top level key of a
+    json object read from a file-like object, without loading the whole
+    document. Elements are decoded one by one as JsonObject, the other top
+    level keys are available in 'fields' once the stream has been iterated
+    '''
+
+    CHUNK_SIZE = 64 * 1024
+    WHITESPACES = ' \t\r\n'
+
+    def __init__(self, fp, key, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.key = key
+        self.chunk_size = chunk_size
+        self.fields = None
+        self._decoder = simplejson.JSONDecoder(object_hook=_to_json_object)
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+
+        # read at least as much as what is buffered, so a large element is
+        # re-decoded a logarithmic number of times
+        data = self.fp.read(max(self.chunk_size, len(self._buf) - self._pos))
+        if not data:
+            self._eof = True
+            return False
+
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in self.WHITESPACES:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise NoneSupportedTypeError('unexpected end of json stream, key: %s' % self.key)
+
+    def _next_char(self, expected):
+        c = self._peek()
+        if c not in expected:
+            raise NoneSupportedTypeError("expecting one of '%s' but got '%s' in json stream, key: %s" % (expected, c, self.key))
+        self._pos += 1
+        return c
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                val, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number at the end of the buffer may be truncated
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return val
+            except simplejson.JSONDecodeError as e:
+                if self._eof:
+                    raise NoneSupportedTypeError('cannot decode json stream, key: %s, %s' % (self.key, str(e)))
+
+            self._fill()
+
+    def __iter__(self):
+        if hasattr(self.fp, 'seek'):
+            self.fp.seek(0)
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+        fields = {}
+        self._next_char('{')
+        if self._peek() == '}':
+            self._pos += 1
+        else:
+            while True:
+                key = self._decode()
+                self._next_char(':')
+                if key != self.key:
+                    fields[key] = self._decode()
+                else:
+                    self._next_char('[')
+                    if self._peek() == ']':
+                        self._pos += 1
+                    else:
+                        while True:
+                            yield self._decode()
+                            if self._next_char(',]') == ']':
+                                break
+
+                if self._next_char(',}') == '}':
+                    break
+
+        self.fields = _to_json_object(fields)
+
+    def load_fields(self):
+        for _ in self:
+            pass
+        return self.fields
 
 def _new_json_object():
     return JsonObject()
@@ -133,25 +200,32 @@ def _is_unsupported_type(obj):
 def _is_primitive_types(obj):
     return isinstance(obj, (types.BooleanType, types.LongType, types.IntType, types.FloatType, types.StringType, types.UnicodeType))
 
+_PRIMITIVE_TYPES = frozenset([types.BooleanType, types.LongType, types.IntType, types.FloatType, types.StringType, types.UnicodeType])
+
+def _dump_value(val):
+    # most values are exact primitive types, check them without walking the
+    # isinstance() chains
+    t = type(val)
+    if t in _PRIMITIVE_TYPES or t is types.DictType:
+        return val
+    if t is types.ListType:
+        return _dump_list(val)
+
+    if _is_primitive_types(val) or isinstance(val, types.DictType):
+        return val
+    elif isinstance(val, types.ListType):
+        return _dump_list(val)
+    else:
+        return _dump(val)
+
 def _dump_list(lst):
     nlst = []
     for val in lst:
-        if _is_unsupported_type(val):
+        if val is None:
+            continue
+        if type(val) not in _PRIMITIVE_TYPES and _is_unsupported_type(val):
             raise NoneSupportedTypeError('Cannot dump val: %s, type: %s, list dump: %s' % (val, type(val), lst))
-        
-        if _is_primitive_types(val):
-            nlst.append(val)
-        elif isinstance(val, types.DictType):
-            nlst.append(val)
-        elif isinstance(val, types.ListType):        
-            tlst = _dump_list(val)
-            nlst.append(tlst)
-        elif isinstance(val, types.NoneType):
-            pass
-        else:
-            nmap = _dump(val)
-            nlst.append(nmap)
-    
+        nlst.append(_dump_value(val))
     return nlst
             
 def _dump_super(obj):
@@ -162,25 +236,10 @@ def _dump(obj):
     
     ret = {}
     items = obj.iteritems() if isinstance(obj, types.DictionaryType) else obj.__dict__.iteritems()
-    #items = inspect.getmembers(obj)
     for key, val in items:
-        if key.startswith('_'): continue
-        
-        if _is_unsupported_type(obj):
-            raise NoneSupportedTypeError('cannot dump %s, type:%s, object dict: %s' % (val, type(val), obj.__dict__))
-        
-        if _is_primitive_types(val):
-            ret[key] = val
-        elif isinstance(val, types.DictType):
-            ret[key] = val
-        elif isinstance(val, types.ListType):
-            nlst = _dump_list(val)
-            ret[key] = nlst
-        elif isinstance(val, types.NoneType):
-            pass
-        else:
-            nmap = _dump(val)
-            ret[key] = nmap
+        if val is None or key.startswith('_'):
+            continue
+        ret[key] = _dump_value(val)
     return ret
 
 def dumps(obj, pretty=False):
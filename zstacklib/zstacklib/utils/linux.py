@@ -3,6 +3,8 @@
 @author: frank
 '''
 import os
+import copy
+import errno
 import socket
 import subprocess
 import time
@@ -16,6 +18,7 @@ import threading
 from zstacklib.utils import shell
 from zstacklib.utils import log
 from zstacklib.utils import lock
+from zstacklib.utils import proctable
 
 
 logger = log.get_logger(__name__)
@@ -65,7 +68,85 @@ def cidr_to_netmask(cidr):
     cidr = int(cidr)
     return socket.inet_ntoa(struct.pack(">I", (0xffffffff << (32 - cidr)) & 0xffffffff))
 
+class EthernetInfoCache(object):
+    '''
+    the devices of get_ethernet_info() indexed by name, mac and ip. They are
+    reloaded after an rtnetlink link or ipv4 address notification, which a
+    lookup reads without blocking. The kernel queues a notification before
+    the command changing a link returns, so a lookup right after a change
+    never sees the old devices
+    '''
+    NETLINK_ROUTE = 0
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sock = None
+        self.devices = None
+        self.by_name = {}
+        self.by_mac = {}
+        self.by_ip = {}
+
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, self.NETLINK_ROUTE)
+            sock.bind((0, self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR))
+            sock.setblocking(False)
+            self._sock = sock
+        except (socket.error, AttributeError) as e:
+            logger.warn('unable to listen to rtnetlink, ethernet devices are not cached, %s' % str(e))
+
+    def _is_changed(self):
+        changed = False
+        while True:
+            try:
+                self._sock.recv(65536)
+                changed = True
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # ENOBUFS, notifications were dropped
+                    changed = True
+                return changed
+
+    def _load(self):
+        self.devices = _get_ethernet_info()
+        self.by_name = {}
+        self.by_mac = {}
+        self.by_ip = {}
+        for e in self.devices:
+            self.by_name[e.interface] = e
+            if e.mac:
+                self.by_mac.setdefault(e.mac, []).append(e.interface)
+            if e.ip and e.ip not in self.by_ip:
+                self.by_ip[e.ip] = e.interface
+
+    def refresh(self):
+        '''
+        must be called with the lock held, see lookup()
+        '''
+        if self._sock is None or self._is_changed() or self.devices is None:
+            self._load()
+
+    def lookup(self, func):
+        with self._lock:
+            self.refresh()
+            return func(self)
+
+_ethernet_info_cache = None
+_ethernet_info_cache_lock = threading.Lock()
+
+def _get_ethernet_info_cache():
+    global _ethernet_info_cache
+    with _ethernet_info_cache_lock:
+        if not _ethernet_info_cache:
+            _ethernet_info_cache = EthernetInfoCache()
+        return _ethernet_info_cache
+
 def get_ethernet_info():
+    # callers get copies, changing them doesn't change the cache
+    return _get_ethernet_info_cache().lookup(lambda c: [copy.copy(e) for e in c.devices])
+
+def _get_ethernet_info():
     link_info = shell.call('ip -o link show')
     inet_info = shell.call('ip -o -f inet addr show')
 
@@ -315,6 +396,24 @@ def write_to_temp_file(content):
     tmp_fd.close()
     return tmp_path
 
+def write_file_atomically(path, content):
+    '''
+    readers of path see either the old or the new content, never a partial one
+    '''
+    (tmp_fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(tmp_fd, 'w') as fd:
+            fd.write(content)
+        if os.path.exists(path):
+            os.chmod(tmp_path, os.stat(path).st_mode & 0777)
+        else:
+            os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 def ssh(hostname, sshkey, cmd, user='root'):
     def create_ssh_key_file():
         return write_to_temp_file(sshkey)
@@ -749,30 +848,17 @@ def get_nic_name_by_mac(mac):
         return names[0]
 
 def get_nic_names_by_mac(mac):
-    eths = get_ethernet_info()
-    names = []
     mac = mac.lower()
-    for e in eths:
-        if not e.mac or e.mac != mac:
-            continue
-
-        if e.interface:
-            names.append(e.interface)
-    return names
+    return _get_ethernet_info_cache().lookup(lambda c: [n for n in c.by_mac.get(mac, []) if n])
 
 def get_nic_name_by_ip(ip):
-    eths = get_ethernet_info()
-    for e in eths:
-        if e.ip and e.ip == ip:
-            return e.interface
-    return None
+    return _get_ethernet_info_cache().lookup(lambda c: c.by_ip.get(ip))
 
 def get_ip_by_nic_name(nicname):
-    eths = get_ethernet_info()
-    for e in eths:
-        if e.interface == nicname:
-            return e.ip
-    return None
+    def ip_of(c):
+        e = c.by_name.get(nicname)
+        return e.ip if e else None
+    return _get_ethernet_info_cache().lookup(ip_of)
 
 def get_nic_name_from_alias(nicnames):
     for name in nicnames:
@@ -849,26 +935,9 @@ def create_vlan_bridge(bridgename, ethname, vlan, ip=None, netmask=None):
     create_bridge(bridgename, vlan_dev_name, move_route)
 
 def find_process_by_cmdline(cmdlines):
-    pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
-    for pid in pids:
-        try:
-            with open(os.path.join('/proc', pid, 'cmdline'), 'r') as fd:
-                cmdline = fd.read()
-
-            is_find = True
-            for c in cmdlines:
-                if c not in cmdline:
-                    is_find = False
-                    break
-
-            if not is_find:
-                continue
-
-            return pid
-        except IOError:
-            continue
-
-    return None
+    # looked up in the process table of proctable instead of reading the
+    # cmdline of every process
+    return proctable.find_process_by_cmdline(cmdlines)
 
 def error_if_path_missing(path):
     if not os.path.exists(path):
@@ -0,0 +1,144 @@
+'''
+an index of the command lines of the processes on the host. Each refresh lists
+/proc but only reads the cmdline of processes it hasn't seen, instead of
+reading every /proc/<pid>/cmdline for each lookup
+'''
+import os
+import time
+import threading
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+def _read_cmdline(pid):
+    try:
+        with open('/proc/%s/cmdline' % pid, 'r') as fd:
+            return fd.read()
+    except IOError:
+        return None
+
+def _read_ctime(pid):
+    # the inode of /proc/<pid> is made when the pid is first looked up after
+    # the process started, so a reused pid has another ctime. The inode may
+    # also be made again after being evicted from cache, then the cmdline is
+    # just read again
+    try:
+        return os.stat('/proc/%s' % pid).st_ctime
+    except OSError:
+        return None
+
+def _matches(cmdline, patterns):
+    for p in patterns:
+        if p not in cmdline:
+            return False
+    return True
+
+class ProcessTable(object):
+    '''
+    pid -> cmdline of all processes. A process may exec another program right
+    after being forked, so the cmdline of a pid seen less than RECHECK_WINDOW
+    seconds ago is read again on the next refresh. A pid reused by another
+    process is told by the ctime of /proc/<pid>, which is cheaper to get than
+    the start time in /proc/<pid>/stat, its cmdline is then read again. A pid
+    found by a lookup is verified against /proc before it is returned
+    '''
+    RECHECK_WINDOW = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # pid -> (cmdline, ctime of /proc/<pid>, time the process was first seen)
+        self._processes = {}
+
+    def refresh(self):
+        now = time.time()
+        pids = set([pid for pid in os.listdir('/proc') if pid.isdigit()])
+
+        for pid in self._processes.keys():
+            if pid not in pids:
+                del self._processes[pid]
+
+        for pid in pids:
+            ctime = _read_ctime(pid)
+            p = self._processes.get(pid)
+            if p and p[1] != ctime:
+                # the pid has been reused
+                p = None
+            if p and now - p[2] > self.RECHECK_WINDOW:
+                continue
+
+            cmdline = _read_cmdline(pid)
+            if cmdline is None or ctime is None:
+                # the process has exited
+                self._processes.pop(pid, None)
+                continue
+
+            self._processes[pid] = (cmdline, ctime, p[2] if p else now)
+
+    def find_many(self, queries):
+        '''
+        queries is a dict of name -> list of strings that must all be in the
+        cmdline of a process. All queries are resolved in one pass over the
+        table, returns a dict of name -> pid, None for names not found
+        '''
+        ret = dict([(name, None) for name in queries.keys()])
+        with self._lock:
+            self.refresh()
+
+            pending = dict(queries)
+            for pid, (cmdline, _, _) in self._processes.items():
+                if not pending:
+                    break
+
+                names = [name for name, patterns in pending.items() if _matches(cmdline, patterns)]
+                if not names:
+                    continue
+
+                current = _read_cmdline(pid)
+                if current is None:
+                    del self._processes[pid]
+                    continue
+                if current != cmdline:
+                    # the pid has been reused since it was read
+                    self._processes[pid] = (current, _read_ctime(pid), time.time())
+
+                for name in names:
+                    if _matches(current, pending[name]):
+                        ret[name] = pid
+                        del pending[name]
+
+        return ret
+
+    def find(self, patterns):
+        return self.find_many({'pid': patterns})['pid']
+
+_table = ProcessTable()
+
+def find_process_by_cmdline(cmdlines):
+    return _table.find(cmdlines)
+
+def find_processes_by_cmdlines(queries):
+    return _table.find_many(queries)
+
+def get_pid_from_pidfile(pidfile, cmdlines=None):
+    '''
+    the pid in pidfile if the process is alive and, when cmdlines is given,
+    has all of cmdlines in its cmdline. None otherwise
+    '''
+    if not os.path.exists(pidfile):
+        return None
+
+    with open(pidfile, 'r') as fd:
+        pid = fd.read().strip()
+
+    if not pid.isdigit():
+        return None
+
+    cmdline = _read_cmdline(pid)
+    if cmdline is None:
+        return None
+
+    if cmdlines and not _matches(cmdline, cmdlines):
+        # a stale pidfile whose pid now belongs to another process
+        return None
+
+    return pid
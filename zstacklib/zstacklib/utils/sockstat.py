@@ -0,0 +1,113 @@
+'''
+tcp socket inspection by reading /proc/net/tcp and /proc/net/tcp6, which is
+what netstat does but without forking a process and formatting every socket
+of the host for each query
+'''
+import os
+import time
+import threading
+from zstacklib.utils import log
+
+logger = log.get_logger(__name__)
+
+PROC_NET_TCP = ['/proc/net/tcp', '/proc/net/tcp6']
+TCP_LISTEN = '0A'
+
+class TcpSocket(object):
+    def __init__(self):
+        self.local_port = None
+        self.remote_port = None
+        self.state = None
+        self.inode = None
+
+def _parse_port(addr):
+    # 0100007F:1F90 or 00000000000000000000000000000000:1F90
+    return int(addr.rsplit(':', 1)[1], 16)
+
+def get_tcp_sockets():
+    ret = []
+    for path in PROC_NET_TCP:
+        if not os.path.exists(path):
+            continue
+
+        with open(path, 'r') as fd:
+            lines = fd.readlines()
+
+        # the first line is the header
+        for l in lines[1:]:
+            fields = l.split()
+            if len(fields) < 10:
+                continue
+
+            s = TcpSocket()
+            s.local_port = _parse_port(fields[1])
+            s.remote_port = _parse_port(fields[2])
+            s.state = fields[3]
+            s.inode = fields[9]
+            ret.append(s)
+    return ret
+
+_listening_lock = threading.Lock()
+_listening_ports = set()
+_listening_scanned_at = 0
+
+def get_listening_ports(max_age=0):
+    '''
+    ports of all listening tcp sockets. A scan younger than max_age seconds
+    is reused, so threads waiting for different ports at the same time share
+    one read of /proc/net/tcp
+    '''
+    global _listening_ports, _listening_scanned_at
+    with _listening_lock:
+        if max_age > 0 and time.time() - _listening_scanned_at < max_age:
+            return _listening_ports
+
+        _listening_ports = set([s.local_port for s in get_tcp_sockets() if s.state == TCP_LISTEN])
+        _listening_scanned_at = time.time()
+        return _listening_ports
+
+def is_port_listening(port):
+    return int(port) in get_listening_ports()
+
+def wait_ports_listening(ports, timeout=30, interval=0.5):
+    '''
+    wait until all ports are listening, returns the ports still not listening
+    after timeout, an empty set means success
+    '''
+    pending = set([int(p) for p in ports])
+    deadline = time.time() + timeout
+    while True:
+        pending -= get_listening_ports(interval)
+        if not pending or time.time() >= deadline:
+            return pending
+        time.sleep(interval)
+
+def get_pid_listening_on_port(port):
+    '''
+    the pid of the process owning the listening socket of port, None if no
+    process listens on it
+    '''
+    port = int(port)
+    inodes = set(['socket:[%s]' % s.inode for s in get_tcp_sockets() if s.state == TCP_LISTEN and s.local_port == port])
+    if not inodes:
+        return None
+
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+
+        fd_dir = os.path.join('/proc', pid, 'fd')
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # the process exited or is not ours to inspect
+            continue
+
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)) in inodes:
+                    return int(pid)
+            except OSError:
+                continue
+
+    return None
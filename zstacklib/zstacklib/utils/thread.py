@@ -3,12 +3,14 @@
 @author: frank
 '''
 
+import sys
 import threading
 import inspect
 import pprint
 import traceback
 import log
 import functools
+import Queue
 
 logger = log.get_logger(__name__)
 
@@ -37,6 +39,129 @@ class ThreadFacade(object):
         t.start()
         return t
 
+class ThreadPoolFullError(Exception):
+    '''thread pool full error'''
+
+class ThreadPool(object):
+    '''
+    a fixed number of worker threads consuming a bounded task queue. Workers
+    are created lazily on the first submit, submit() raises ThreadPoolFullError
+    instead of blocking when the queue is full
+    '''
+
+    def __init__(self, size=64, queue_size=1024, name='pool'):
+        self.size = size
+        self.queue_size = queue_size
+        self.name = name
+        self.queue = Queue.Queue(queue_size)
+        self.workers = []
+        self._lock = threading.Lock()
+
+    def _start_workers(self):
+        with self._lock:
+            if self.workers:
+                return
+
+            for i in range(self.size):
+                t = threading.Thread(target=self._work, name='%s-%s' % (self.name, i))
+                t.daemon = True
+                t.start()
+                self.workers.append(t)
+
+    def _work(self):
+        while True:
+            (target, args, kwargs) = self.queue.get()
+            try:
+                if target is None:
+                    return
+                target(*args, **kwargs)
+            except Exception as e:
+                content = traceback.format_exc()
+                err = '%s\n%s\nargs:%s' % (str(e), content, pprint.pformat([args, kwargs]))
+                logger.warn(err)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, target, *args, **kwargs):
+        if not self.workers:
+            self._start_workers()
+
+        try:
+            self.queue.put_nowait((target, args, kwargs))
+        except Queue.Full:
+            raise ThreadPoolFullError('thread pool[%s] is full, %s tasks are waiting' % (self.name, self.queue_size))
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def join(self):
+        self.queue.join()
+
+    def shutdown(self):
+        with self._lock:
+            for t in self.workers:
+                self.queue.put((None, (), {}))
+            self.workers = []
+
+class _CoalescedCall(object):
+    def __init__(self, item):
+        self.item = item
+        self.done = False
+        self.error = None
+
+class Coalescer(object):
+    '''
+    merges items submitted concurrently into one call of apply_func(items).
+    submit() blocks until the batch holding the item is applied; the caller
+    finding no batch running applies all pending items for the others. If a
+    batch of several items fails, its items are retried one by one so every
+    caller gets its own error
+    '''
+
+    def __init__(self, apply_func):
+        self.apply_func = apply_func
+        self.pending = []
+        self.running = False
+        self.cond = threading.Condition()
+
+    def _apply(self, calls):
+        try:
+            self.apply_func([c.item for c in calls])
+            return
+        except Exception:
+            if len(calls) == 1:
+                calls[0].error = sys.exc_info()
+                return
+
+        logger.warn('failed to apply %s coalesced items, apply them one by one' % len(calls))
+        for c in calls:
+            self._apply([c])
+
+    def submit(self, item):
+        call = _CoalescedCall(item)
+        with self.cond:
+            self.pending.append(call)
+            while self.running and not call.done:
+                self.cond.wait()
+
+            if not call.done:
+                calls = self.pending
+                self.pending = []
+                self.running = True
+
+        if not call.done:
+            try:
+                self._apply(calls)
+            finally:
+                with self.cond:
+                    for c in calls:
+                        c.done = True
+                    self.running = False
+                    self.cond.notify_all()
+
+        if call.error:
+            raise call.error[0], call.error[1], call.error[2]
+
 class PeriodicTimer(object):
     def __init__(self, interval, callback, args=[], kwargs={}, stop_on_exception=True):
         self.interval = interval
@@ -2,16 +2,75 @@
 
 @author: Frank
 '''
-import xml.etree.ElementTree as etree
+try:
+    import xml.etree.cElementTree as etree
+except ImportError:
+    import xml.etree.ElementTree as etree
 import re
 import types
+import threading
+
+# serializes the conversion of lazily loaded nodes, see XmlObject._materialize()
+_materialize_lock = threading.Lock()
 
 class XmlObjectError(Exception):
     '''XmlObject error'''
 
 class XmlObject(object):
+    '''
+    an xml element whose attributes are python attributes with a '_' suffix,
+    whose text is text_ and whose children are attributes named by their tags,
+    a list if the tag repeats.
+
+    An XmlObject returned by loads() keeps its ElementTree element and
+    converts it on the first access, only the parts of a document that are
+    read are converted
+    '''
     def __init__(self, tag):
         self.__tag_name__ = tag
+
+    def _materialize(self):
+        d = self.__dict__
+        if '_node' not in d:
+            return
+
+        with _materialize_lock:
+            node = d.get('_node')
+            if node is None:
+                return
+
+            attrs = {}
+            for key, val in node.attrib.iteritems():
+                if key.startswith('xmlns'):
+                    # a namespace declaration set as a plain attribute on a built
+                    # tree, the parser never reports it as an attribute
+                    continue
+                attrs[key + '_'] = val.strip().strip('\t')
+
+            text = node.text
+            attrs['text_'] = text.strip().strip('\n').strip('\t') if text else ''
+
+            for n in node:
+                tag = n.tag
+                child = _lazy(n)
+                nodes = attrs.get(tag)
+                if nodes is None:
+                    attrs[tag] = child
+                elif isinstance(nodes, types.ListType):
+                    nodes.append(child)
+                else:
+                    attrs[tag] = [nodes, child]
+
+            d.update(attrs)
+            del d['_node']
+
+    def __setattr__(self, name, val):
+        self._materialize()
+        self.__dict__[name] = val
+
+    def __delattr__(self, name):
+        self._materialize()
+        del self.__dict__[name]
     
     def get_tag(self):
         return self.__tag_name__
@@ -75,6 +134,7 @@ class XmlObject(object):
             return [children]
     
     def get_children_nodes(self):
+        self._materialize()
         children = {}
         for key, value in self.__dict__.items():
             if isinstance(value, XmlObject) or isinstance(value, types.ListType):
@@ -83,36 +143,45 @@ class XmlObject(object):
     
     
     def dump(self):
+        # one buffer for the whole document instead of joining per element
+        xmlstr = []
+
         def _dump(obj):
-            xmlstr = []
-            opentag = []
-            opentag.append('<%s' % obj.get_tag())
-            for key, val in obj.__dict__.iteritems():
+            obj._materialize()
+            items = obj.__dict__.items()
+            xmlstr.append('<%s' % obj.get_tag())
+            for key, val in items:
                 if not key.endswith('_') or key.startswith('_') or key == 'text_':
                     continue
-                opentag.append('%s="%s"' % (key[:-1], val))
-            xmlstr.append(' '.join(opentag))
+                xmlstr.append(' %s="%s"' % (key[:-1], val))
             xmlstr.append('>')
             
             found_child = False
-            for key, val in obj.__dict__.iteritems():
+            for key, val in items:
                 if isinstance(val, XmlObject):
-                    xmlstr.append(_dump(val))
+                    _dump(val)
                     found_child = True
                 if isinstance(val, types.ListType):
                     for l in val:
                         if isinstance(l, XmlObject):
-                            xmlstr.append(_dump(l))
+                            _dump(l)
                             found_child = True
                 
-            if not found_child and hasattr(obj, 'text_'):
-                xmlstr.append(getattr(obj, 'text_'))
+            if not found_child and 'text_' in obj.__dict__:
+                xmlstr.append(obj.text_)
             xmlstr.append('</%s>' % obj.get_tag())
-            return ''.join(xmlstr)
-        
-        return _dump(self)
+
+        _dump(self)
+        return ''.join(xmlstr)
     
     def __getattr__(self, name):
+        # only called for names not in __dict__, which may not be converted yet
+        d = self.__dict__
+        if '_node' in d:
+            self._materialize()
+        if name in d:
+            return d[name]
+
         if name.endswith('__'):
             n = name[:-1]
             if hasattr(self, n):
@@ -128,22 +197,20 @@ class XmlObject(object):
     def has_element(self, elementstr):
         return has_element(self, elementstr)
 
-def _loads(node):
-    xo = XmlObject(node.tag)
-    for key in node.attrib.keys():
-        xo.put_attr(key, node.attrib.get(key))
-    if node.text:
-        xo.put_text(node.text)
-    else:
-        xo.put_text('')
-    for n in list(node):
-        sub_xo = _loads(n)
-        xo.put_node(n.tag, sub_xo)
+def _lazy(node):
+    xo = XmlObject.__new__(XmlObject)
+    d = xo.__dict__
+    d['__tag_name__'] = node.tag
+    d['_node'] = node
     return xo
+
+def _loads(node):
+    return _lazy(node)
     
 def loads(xmlstr):
     try:
-        xmlstr = re.sub(r'xmlns=".*"', '', xmlstr)
+        if 'xmlns="' in xmlstr:
+            xmlstr = re.sub(r'xmlns=".*"', '', xmlstr)
         root = etree.fromstring(xmlstr)
         return _loads(root)
     except Exception as e:
@@ -155,6 +222,13 @@ xml content:
         raise XmlObjectError(err)
         
 
+def loads_from_element(node):
+    '''
+    the XmlObject of an ElementTree element, for xml built in memory which
+    doesn't need a round trip through a string
+    '''
+    return _loads(node)
+
 def loads_from_xml_file(path):
     with open(path, 'r') as fd:
         xmlstr = fd.read()